@@ -0,0 +1,179 @@
+import sys
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import yaha_analyzer
+from profiling import peak_rss
+
+SCALES = [1000, 10000, 100000] #games per benchmark run
+BASELINE_FILE = 'benchmark_baseline.json'
+TOLERANCE = 1.25 #a stage regresses if it takes this many times its baseline
+NOISE_FLOOR = 0.01 #seconds a stage may slow down by before it's counted as a regression, so tiny stages don't flap
+THE_COIN = {'id': 'GAME_005', 'name': 'The Coin', 'mana': None} #played on turn 1 by whoever went second when synthetic_games is asked for it
+STAGES = ['generate_decks', 'generate_matchups', 'generate_card_stats', 'generate_decklist_matchups', 'create_heatmap', 'make_graph_data', '_update_graph_data']
+
+def synthetic_games(count, heroes = 9, archetypes = 4, cards = 300, max_turns = 15, plays_per_turn = 3, card_skew = 1.0, coin = False, seed = 0):
+    """
+    Generates collect-o-bot style games, decks are drawn uniformly and cards from a zipf-like distribution so a few cards show up in most games
+
+    Keyword parameters:
+    count -- int, number of games
+    heroes -- int, number of heroes
+    archetypes -- int, number of deck archetypes per hero, games without an archetype are added as well
+    cards -- int, size of the card pool
+    max_turns -- int, games last between 1 and max_turns turns
+    plays_per_turn -- int, each player plays between 0 and plays_per_turn cards a turn
+    card_skew -- float, exponent of the card distribution, 0 draws every card equally often
+    coin -- bool, start every game with THE_COIN, a card without a mana cost, played by the player with the coin
+    seed -- int, random seed, the same arguments always make the same games
+
+    Returns:
+    games -- list of game dicts
+    """
+    rand = random.Random(seed)
+    hero_names = ['Hero{}'.format(n) for n in range(heroes)]
+    deck_names = ['Deck{}'.format(n) for n in range(archetypes)] + [None]
+    pool = [{'id': 'CARD_{:04d}'.format(n), 'name': 'Card {}'.format(n), 'mana': n % 11} for n in range(cards)]
+    weights = [1/(n + 1)**card_skew for n in range(cards)]
+    games = []
+    for game_id in range(count):
+        turns = rand.randint(1, max_turns)
+        card_history = []
+        for turn in range(1, turns + 1):
+            for player in ('me', 'opponent'):
+                for card in rand.choices(pool, weights, k = rand.randint(0, plays_per_turn)):
+                    card_history.append({'player': player, 'turn': turn, 'card': dict(card)})
+        games.append({
+            'id': game_id,
+            'mode': rand.choice(['ranked', 'ranked', 'casual', 'arena']),
+            'hero': rand.choice(hero_names),
+            'hero_deck': rand.choice(deck_names),
+            'opponent': rand.choice(hero_names),
+            'opponent_deck': rand.choice(deck_names),
+            'coin': rand.random() < 0.5,
+            'result': rand.choice(['win', 'loss']),
+            'duration': rand.randint(60, 1200),
+            'rank': rand.choice([None, rand.randint(1, 25)]),
+            'legend': None,
+            'note': None,
+            'added': '2016-07-{:02d}T{:02d}:{:02d}:{:02d}.000Z'.format(rand.randint(1, 28), rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59)),
+            'region': rand.choice(['America', 'Europe', 'Asia']),
+            'user_hash': 'user{}'.format(rand.randint(0, count//20)),
+            'card_history': card_history
+        })
+        if coin:
+            card_history.insert(0, {'player': 'me' if games[-1]['coin'] else 'opponent', 'turn': 1, 'card': dict(THE_COIN)})
+    return games
+
+def run_scale(count, seed = 0):
+    """
+    Runs every stage in STAGES once on count synthetic games, the analysis cache is cleared before each stage so nothing is reused
+
+    Keyword parameters:
+    count -- int, number of games
+    seed -- int, random seed of the games
+
+    Returns:
+    results -- dict of stage -> {'seconds': wall time, 'peak_rss_mb': peak rss of the process after the stage}
+    """
+    results = {}
+    directory = tempfile.mkdtemp()
+    yaha_analyzer.GRAPH_DATABASE = os.path.join(directory, 'graph.db')
+    yaha_analyzer.ANALYSIS_CACHE_DIR = None
+    analyzer = yaha_analyzer.yaha_analyzer()
+    analyzer.history = {'children': synthetic_games(count, seed = seed)}
+
+    def stage(name, function):
+        yaha_analyzer.clear_analysis_cache()
+        start = time.perf_counter()
+        result = function()
+        results[name] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss()}
+        return result
+
+    stage('generate_decks', analyzer.generate_decks)
+    stage('generate_matchups', analyzer.generate_matchups)
+    stage('generate_card_stats', analyzer.generate_card_stats)
+    decklists = stage('generate_decklist_matchups', analyzer.generate_decklist_matchups).reset_index()
+    stage('create_heatmap', lambda: [analyzer.create_heatmap(x = 'o_deck_type', y = 'card', z = 'win%', df = d_data, title = deck, text = 'total_games') for deck, d_data in decklists.groupby('p_deck_type')])
+    stage('make_graph_data', analyzer.make_graph_data)
+    conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+    rows = conn.execute('SELECT id, name, json, type FROM graphs').fetchall()
+    conn.close()
+    yaha_analyzer.GRAPH_DATABASE = os.path.join(directory, 'graph_rows.db')
+    stage('_update_graph_data', lambda: analyzer._update_graph_data(rows))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return results
+
+def run(scales = SCALES, seed = 0):
+    """
+    Runs run_scale for every scale, each in a new process so the peak rss of one scale doesn't carry over to the next
+
+    Keyword parameters:
+    scales -- list of ints, numbers of games
+    seed -- int, random seed of the games
+
+    Returns:
+    results -- dict of str(scale) -> run_scale results
+    """
+    results = {}
+    for count in scales:
+        with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as pool:
+            results[str(count)] = pool.submit(run_scale, count, seed).result()
+    return results
+
+def compare(results, baseline, tolerance = TOLERANCE):
+    """
+    Finds the stages that got slower than their baseline
+
+    Keyword parameters:
+    results -- dict from run
+    baseline -- dict from an earlier run
+    tolerance -- float, a stage regresses if it takes more than tolerance times its baseline, plus NOISE_FLOOR
+
+    Returns:
+    regressions -- list of (scale, stage, baseline seconds, seconds)
+    """
+    regressions = []
+    for scale, stages in sorted(results.items(), key = lambda item: int(item[0])):
+        for name, result in stages.items():
+            old = baseline.get(scale, {}).get(name)
+            if old and result['seconds'] > old['seconds']*tolerance + NOISE_FLOOR:
+                regressions.append((scale, name, old['seconds'], result['seconds']))
+    return regressions
+
+def main(argv = None):
+    """
+    Command line entry point, prints the results and any regressions against the baseline file, exits with 1 if there are regressions
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmarks the ingest -> aggregate -> graph pipeline on synthetic collect-o-bot data')
+    parser.add_argument('--scales', type = int, nargs = '+', default = SCALES, help = 'numbers of games to run')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--baseline', default = BASELINE_FILE, help = 'json file of an earlier run to compare against')
+    parser.add_argument('--save', action = 'store_true', help = 'write the results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE)
+    args = parser.parse_args(argv)
+    results = run(args.scales, args.seed)
+    for scale, stages in results.items():
+        for name in STAGES:
+            print('{:>8} {:<28} {:>9.3f}s {:>9.1f}MB'.format(scale, name, stages[name]['seconds'], stages[name]['peak_rss_mb']))
+    regressions = []
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as infile:
+            regressions = compare(results, json.load(infile), args.tolerance)
+        for scale, name, old, new in regressions:
+            print('regression: {} at {} games took {:.3f}s, baseline {:.3f}s'.format(name, scale, new, old))
+    if args.save:
+        with open(args.baseline, 'w') as outfile:
+            json.dump(results, outfile, indent = 2, sort_keys = True)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,59 @@
 import requests
 import pandas as pd
-import urllib.request
 import subprocess
 import sqlite3
 import zipfile
 import os
+import io
 import json
+import threading
+import time
+import collections
+import itertools
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor
+import profiling
 
 URL = 'http://files.hearthscry.com/collectobot/'
 DATABASE = '../collectobot_data/collectobot.db'
+START_DATE = '2016-7-01' #first day with a daily file
+DOWNLOAD_WORKERS = 4 #days downloaded at once by pull_data
+DOWNLOAD_WINDOW = 2 #days in flight per download worker, downloaded days wait in memory until they're written
+DOWNLOAD_RETRIES = 3 #attempts per day before pull_data gives up
+DOWNLOAD_BACKOFF = 1 #seconds before the first retry, doubled on every retry
+GAME_COLUMNS = [('id', 'INTEGER'), ('mode', 'TEXT'), ('hero', 'TEXT'), ('hero_deck', 'TEXT'), ('opponent', 'TEXT'), ('opponent_deck', 'TEXT'), ('coin', 'INTEGER'), ('result', 'TEXT'), ('duration', 'INTEGER'),
+                ('rank', 'INTEGER'), ('legend', 'INTEGER'), ('note', 'TEXT'), ('added', 'TEXT'), ('region', 'TEXT'), ('user_hash', 'TEXT')] #fields of a game kept in the games table
+DECK_COLUMNS = ['hero', 'hero_deck', 'opponent', 'opponent_deck'] #always read by iter_frames, the deck types are built from them
 
-def pull_data():
+_PLAYS_TABLE = 'CREATE TABLE IF NOT EXISTS plays (game INTEGER, player TEXT, turn INTEGER, card INTEGER, card_id TEXT, mana INTEGER)'
+
+def pull_data(end_date = None, workers = DOWNLOAD_WORKERS, profile_dir = None, cprofile = None):
     """
     Pulls all the collect-o-bot data from: http://www.hearthscry.com/CollectOBot and stores them into DATABASE
     Datebase structure is: ['id', 'date', 'json'] with [int, text, text]
+    Days are downloaded by a pool of workers and unzipped in memory, each one is committed as soon as it's written so a failed pull can be resumed. Days already in the database are skipped.
+    The games are stored parsed into the games and plays tables, the day's json column is left NULL. Days stored as json by older pulls are normalized first
+
+    Keyword parameters:
+    end_date -- str, formatted in the manner YY-mm-dd, the last day to pull. Today if None
+    workers -- int, days downloaded at once
+    profile_dir -- str, directory for a profile report of the download, json parse and sqlite write stages, see profiling.profile
+    cprofile -- bool, also dump cProfile stats for every stage
     """
-    conn = sqlite3.connect(DATABASE)
+    with profiling.profile('collectobot_pull_data', profile_dir, cprofile):
+        with profiling.stage('normalize'):
+            normalize()
+        _pull_days(end_date, workers)
+
+def _pull_days(end_date, workers):
+    """
+    Downloads and stores the days pull_data is missing, in date order, with at most workers * DOWNLOAD_WINDOW days submitted and not written yet
+
+    Keyword parameters:
+    end_date -- str, formatted in the manner YY-mm-dd, the last day to pull. Today if None
+    workers -- int, days downloaded at once
+    """
+    conn = _connect()
     c = conn.cursor()
     c.execute('SELECT max(id) FROM collectobot')
     max_id = c.fetchone()[0]
@@ -24,35 +62,64 @@ def pull_data():
         data = c.fetchone()
         last_date = data[1]
     else:
-        last_date = '2016-7-01'
+        last_date = START_DATE
         max_id = 1
     beginning = max_id
-    times = pd.date_range(end=pd.to_datetime('today'), start=last_date)
-    error_dates = []
-    for date in times:
-        try:
-            urllib.request.urlretrieve('{}{}.zip'.format(URL, date.date().strftime('%Y-%m-%d')), './collectobot_data/{}.zip'.format(date.date()))
-        except urllib.request.HTTPError as err:
-            if err.code == 404:
-                error_dates.append(date.date())
-            else:
-                raise
-        if date.date() not in error_dates and date.date().strftime('%Y-%m-%d') != last_date:
-            with zipfile.ZipFile('./collectobot_data/{}.zip'.format(date.date())) as zip_ref:
-                zip_ref.extractall('./collectobot_data/')
-            with open('./collectobot_data/{}.json'.format(date.date())) as infile:
-                data = infile.readlines()
-                data = ''.join(data)
+    stored = {pd.to_datetime(date, errors = 'coerce').date() for (date,) in c.execute('SELECT date FROM collectobot')}
+    times = pd.date_range(end=pd.to_datetime(end_date or 'today'), start=last_date)
+    dates = [date.date() for date in times if date.date() not in stored]
+    sessions = threading.local()
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            pending = iter(dates)
+            downloads = collections.deque((date, pool.submit(_download_day, date, sessions)) for date in itertools.islice(pending, workers * DOWNLOAD_WINDOW))
+            while downloads:
+                date, download = downloads.popleft()
+                with profiling.stage('download') as stage: #time spent waiting on the workers
+                    data = download.result()
+                    stage.add(rows = 1, nbytes = len(data or ''))
+                for next_date in itertools.islice(pending, 1):
+                    downloads.append((next_date, pool.submit(_download_day, next_date, sessions)))
+                if data is None: #no file for that day
+                    continue
                 max_id += 1
-                c.execute('INSERT INTO collectobot VALUES (?, ?, ?)', (max_id, '{}'.format(date.date()), data))
-    conn.commit()
-    conn.close()
+                with profiling.stage('json_parse') as stage:
+                    games = json.loads(data)['games']
+                    stage.add(rows = len(games), nbytes = len(data))
+                with profiling.stage('sqlite_write') as stage:
+                    c.execute('INSERT INTO collectobot VALUES (?, ?, NULL)', (max_id, '{}'.format(date)))
+                    _store_games(c, max_id, games)
+                    conn.commit()
+                    stage.add(rows = len(games))
+    finally:
+        conn.close()
+        print('wrote {} new entries'.format(max_id - beginning))
+
+def _download_day(date, sessions):
+    """
+    Downloads one day's zip and returns the json inside it, retrying DOWNLOAD_RETRIES times
 
-    for date in times:
-        if date.date() not in error_dates and date.date().strftime('%Y-%m-%d') != last_date:
-            os.remove('collectobot_data/{}.zip'.format(date.date()))
-            os.remove('collectobot_data/{}.json'.format(date.date()))
-    print('wrote {} new entries'.format(max_id - beginning))
+    Keyword parameters:
+    date -- datetime.date, day to download
+    sessions -- threading.local, holds each worker's requests session
+
+    Returns:
+    data -- str, the day's json, None if there's no file for that day
+    """
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            response = sessions.session.get('{}{}.zip'.format(URL, date.strftime('%Y-%m-%d')))
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
+                return zip_ref.read(zip_ref.namelist()[0]).decode('utf-8')
+        except (requests.RequestException, zipfile.BadZipFile):
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            time.sleep(DOWNLOAD_BACKOFF * 2**attempt)
 
 def add_june_2016():
     """This is a manual method to add june 2016, which only has a monthly json file. Don't actually use this."""
@@ -66,23 +133,217 @@ def add_june_2016():
     conn.commit()
     conn.close()
 
+def _connect():
+    """
+    Connects to DATABASE, creating the tables if they're missing
+    collectobot has a row per day ['id', 'date', 'json'], json is NULL once the day's games are in the games and plays tables
+    games has a row per game ['game', 'day'] + GAME_COLUMNS + ['p_deck_type', 'o_deck_type'], where ['day'] is the id of its collectobot row
+    cards is the card dictionary ['card', 'name', 'card_id', 'mana'], a row per card name with the card id and mana it was first played with
+    plays has a row per card played ['game', 'player', 'turn', 'card', 'card_id', 'mana'], where ['card'] is the id of its cards row
+    A plays table from before the card dictionary is moved over to it
+
+    Returns:
+    conn -- sqlite3 connection
+    """
+    conn = sqlite3.connect(DATABASE)
+    conn.execute('CREATE TABLE IF NOT EXISTS collectobot (id INTEGER, date TEXT, json TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS games (game INTEGER PRIMARY KEY, day INTEGER, {}, p_deck_type TEXT, o_deck_type TEXT)'.format(', '.join('{} {}'.format(*column) for column in GAME_COLUMNS)))
+    conn.execute('CREATE TABLE IF NOT EXISTS cards (card INTEGER PRIMARY KEY, name TEXT UNIQUE, card_id TEXT, mana INTEGER)')
+    if 'TEXT' in [row[2] for row in conn.execute('PRAGMA table_info(plays)') if row[1] == 'card']:
+        _intern_plays(conn)
+    conn.execute(_PLAYS_TABLE)
+    conn.execute('CREATE INDEX IF NOT EXISTS collectobot_date ON collectobot (date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS games_day ON games (day)')
+    conn.execute('CREATE INDEX IF NOT EXISTS games_mode ON games (mode)')
+    conn.execute('CREATE INDEX IF NOT EXISTS games_deck_type ON games (p_deck_type, o_deck_type)')
+    conn.execute('CREATE INDEX IF NOT EXISTS plays_game ON plays (game)')
+    conn.commit()
+    return conn
+
+def _connect_read_only():
+    """
+    Connects to DATABASE without creating or migrating anything, for readers of a database pull_data or normalize has already upgraded
+
+    Returns:
+    conn -- sqlite3 connection that can't write
+    """
+    return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(DATABASE))), uri = True)
+
+def _intern_plays(conn):
+    """
+    Moves a plays table that stores card names over to the card dictionary, the cards are numbered in the order they were first played, then vacuums the database to give the space back
+
+    Keyword parameters:
+    conn -- sqlite3 connection on DATABASE
+    """
+    conn.execute('BEGIN')
+    conn.execute('ALTER TABLE plays RENAME TO plays_names')
+    conn.execute('INSERT INTO cards (name, card_id, mana) SELECT card, card_id, mana FROM (SELECT card, card_id, mana, min(rowid) AS first FROM plays_names WHERE card IS NOT NULL GROUP BY card) ORDER BY first')
+    conn.execute(_PLAYS_TABLE)
+    conn.execute('INSERT INTO plays SELECT game, player, turn, cards.card, plays_names.card_id, plays_names.mana FROM plays_names LEFT JOIN cards ON cards.name = plays_names.card ORDER BY plays_names.rowid')
+    conn.execute('DROP TABLE plays_names')
+    conn.commit()
+    conn.execute('VACUUM')
+
+def _store_games(c, day_id, games):
+    """
+    Writes one day's games into the games and plays tables, fields that aren't in GAME_COLUMNS are dropped
+    Cards that aren't in the cards table yet are added to it
+
+    Keyword parameters:
+    c -- sqlite3 cursor on DATABASE
+    day_id -- int, id of the day's collectobot row
+    games -- list of game dicts
+    """
+    c.execute('SELECT coalesce(max(game), -1) + 1 FROM games')
+    first_game = c.fetchone()[0]
+    cards = dict(c.execute('SELECT name, card FROM cards').fetchall())
+    game_rows = []
+    play_rows = []
+    for game_id, game in enumerate(games, first_game):
+        deck_types = ('{}_{}'.format(game.get('hero_deck') or 'Other', game.get('hero')), '{}_{}'.format(game.get('opponent_deck') or 'Other', game.get('opponent')))
+        game_rows.append((game_id, day_id) + tuple(game.get(column) for column, _ in GAME_COLUMNS) + deck_types)
+        for play in game.get('card_history') or []:
+            card = play['card']
+            if card['name'] not in cards:
+                cards[card['name']] = c.execute('INSERT INTO cards (name, card_id, mana) VALUES (?, ?, ?)', (card['name'], card['id'], card['mana'])).lastrowid
+            play_rows.append((game_id, play['player'], play['turn'], cards[card['name']], card['id'], card['mana']))
+    c.executemany('INSERT INTO games VALUES ({})'.format(', '.join('?'*(len(GAME_COLUMNS) + 4))), game_rows)
+    c.executemany('INSERT INTO plays VALUES (?, ?, ?, ?, ?, ?)', play_rows)
+
+def normalize():
+    """
+    Moves the days still stored as json blobs into the games and plays tables, one committed day at a time, then vacuums the database to give the space back
+    This is the upgrade step for databases from before the games and plays tables, pull_data runs it and iter_frames expects it to have been run
+
+    Returns:
+    days -- int, number of days moved
+    """
+    conn = _connect()
+    c = conn.cursor()
+    days = 0
+    try:
+        for (day_id,) in c.execute('SELECT id FROM collectobot WHERE json IS NOT NULL ORDER BY id').fetchall():
+            data = c.execute('SELECT json FROM collectobot WHERE id = ?', (day_id,)).fetchone()[0]
+            with profiling.stage('json_parse') as stage:
+                games = json.loads(data)['games']
+                stage.add(rows = len(games), nbytes = len(data))
+            with profiling.stage('sqlite_write') as stage:
+                _store_games(c, day_id, games)
+                c.execute('UPDATE collectobot SET json = NULL WHERE id = ?', (day_id,))
+                conn.commit()
+                stage.add(rows = len(games))
+            days += 1
+        if days:
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+    return days
+
+def iter_frames(start_date = None, end_date = None, after_id = -1, modes = None, columns = None):
+    """
+    Streams the games and plays of each day in the database from the games and plays tables, oldest first, reading only the days, games and columns asked for
+    The database is only read, it has to have been upgraded by normalize first, a RuntimeError is raised if any of the days after after_id are still stored as json
+
+    Keyword parameters:
+    start_date -- str, formatted in the manner YY-mm-dd, no lower bound if None
+    end_date -- str, formatted in the manner YY-mm-dd, no upper bound if None
+    after_id -- int, only days with an id above this are read
+    modes -- list of game modes to read, every mode if None
+    columns -- list of fields from GAME_COLUMNS to read, every field if None. DECK_COLUMNS are always read
+
+    Yields:
+    (id, (games, plays)) -- the day's id in the database, its games, and its plays where ['game'] is the position of the game in games and ['card'] a categorical of the card names
+    """
+    columns = [column for column, _ in GAME_COLUMNS if columns is None or column in columns or column in DECK_COLUMNS]
+    day_query = 'SELECT id FROM collectobot WHERE id > ?'
+    day_params = [after_id]
+    if start_date is not None:
+        day_query += ' AND date(date) >= date(?)'
+        day_params.append(start_date)
+    if end_date is not None:
+        day_query += ' AND date(date) <= date(?)'
+        day_params.append(end_date)
+    game_query = 'SELECT game, {} FROM games WHERE day = ?'.format(', '.join('"{}"'.format(column) for column in columns))
+    if modes is not None:
+        game_query += ' AND mode IN ({})'.format(', '.join('?'*len(modes)))
+    conn = _connect_read_only()
+    try:
+        _check_normalized(conn, after_id)
+        cards = pd.read_sql_query('SELECT card, name FROM cards WHERE name IS NOT NULL ORDER BY card', conn)
+        for (day_id,) in conn.execute(day_query + ' ORDER BY id', day_params).fetchall():
+            with profiling.stage('sqlite_read') as stage:
+                games = pd.read_sql_query(game_query + ' ORDER BY game', conn, params = [day_id] + list(modes or []))
+                if len(games) == 0:
+                    continue
+                plays = pd.read_sql_query('SELECT game, player, turn, card, card_id, mana FROM plays WHERE game BETWEEN ? AND ?', conn, params = (int(games['game'].min()), int(games['game'].max())))
+                plays['game'] = pd.Index(games['game']).get_indexer(plays['game'])
+                plays = plays[plays['game'] >= 0].reset_index(drop = True)
+                plays['card'] = pd.Categorical.from_codes(pd.Index(cards['card']).get_indexer(plays['card']), categories = cards['name'])
+                games = games.drop('game', axis = 1)
+                if 'coin' in games.columns:
+                    games['coin'] = games['coin'].map({1: True, 0: False})
+                stage.add(rows = len(games) + len(plays))
+            yield day_id, (games, plays)
+    finally:
+        conn.close()
+
+def _check_normalized(conn, after_id):
+    """
+    Raises a RuntimeError if the database is missing the games, plays or cards tables, or days after after_id are still stored as json
+
+    Keyword parameters:
+    conn -- sqlite3 connection on DATABASE
+    after_id -- int, only days with an id above this are checked
+    """
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not {'collectobot', 'games', 'plays', 'cards'} <= tables or conn.execute('SELECT count(*) FROM collectobot WHERE id > ? AND json IS NOT NULL', (after_id,)).fetchone()[0]:
+        raise RuntimeError('{} has days stored as json, run collectobot.normalize() first'.format(DATABASE))
+
+def _to_dicts(games, plays):
+    """
+    Turns a day from iter_frames back into game dicts with their ['card_history']
+
+    Keyword parameters:
+    games -- dataframe of a day's games
+    plays -- dataframe of the day's plays
+
+    Returns:
+    games -- list of game dicts
+    """
+    games = games.astype(object).where(games.notnull(), None).to_dict('records')
+    for game in games:
+        game['card_history'] = []
+    for game, player, turn, card, card_id, mana in plays.itertuples(index = False):
+        games[game]['card_history'].append({'player': player, 'turn': turn, 'card': {'id': card_id, 'name': card, 'mana': None if pd.isnull(mana) else int(mana)}})
+    return games
+
+def iter_aggregate(start_date = '2016-06-30', end_date = pd.to_datetime('today').strftime('%Y-%m-%d')):
+    """
+    Streams the games for the range [date_start, date_end] one day at a time, so only a single day is held in memory
+    Days still stored as json are normalized first. Use iter_frames to read the days as dataframes without building the dicts
+
+    Keyword parameters:
+    start_date -- str, formatted in the manner YY-mm-dd
+    end_date str, formatted in the manner YY-mm-dd
+
+    Yields:
+    games -- list of game dicts for one day
+    """
+    normalize()
+    for day_id, (games, plays) in iter_frames(start_date, end_date):
+        yield _to_dicts(games, plays)
+
 def aggregate(start_date = '2016-06-30', end_date = pd.to_datetime('today').strftime('%Y-%m-%d')):
     """
     Grabs and writes out a giant list of dicts for the range [date_start, date_end]. If the date_end isn't within the last date, it uses the last date possible.
+    Use iter_aggregate to go through the range one day at a time instead.
 
     Keyword parameters:
     start_date -- str, formatted in the manner YY-mm-dd
     end_date str, formatted in the manner YY-mm-dd
     """
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT json FROM collectobot WHERE date(date) BETWEEN date(?) AND date(?)', (start_date, end_date))
-    date_list = c.fetchall()
     data = []
-    for game_data in date_list:
-        date = json.loads(game_data[0])
-        data.extend(date['games'])
-    conn.close()
+    for games in iter_aggregate(start_date, end_date):
+        data.extend(games)
     return data
-
-
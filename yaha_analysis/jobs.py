@@ -0,0 +1,178 @@
+import os
+import time
+import sqlite3
+import threading
+import traceback
+import multiprocessing
+import yaha_analyzer
+
+JOB_DATABASE = '../test_data/jobs.db'
+JOB_TYPES = {'rebuild': 'rebuild_and_update', 'remake': 'remake_graphs'} #job kind -> yaha_analyzer method it runs
+JOB_COLUMNS = ['id', 'kind', 'status', 'step', 'progress', 'error', 'pid', 'created', 'started', 'finished', 'heartbeat'] #fields returned by get
+HEARTBEAT_INTERVAL = 10 #seconds between the heartbeats of a running job
+HEARTBEAT_TIMEOUT = 60 #seconds without a heartbeat before a running job's worker counts as gone
+
+def submit(kind, start = True):
+    """
+    Queues a job, unless one of the same kind is already queued, in which case that job is returned instead. A job of the same kind that's already running may have read its data before the request, so it doesn't count
+
+    Keyword parameters:
+    kind -- str, a key of JOB_TYPES
+    start -- bool, start a worker process to run the queue
+
+    Returns:
+    job_id -- int, id of the queued job, or of the job it was deduped into
+    """
+    if kind not in JOB_TYPES:
+        raise ValueError('unknown job kind: {}'.format(kind))
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _fail_orphans(conn)
+        row = conn.execute("SELECT id FROM jobs WHERE kind = ? AND status = 'queued' ORDER BY id", (kind,)).fetchone()
+        if row:
+            job_id = row[0]
+        else:
+            job_id = conn.execute("INSERT INTO jobs (kind, status, progress, created) VALUES (?, 'queued', 0, ?)", (kind, time.time())).lastrowid
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    if start:
+        start_worker()
+    return job_id
+
+def get(job_id):
+    """
+    Looks up a job's status
+
+    Keyword parameters:
+    job_id -- int, id from submit
+
+    Returns:
+    job -- dict of JOB_COLUMNS, status is one of 'queued', 'running', 'done' or 'failed'. None if there's no such job
+    """
+    conn = _connect()
+    try:
+        row = conn.execute('SELECT {} FROM jobs WHERE id = ?'.format(', '.join(JOB_COLUMNS)), (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+def start_worker():
+    """
+    Starts a worker process that runs the queued jobs and exits once the queue is empty, a daemon thread joins it so it's reaped when it exits
+
+    Returns:
+    process -- multiprocessing.Process
+    """
+    process = multiprocessing.get_context('spawn').Process(target = work)
+    process.start()
+    threading.Thread(target = process.join, daemon = True).start()
+    return process
+
+def work():
+    """
+    Runs queued jobs, oldest first, one at a time until there are none left. Only one job runs at once across all workers, since every job rewrites the graphs
+    A daemon thread updates the running job's heartbeat every HEARTBEAT_INTERVAL seconds. A job that was failed as an orphan while it ran keeps its failed status, the worker's updates only go to jobs it's still running
+
+    Returns:
+    jobs -- int, number of jobs run
+    """
+    jobs = 0
+    job = _claim()
+    while job:
+        job_id, kind = job
+        stopped = threading.Event()
+        heart = threading.Thread(target = _beat, args = (job_id, stopped), daemon = True)
+        heart.start()
+        try:
+            getattr(yaha_analyzer.yaha_analyzer(), JOB_TYPES[kind])(progress = lambda step, fraction: _update(job_id, owned = True, step = step, progress = fraction))
+        except Exception:
+            stopped.set()
+            heart.join()
+            _update(job_id, owned = True, status = 'failed', error = traceback.format_exc(), finished = time.time())
+        else:
+            stopped.set()
+            heart.join()
+            _update(job_id, owned = True, status = 'done', step = None, progress = 1.0, finished = time.time())
+        jobs += 1
+        job = _claim()
+    return jobs
+
+def _connect():
+    """
+    Connects to JOB_DATABASE in autocommit mode, creating the jobs table if it's missing
+
+    Returns:
+    conn -- sqlite3 connection, transactions are started explicitly
+    """
+    conn = sqlite3.connect(JOB_DATABASE, timeout = 30, isolation_level = None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, status TEXT, step TEXT, progress REAL, error TEXT, pid INTEGER, created REAL, started REAL, finished REAL, heartbeat REAL)')
+    if 'heartbeat' not in [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]: #tables from before heartbeats
+        conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, kind)')
+    return conn
+
+def _claim():
+    """
+    Marks the oldest queued job as running in this process, if no other job is running
+
+    Returns:
+    (id, kind) -- the claimed job, None if nothing was claimed
+    """
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        _fail_orphans(conn)
+        job = None
+        if conn.execute("SELECT count(*) FROM jobs WHERE status = 'running'").fetchone()[0] == 0:
+            job = conn.execute("SELECT id, kind FROM jobs WHERE status = 'queued' ORDER BY id").fetchone()
+        if job:
+            now = time.time()
+            conn.execute("UPDATE jobs SET status = 'running', pid = ?, started = ?, heartbeat = ? WHERE id = ?", (os.getpid(), now, now, job[0]))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return job
+
+def _fail_orphans(conn):
+    """
+    Fails running jobs that haven't had a heartbeat in HEARTBEAT_TIMEOUT seconds, so a crashed worker doesn't block the queue
+
+    Keyword parameters:
+    conn -- sqlite3 connection on JOB_DATABASE, inside a transaction
+    """
+    now = time.time()
+    conn.execute("UPDATE jobs SET status = 'failed', error = 'worker stopped responding', finished = ? WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)", (now, now - HEARTBEAT_TIMEOUT))
+
+def _beat(job_id, stopped):
+    """
+    Updates a running job's heartbeat every HEARTBEAT_INTERVAL seconds until stopped is set
+
+    Keyword parameters:
+    job_id -- int, the job
+    stopped -- threading.Event, set once the job has finished
+    """
+    while not stopped.wait(HEARTBEAT_INTERVAL):
+        _update(job_id, owned = True, heartbeat = time.time())
+
+def _update(job_id, owned = False, **fields):
+    """
+    Sets fields of a job
+
+    Keyword parameters:
+    job_id -- int, the job
+    owned -- bool, only set them while the job is running in this process, so a worker doesn't overwrite a job that was failed as an orphan
+    fields -- values of JOB_COLUMNS to set
+    """
+    query = 'UPDATE jobs SET {} WHERE id = ?'.format(', '.join('{} = ?'.format(field) for field in fields))
+    params = list(fields.values()) + [job_id]
+    if owned:
+        query += " AND status = 'running' AND pid = ?"
+        params.append(os.getpid())
+    conn = _connect()
+    try:
+        conn.execute(query, params)
+    finally:
+        conn.close()
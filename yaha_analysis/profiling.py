@@ -0,0 +1,211 @@
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+PROFILE_ENV = 'YAHA_PROFILE' #directory profile reports are written to when no directory is passed, profiling is off if it isn't set
+CPROFILE_ENV = 'YAHA_CPROFILE' #set to 1 to dump cProfile stats for every stage next to the report
+TRACE_MEMORY_ENV = 'YAHA_TRACE_MEMORY' #set to 1 to measure the peak python allocations of every stage with tracemalloc, it slows the run down a lot
+
+logger = logging.getLogger(__name__)
+_active = threading.local()
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process so far
+
+    Returns:
+    rss -- float, megabytes
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10 #bytes on macOS, kilobytes elsewhere
+
+class Stage(object):
+    """
+    Totals of one stage of a profiled run, a stage entered more than once (e.g. once per day) adds up over all of its calls
+    The seconds of a stage include the stages nested in it, its cProfile stats don't
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.peak_rss_mb = 0.0
+        self.rss_growth_mb = 0.0
+        self.peak_traced_mb = None
+        self.cprofile = None
+
+    def add(self, rows = 0, nbytes = 0):
+        """
+        Counts the rows and bytes the stage went through
+
+        Keyword parameters:
+        rows -- int, rows (games, plays, graphs...) handled
+        nbytes -- int, bytes read, built or written
+        """
+        self.rows += rows
+        self.bytes += nbytes
+
+    def as_dict(self):
+        """
+        Returns:
+        stage -- dict of the stage's totals, as it's written to the report
+        """
+        return {'stage': self.path, 'calls': self.calls, 'seconds': self.seconds, 'rows': self.rows, 'bytes': self.bytes,
+                'peak_rss_mb': self.peak_rss_mb, 'rss_growth_mb': self.rss_growth_mb, 'peak_traced_mb': self.peak_traced_mb}
+
+class _NullStage(object):
+    """Stands in for Stage when nothing is being profiled"""
+
+    def add(self, rows = 0, nbytes = 0):
+        pass
+
+_null_stage = contextlib.nullcontext(_NullStage())
+
+class Profiler(object):
+    """
+    Times the named stages of one run and writes them out as a json report, stages are nested into paths like 'rebuild_and_update/update_aggregates/groupby'
+    """
+
+    def __init__(self, name, directory, cprofile = False, trace_memory = False):
+        self.name = name
+        self.directory = directory
+        self.cprofile = cprofile
+        self.trace_memory = trace_memory
+        self.started = time.strftime('%Y%m%dT%H%M%S')
+        self.stages = {}
+        self._path = []
+        self._profilers = []
+        self._peaks = [0]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the code in the with block as the stage name, nested in the stages it's called from
+
+        Keyword parameters:
+        name -- str, name of the stage
+
+        Yields:
+        stage -- Stage, call stage.add to count the stage's rows and bytes
+        """
+        self._path.append(name)
+        path = '/'.join(self._path)
+        record = self.stages.setdefault(path, Stage(path))
+        if self.cprofile:
+            if self._profilers:
+                self._profilers[-1].disable()
+            if record.cprofile is None:
+                record.cprofile = cProfile.Profile()
+            self._profilers.append(record.cprofile)
+            record.cprofile.enable()
+        if self.trace_memory:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            self._peaks.append(0)
+            tracemalloc.reset_peak()
+        rss = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds += time.perf_counter() - start
+            record.calls += 1
+            record.peak_rss_mb = peak_rss()
+            record.rss_growth_mb += record.peak_rss_mb - rss
+            if self.trace_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                self._peaks[-1] = max(self._peaks[-1], peak)
+                record.peak_traced_mb = max(record.peak_traced_mb or 0, peak/2**20)
+                tracemalloc.reset_peak()
+            if self.cprofile:
+                self._profilers.pop().disable()
+                if self._profilers:
+                    self._profilers[-1].enable()
+            self._path.pop()
+
+    def report(self):
+        """
+        Returns:
+        report -- dict with the name and start of the run and the totals of each stage in the order they were first entered
+        """
+        return {'name': self.name, 'started': self.started, 'peak_rss_mb': peak_rss(), 'stages': [record.as_dict() for record in self.stages.values()]}
+
+    def write(self):
+        """
+        Writes the report to '<directory>/<name>-<started>.json', and the cProfile stats of every stage to '<directory>/<name>-<started>.<stage path with / as .>.prof'
+
+        Returns:
+        path -- str, path of the json report
+        """
+        os.makedirs(self.directory, exist_ok = True)
+        prefix = os.path.join(self.directory, '{}-{}'.format(self.name, self.started))
+        for record in self.stages.values():
+            if record.cprofile is not None:
+                record.cprofile.dump_stats('{}.{}.prof'.format(prefix, record.path.replace('/', '.')))
+        with open('{}.json'.format(prefix), 'w') as outfile:
+            json.dump(self.report(), outfile, indent = 2)
+        return '{}.json'.format(prefix)
+
+@contextlib.contextmanager
+def profile(name, directory = None, cprofile = None, trace_memory = None):
+    """
+    Profiles the with block as a run called name, the stages entered in it on this thread are timed and written out as a report when it ends
+    Inside a run that's already being profiled it's just another stage of that run. Every stage is also logged as a line of json at INFO level
+
+    Keyword parameters:
+    name -- str, name of the run, the outermost stage of the report
+    directory -- str, where the report goes, the PROFILE_ENV environment variable if None. Nothing is profiled if neither is set
+    cprofile -- bool, dump cProfile stats per stage, the CPROFILE_ENV environment variable if None
+    trace_memory -- bool, measure peak python allocations per stage, the TRACE_MEMORY_ENV environment variable if None
+
+    Yields:
+    profiler -- Profiler of the run, None if nothing is profiled
+    """
+    profiler = getattr(_active, 'profiler', None)
+    if profiler is not None:
+        with profiler.stage(name):
+            yield profiler
+        return
+    directory = directory or os.environ.get(PROFILE_ENV)
+    if not directory:
+        yield None
+        return
+    cprofile = os.environ.get(CPROFILE_ENV) == '1' if cprofile is None else cprofile
+    trace_memory = os.environ.get(TRACE_MEMORY_ENV) == '1' if trace_memory is None else trace_memory
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = _active.profiler = Profiler(name, directory, cprofile, trace_memory)
+    try:
+        with profiler.stage(name):
+            yield profiler
+    finally:
+        _active.profiler = None
+        if started_tracing:
+            tracemalloc.stop()
+        path = profiler.write()
+        for record in profiler.stages.values():
+            logger.info(json.dumps(dict(record.as_dict(), run = name, report = path)))
+
+def stage(name):
+    """
+    Times the with block as a stage of the run being profiled on this thread, does nothing if there isn't one
+
+    Keyword parameters:
+    name -- str, name of the stage
+
+    Returns:
+    context -- context manager yielding a Stage (or a stand-in with the same add method), call add on it to count rows and bytes
+    """
+    profiler = getattr(_active, 'profiler', None)
+    if profiler is None:
+        return _null_stage
+    return profiler.stage(name)
@@ -1,6 +1,27 @@
 from unittest2 import TestCase
+import base64
+import datetime
+import gzip
+import io
+import json
+import os
+import pstats
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+import pandas as pd
+import numpy as np
 
 import yaha_analyzer
+import collectobot
+import benchmark
+import profiling
+import jobs
 
 class YahaTests(TestCase):
     def setup(self):
@@ -64,3 +85,984 @@ class YahaTests(TestCase):
         self.assertTrue(len(p_card_list) > 0)
         self.assertTrue(isinstance(p_card_list[0], str))
 
+
+def synthetic_games(count, seed = 0):
+    """The benchmark games with a small pool of decks and cards, so the aggregates are dense enough to compare"""
+    return benchmark.synthetic_games(count, heroes = 3, archetypes = 2, cards = 15, max_turns = 11, card_skew = 0, coin = True, seed = seed)
+
+def legacy_games(children, game_mode):
+    """Builds the games dataframe the way generate_decks did before self.plays, keeping ['card_history']"""
+    games = pd.DataFrame(children)
+    games.loc[games['hero_deck'].isnull(), 'hero_deck'] = 'Other'
+    games.loc[games['opponent_deck'].isnull(), 'opponent_deck'] = 'Other'
+    games['p_deck_type'] = games['hero_deck'].map(str) + '_' + games['hero']
+    games['o_deck_type'] = games['opponent_deck'].map(str) + '_' + games['opponent']
+    games = games[games['card_history'].str.len() != 0]
+    return games[games['mode'] == game_mode]
+
+def legacy_card_stats(games, game_threshold):
+    """The per play dict implementation of generate_card_stats"""
+    cards = []
+    for r in zip(games['card_history'], games['result'], games['p_deck_type'], games['o_deck_type']):
+        for play in r[0]:
+            data = {'win': 1, 'loss': 0} if r[1] == 'win' else {'win': 0, 'loss': 1}
+            data.update({'card': play['card']['name'], 'turn': play['turn']})
+            data.update({'p_deck_type': r[2], 'o_deck_type': r[3]} if play['player'] == 'me' else {'p_deck_type': r[3], 'o_deck_type': r[2]})
+            cards.append(data)
+    cards = pd.DataFrame(cards).groupby(['card', 'p_deck_type', 'o_deck_type', 'turn'])[['win', 'loss']].agg(np.sum)
+    cards = cards[cards['win'] + cards['loss'] > game_threshold].copy()
+    cards['win%'] = cards['win']/(cards['win'] + cards['loss'])
+    cards['total_games'] = cards['win'] + cards['loss']
+    return cards
+
+def legacy_decklist_matchups(games, game_threshold):
+    """The per play dict implementation of generate_decklist_matchups"""
+    cards = []
+    for r in zip(games['card_history'], games['result'], games['p_deck_type'], games['o_deck_type']):
+        for play in r[0]:
+            if play['player'] == 'me':
+                cards.append({'card': play['card']['name'], 'p_deck_type': r[2], 'o_deck_type': r[3], 'win': int(r[1] == 'win'), 'loss': int(r[1] != 'win')})
+    cards = pd.DataFrame(cards).groupby(['card', 'p_deck_type', 'o_deck_type'])[['win', 'loss']].agg(np.sum)
+    cards = cards[(cards['win'] + cards['loss']) > game_threshold].copy()
+    cards['win%'] = cards['win']/(cards['win'] + cards['loss'])
+    cards['total_games'] = cards['win'] + cards['loss']
+    return cards
+
+def legacy_cards(games):
+    """The per play dict implementation of generate_cards"""
+    p_df = []
+    o_df = []
+    for r in zip(games['card_history'], games['result']):
+        for play in r[0]:
+            if play['player'] == 'me':
+                p_df.append({'card': play['card']['name'], 'win': int(r[1] == 'win'), 'loss': int(r[1] != 'win')})
+            else:
+                o_df.append({'card': play['card']['name'], 'win': int(r[1] == 'loss'), 'loss': int(r[1] != 'loss')})
+    return pd.DataFrame(p_df).groupby('card')[['win', 'loss']].agg(np.sum), pd.DataFrame(o_df).groupby('card')[['win', 'loss']].agg(np.sum)
+
+class AggregationTests(TestCase):
+    def setUp(self):
+        self.children = synthetic_games(3000)
+        self.client = yaha_analyzer.yaha_analyzer()
+        self.client.history = {'children': self.children}
+        self.client.generate_decks(dates = False)
+        self.legacy = legacy_games(self.children, 'ranked')
+
+    def assert_frames_equal(self, result, expected):
+        result = result.rename(index = dict(enumerate(self.client.cards['name'])), level = 'card').sort_index() #the aggregates are keyed on card ids
+        pd.testing.assert_frame_equal(result, expected, check_dtype = False, check_index_type = False)
+
+    def test_card_stats_equivalence(self):
+        """
+        Tests that generate_card_stats matches the per play implementation
+        """
+        self.assert_frames_equal(self.client.generate_card_stats(game_threshold = 2), legacy_card_stats(self.legacy, 2))
+
+    def test_decklist_matchups_equivalence(self):
+        """
+        Tests that generate_decklist_matchups matches the per play implementation
+        """
+        self.assert_frames_equal(self.client.generate_decklist_matchups(game_threshold = 2), legacy_decklist_matchups(self.legacy, 2))
+
+    def test_cards_played_matches_card_history(self):
+        """
+        Tests that the ragged card lists of every game match its card history, for all the games and for a subset
+        """
+        cards_played = self.client.cards_played(turns = True, card_ids = True)
+        self.assertIs(self.client.cards_played(), cards_played)
+        history = dict((game['id'], game['card_history']) for game in self.children)
+        for row, game_id in enumerate(self.client.games['id']):
+            for player in ('me', 'opponent'):
+                plays = [play for play in history[game_id] if play['player'] == player]
+                start, end = cards_played.bounds(row, player)
+                self.assertEqual(cards_played.cards(row, player), [play['card']['name'] for play in plays])
+                self.assertEqual(cards_played.turns[start:end].tolist(), [play['turn'] for play in plays])
+                self.assertEqual(cards_played.card_id_categories.take(cards_played.card_ids[start:end]).tolist(), [play['card']['id'] for play in plays])
+        ranked = self.client.games[self.client.games['mode'] == 'ranked']
+        subset = self.client.cards_played(ranked)
+        self.assertEqual(subset.to_lists('opponent'), [cards_played.cards(row, 'opponent') for row in np.flatnonzero((self.client.games['mode'] == 'ranked').values)])
+        self.assertEqual(subset.counts('me').sum() + subset.counts('opponent').sum(), self.client.plays['game'].isin(ranked.index).sum())
+
+    def test_games_with_cards_played(self):
+        """
+        Tests that the old ['p_cards_played'] and ['o_cards_played'] columns are rebuilt from the card history, without adding them to self.games
+        """
+        columns = list(self.client.games.columns)
+        ranked = self.client.games[self.client.games['mode'] == 'ranked']
+        games = self.client.games_with_cards_played(ranked)
+        history = dict((game['id'], game['card_history']) for game in self.children)
+        for column, player in (('p_cards_played', 'me'), ('o_cards_played', 'opponent')):
+            self.assertEqual(games[column].tolist(), [[play['card']['name'] for play in history[game_id] if play['player'] == player] for game_id in ranked['id']])
+        self.assertEqual(list(self.client.games.columns), columns)
+        self.assertEqual(len(self.client.games_with_cards_played()), len(self.client.games))
+
+    def test_cards_equivalence(self):
+        """
+        Tests that generate_cards matches the per play implementation
+        """
+        p_df, o_df = self.client.generate_cards(self.client.games[self.client.games['mode'] == 'ranked'])
+        legacy_p_df, legacy_o_df = legacy_cards(self.legacy)
+        self.assert_frames_equal(p_df, legacy_p_df)
+        self.assert_frames_equal(o_df, legacy_o_df)
+
+GOLDEN_GRAPHS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'graphs.json.gz') #[type, name, json] of every graph make_graph_data builds from graph_games()
+
+def graph_games():
+    """A fixture small enough that make_graph_data builds a handful of graphs, every deck and card clearing the game threshold"""
+    return benchmark.synthetic_games(150, heroes = 2, archetypes = 1, cards = 4, max_turns = 6, card_skew = 0)
+
+class GraphDatabaseTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.graph_database = yaha_analyzer.GRAPH_DATABASE
+        yaha_analyzer.GRAPH_DATABASE = os.path.join(self.directory.name, 'graph.db')
+        self.client = yaha_analyzer.yaha_analyzer()
+
+    def tearDown(self):
+        yaha_analyzer.GRAPH_DATABASE = self.graph_database
+        self.directory.cleanup()
+
+    def make_graphs(self, workers):
+        """Builds the graphs of graph_games() and returns their [type, name, json] rows"""
+        yaha_analyzer.clear_analysis_cache()
+        client = yaha_analyzer.yaha_analyzer()
+        client.history = {'children': graph_games()}
+        client.generate_decks(dates = False)
+        client.make_graph_data(workers = workers, batch_size = 3)
+        conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+        rows = [list(row) for row in conn.execute('SELECT type, name, json FROM graphs ORDER BY type, name')]
+        conn.close()
+        return rows
+
+    def test_graphs_match_golden(self):
+        """
+        Tests that make_graph_data builds byte for byte the graphs stored in GOLDEN_GRAPHS
+        """
+        with gzip.open(GOLDEN_GRAPHS, 'rt') as infile:
+            golden = json.load(infile)
+        rows = self.make_graphs(workers = 1)
+        self.assertEqual([row[:2] for row in rows], [row[:2] for row in golden])
+        for row, golden_row in zip(rows, golden):
+            self.assertEqual(row[2], golden_row[2], '{} {} differs from the golden graph'.format(*row[:2]))
+
+    def test_worker_pool_matches_one_process(self):
+        """
+        Tests that graphs built by a pool of worker processes are the same rows as the ones built in this process
+        """
+        self.assertEqual(self.make_graphs(workers = 2), self.make_graphs(workers = 1))
+
+    def test_update_graph_data_upserts(self):
+        """
+        Tests that new graphs are inserted and existing (name, type) rows are updated in place
+        """
+        self.client._update_graph_data([(0, 'Aggro_Druid', '[1]', 'deck'), (1, 'Card 1', '[2]', 'card')])
+        self.client._update_graph_data([(5, 'Aggro_Druid', '[3]', 'deck'), (6, 'Aggro_Druid', '[4]', 'card')])
+        conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+        rows = conn.execute('SELECT id, name, json, type FROM graphs ORDER BY id').fetchall()
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        conn.close()
+        self.assertEqual(rows, [(0, 'Aggro_Druid', '[3]', 'deck'), (1, 'Card 1', '[2]', 'card'), (6, 'Aggro_Druid', '[4]', 'card')])
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_graph_cache_follows_version(self):
+        """
+        Tests that cached graphs and names are served until a write to the graphs table bumps the version
+        """
+        self.client._update_graph_data([(0, 'Aggro_Druid', '[1]', 'deck'), (1, 'Card 1', '[2]', 'card')])
+        self.assertEqual(self.client.get_graph_data('Aggro_Druid', 'deck'), '[1]')
+        self.assertEqual(self.client.get_name_list(), (['Aggro Druid'], ['Card 1']))
+        conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+        with conn:
+            conn.execute("UPDATE graphs SET json = '[5]' WHERE name = 'Aggro_Druid'")
+        conn.close()
+        self.assertEqual(self.client.get_graph_data('Aggro_Druid', 'deck'), '[1]')
+        self.client._update_graph_data([(0, 'Aggro_Druid', '[3]', 'deck'), (2, 'Card 2', '[4]', 'card')])
+        self.assertEqual(self.client.get_graph_data('Aggro_Druid', 'deck'), '[3]')
+        self.assertEqual(self.client.get_name_list(), (['Aggro Druid'], ['Card 1', 'Card 2']))
+
+    def test_graph_file_is_precompressed(self):
+        """
+        Tests that graphs are stored gzipped with an etag, and that tables from before the compressed columns are migrated
+        """
+        conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+        conn.execute('CREATE TABLE graphs (id INTEGER, name TEXT, json TEXT, type TEXT)')
+        conn.execute("INSERT INTO graphs VALUES (0, 'Card 1', '[1]', 'card')")
+        conn.commit()
+        conn.close()
+        graph, gzip_graph, br_graph, etag = self.client.get_graph_file('Card 1', 'card')
+        self.assertEqual(graph, '[1]')
+        self.assertEqual(gzip.decompress(gzip_graph), b'[1]')
+        self.client._update_graph_data([(1, 'Card 2', '[2]', 'card')])
+        graph, gzip_graph, br_graph, etag_2 = self.client.get_graph_file('Card 2', 'card')
+        self.assertEqual(gzip.decompress(gzip_graph), b'[2]')
+        self.assertNotEqual(etag, etag_2)
+
+    def test_staged_graphs_swap_in_at_once(self):
+        """
+        Tests that graphs written to the staging table aren't served until the swap, which replaces the whole set
+        """
+        self.client._update_graph_data([(0, 'Aggro_Druid', '[1]', 'deck'), (1, 'Card 1', '[2]', 'card')])
+        self.client._create_graph_staging()
+        self.client._update_graph_data([(0, 'Aggro_Druid', '[3]', 'deck')], table = 'graphs_staging')
+        self.assertEqual(self.client.get_graph_data('Aggro_Druid', 'deck'), '[1]')
+        self.client._swap_graph_table()
+        self.assertEqual(self.client.get_graph_data('Aggro_Druid', 'deck'), '[3]')
+        self.assertEqual(self.client.get_name_list(), (['Aggro Druid'], []))
+        conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+        self.assertEqual(conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'graphs%' ORDER BY name").fetchall(), [('graphs',), ('graphs_name_type',)])
+        conn.close()
+
+class HeatmapTests(TestCase):
+    def test_compact_heatmap_matches(self):
+        """
+        Tests that a compact heatmap carries the same z, hover text and annotations as the default one, and that a texttemplate heatmap moves the labels and their colors onto the trace
+        """
+        df = pd.DataFrame({'p_deck_type': ['Aggro_Druid', 'Aggro_Druid', 'Face_Hunter'], 'o_deck_type': ['Face_Hunter', 'Aggro_Druid', 'Aggro_Druid'], 'win%': [0.25, 0.5, 0.75], 'total_games': [4, 2, 8]})
+        client = yaha_analyzer.yaha_analyzer()
+        full = client.create_heatmap(x = 'o_deck_type', y = 'p_deck_type', z = 'win%', df = df, title = 'test', text = 'total_games')
+        compact = client.create_heatmap(x = 'o_deck_type', y = 'p_deck_type', z = 'win%', df = df, title = 'test', text = 'total_games', compact = True)
+        self.assertEqual(full['data'][0]['x'], ['Aggro Druid', 'Face Hunter'])
+        self.assertEqual(full['data'][0]['text'], [['Total Games: 2.0', 'Total Games: 4.0'], ['Total Games: 8.0', 'Total Games: nan']])
+        self.assertEqual(compact['data'][0]['text'], full['data'][0]['text'])
+        self.assertEqual([a['text'] for a in full['layout']['annotations']], ['50.00%', '25.00%', '75.00%', ''])
+        self.assertEqual(compact['layout']['annotations'], full['layout']['annotations'])
+        templated = client.create_heatmap(x = 'o_deck_type', y = 'p_deck_type', z = 'win%', df = df, title = 'test', text = 'total_games', compact = True, texttemplate = True)
+        self.assertEqual(templated['layout']['annotations'], [])
+        self.assertEqual(templated['data'][0]['textfont']['color'], [['black', 'black'], ['white', 'black']])
+        self.assertEqual([a['font']['color'] for a in full['layout']['annotations']], ['black', 'black', 'white', 'black'])
+        z = compact['data'][0]['z']
+        z_vals = np.frombuffer(base64.b64decode(z['bdata']), '<f4').reshape(2, 2)
+        np.testing.assert_allclose(z_vals, np.array(full['data'][0]['z'], dtype = float))
+
+class DayFileHandler(BaseHTTPRequestHandler):
+    """Serves the fixture zips in server.days, failing a day's request while server.failures has attempts left for it"""
+    def do_GET(self):
+        day = self.path.strip('/').replace('.zip', '')
+        if self.server.failures.get(day, 0):
+            self.server.failures[day] -= 1
+            self.send_response(500)
+            self.end_headers()
+            return
+        if day not in self.server.days:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.days[day])))
+        self.end_headers()
+        self.wfile.write(self.server.days[day])
+
+    def log_message(self, *args):
+        pass
+
+class PullDataTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (collectobot.URL, collectobot.DATABASE, collectobot.DOWNLOAD_BACKOFF)
+        self.server = HTTPServer(('127.0.0.1', 0), DayFileHandler)
+        self.server.days = {}
+        self.server.failures = {}
+        for n, day in enumerate(['2016-07-01', '2016-07-02', '2016-07-04']):
+            data = io.BytesIO()
+            with zipfile.ZipFile(data, 'w') as zip_ref:
+                zip_ref.writestr('{}.json'.format(day), json.dumps({'games': [{'id': n}]}))
+            self.server.days[day] = data.getvalue()
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        collectobot.URL = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        collectobot.DATABASE = os.path.join(self.directory.name, 'collectobot.db')
+        collectobot.DOWNLOAD_BACKOFF = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        collectobot.URL, collectobot.DATABASE, collectobot.DOWNLOAD_BACKOFF = self.settings
+        self.directory.cleanup()
+
+    def stored_days(self):
+        conn = sqlite3.connect(collectobot.DATABASE)
+        days = conn.execute('SELECT collectobot.id, date, games.id FROM collectobot JOIN games ON games.day = collectobot.id ORDER BY collectobot.id').fetchall()
+        conn.close()
+        return days
+
+    def test_pull_data_retries_and_skips_missing_days(self):
+        """
+        Tests that a day that fails once is retried and days without a file are skipped
+        """
+        self.server.failures['2016-07-02'] = 1
+        collectobot.pull_data(end_date = '2016-07-04')
+        self.assertEqual(self.stored_days(), [(2, '2016-07-01', 0), (3, '2016-07-02', 1), (4, '2016-07-04', 2)])
+
+    def test_pull_data_resumes(self):
+        """
+        Tests that days committed before a failure are kept and the next pull only fetches what's left
+        """
+        self.server.failures['2016-07-02'] = collectobot.DOWNLOAD_RETRIES
+        with self.assertRaises(requests.HTTPError):
+            collectobot.pull_data(end_date = '2016-07-04')
+        self.assertEqual(self.stored_days(), [(2, '2016-07-01', 0)])
+        collectobot.pull_data(end_date = '2016-07-04')
+        self.assertEqual(self.stored_days(), [(2, '2016-07-01', 0), (3, '2016-07-02', 1), (4, '2016-07-04', 2)])
+
+    def test_pull_data_bounds_downloads_in_flight(self):
+        """
+        Tests that a day's download only starts once the days more than a window ahead of it are written
+        """
+        written = []
+        def download_day(date, sessions):
+            conn = sqlite3.connect(collectobot.DATABASE, timeout = 30)
+            written.append(conn.execute('SELECT count(*) FROM collectobot').fetchone()[0] - (date - datetime.date(2016, 7, 1)).days)
+            conn.close()
+            return json.dumps({'games': [{'id': date.day}]})
+        self.addCleanup(setattr, collectobot, '_download_day', collectobot._download_day)
+        collectobot._download_day = download_day
+        workers = 2
+        collectobot.pull_data(end_date = '2016-07-20', workers = workers)
+        self.assertEqual(len(self.stored_days()), 20)
+        self.assertEqual(len(written), 20)
+        self.assertGreaterEqual(min(written), -workers*collectobot.DOWNLOAD_WINDOW - 1)
+
+class HistoryHandler(BaseHTTPRequestHandler):
+    """Serves server.history newest first in pages of server.per_page like the track-o-bot history api, recording the pages asked for in server.pages"""
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        page = int(query.get('page', ['1'])[0])
+        self.server.pages.append(page)
+        per_page = self.server.per_page
+        total_pages = -(-len(self.server.history)//per_page)
+        body = json.dumps({'meta': {'current_page': page, 'total_pages': total_pages, 'total_items': len(self.server.history)},
+                           'history': self.server.history[(page - 1)*per_page:page*per_page]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TrackobotSyncTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (yaha_analyzer.TRACKOBOT_URL, yaha_analyzer.DATA_PATH, yaha_analyzer.USER_CACHE_SIZE)
+        yaha_analyzer.clear_user_cache()
+        yaha_analyzer.clear_analysis_cache()
+        self.server = HTTPServer(('127.0.0.1', 0), HistoryHandler)
+        self.server.per_page = 25
+        self.server.pages = []
+        self.games = synthetic_games(100)
+        for game in self.games:
+            game.update({'rank': game['id'] % 25 or None, 'legend': None, 'note': 'note {}'.format(game['id']) if game['id'] % 3 else None})
+        self.server.history = self.games[:60][::-1]
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        yaha_analyzer.TRACKOBOT_URL = 'http://127.0.0.1:{}/profile/history.json'.format(self.server.server_port)
+        yaha_analyzer.DATA_PATH = self.directory.name + '/'
+        conn = sqlite3.connect(os.path.join(self.directory.name, 'users.db'))
+        conn.execute('CREATE TABLE users (user_hash TEXT, total_items INTEGER, json_name TEXT, hdf5_name TEXT)')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        yaha_analyzer.TRACKOBOT_URL, yaha_analyzer.DATA_PATH, yaha_analyzer.USER_CACHE_SIZE = self.settings
+        yaha_analyzer.clear_user_cache()
+        self.directory.cleanup()
+
+    def test_incremental_sync(self):
+        """
+        Tests that the first pull fetches every page, and that later pulls only fetch the pages with new games and append them
+        """
+        client = yaha_analyzer.yaha_analyzer()
+        results = client.pull_data('user', 'token')
+        self.assertEqual(sorted(self.server.pages), [1, 2, 3])
+        self.assertEqual(results['children'], self.server.history)
+        for new_games in (self.games[60:63], self.games[63:100]):
+            for game in new_games:
+                game['note'] = None
+            self.server.history = new_games[::-1] + self.server.history
+            self.server.pages = []
+            client = yaha_analyzer.yaha_analyzer()
+            results = client.pull_data('user', 'token')
+            self.assertEqual(results['children'], self.server.history)
+            expected = yaha_analyzer.yaha_analyzer()
+            expected.history = {'children': self.server.history}
+            expected.generate_decks()
+            self.assertEqual(sorted(client.games['id']), sorted(expected.games['id']))
+            self.assertEqual(len(client.plays), len(expected.plays))
+        self.assertEqual(sorted(self.server.pages), [1, 2])
+        self.server.pages = []
+        yaha_analyzer.yaha_analyzer().pull_data('user', 'token')
+        self.assertEqual(self.server.pages, [1])
+        self.server.history = self.games[:1] + self.server.history[:-1]
+        self.server.pages = []
+        results = yaha_analyzer.yaha_analyzer().pull_data('user', 'token')
+        self.assertEqual(results['children'], self.server.history)
+        self.assertEqual(sorted(self.server.pages), [1, 2, 3, 4])
+
+    def test_sync_short_games_onto_stored_games(self):
+        """
+        Tests that an incremental sync whose new games are all short, with a missing coin, appends onto the hdf5 file written from longer games
+        """
+        yaha_analyzer.yaha_analyzer().pull_data('user', 'token')
+        for n, game in enumerate(self.games[60:70]):
+            game.update(duration = 30 + n, coin = None if n == 0 else game['coin'])
+        self.server.history = self.games[60:70][::-1] + self.server.history
+        client = yaha_analyzer.yaha_analyzer()
+        results = client.pull_data('user', 'token')
+        self.assertEqual(results['children'], self.server.history)
+        expected = yaha_analyzer.yaha_analyzer()
+        expected.history = {'children': self.server.history}
+        expected.generate_decks()
+        self.assertEqual(sorted(client.games['id']), sorted(expected.games['id']))
+        self.assertEqual(sorted(client.games['duration']), sorted(expected.games['duration']))
+        self.assertEqual(client.games['coin'].isnull().sum(), expected.games['coin'].isnull().sum())
+
+    def test_user_cache(self):
+        """
+        Tests that up to date users and their matchups are served from memory until their files change, and that the least recently used user is evicted
+        """
+        yaha_analyzer.yaha_analyzer().pull_data('user', 'token')
+        client = yaha_analyzer.yaha_analyzer()
+        client.read_data = lambda *args, **kwargs: self.fail('read from disk')
+        self.assertEqual(client.pull_data('user', 'token')['children'], self.server.history)
+        matchups = client.generate_matchups()
+        other = yaha_analyzer.yaha_analyzer()
+        other.read_data = client.read_data
+        other.pull_data('user', 'token')
+        other._make_matchups = lambda *args: self.fail('recomputed')
+        pd.testing.assert_frame_equal(other.generate_matchups(), matchups)
+        self.assertIs(other.games, client.games)
+        reads = []
+        stale = yaha_analyzer.yaha_analyzer()
+        stale.read_data = lambda *args, **kwargs: reads.append(args) or yaha_analyzer.yaha_analyzer.read_data(stale, *args, **kwargs)
+        stale.username, stale.api_key = 'user', 'token'
+        hdf5_name = os.path.join(self.directory.name, stale.store_data()['hdf5_name'])
+        os.utime(hdf5_name, ns = (os.stat(hdf5_name).st_atime_ns, os.stat(hdf5_name).st_mtime_ns + 10**9))
+        stale.pull_data('user', 'token')
+        self.assertEqual(len(reads), 1)
+        pd.testing.assert_frame_equal(stale.generate_matchups(), matchups)
+        yaha_analyzer.USER_CACHE_SIZE = 1
+        yaha_analyzer.yaha_analyzer().pull_data('other', 'token')
+        self.assertEqual(len(yaha_analyzer._user_cache['users']), 1)
+
+    def test_users_are_updated_by_hash(self):
+        """
+        Tests that users from the old table are migrated, and that updating one user's count leaves the others alone
+        """
+        conn = sqlite3.connect(os.path.join(self.directory.name, 'users.db'))
+        conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?)', [('old', 5, 'old_j.json', 'old_h.hdf5'), ('old', 7, 'old_j.json', 'old_h.hdf5')])
+        conn.commit()
+        conn.close()
+        client = yaha_analyzer.yaha_analyzer()
+        client.username, client.api_key = 'user', 'token'
+        user = client.store_data()
+        self.assertEqual((user['total_items'], user['last_game_id']), (0, None))
+        client.update_count(user['user_hash'], 60, last_game_id = 59, row_count = 58, content_hash = 'abc')
+        conn = sqlite3.connect(os.path.join(self.directory.name, 'users.db'))
+        rows = conn.execute('SELECT user_hash, total_items, last_game_id, row_count, content_hash FROM users ORDER BY total_items').fetchall()
+        conn.close()
+        self.assertEqual(rows, [('old', 7, None, None, None), (user['user_hash'], 60, 59, 58, 'abc')])
+
+class CollectobotStorageTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (collectobot.DATABASE, yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.AGGREGATE_DATABASE)
+        collectobot.DATABASE = os.path.join(self.directory.name, 'collectobot.db')
+        yaha_analyzer.DATA_PATH = self.directory.name
+        yaha_analyzer.HDF_NAME = '/cbot.hdf5'
+        yaha_analyzer.AGGREGATE_DATABASE = os.path.join(self.directory.name, 'aggregates.db')
+        self.children = synthetic_games(600)
+        conn = sqlite3.connect(collectobot.DATABASE)
+        conn.execute('CREATE TABLE collectobot (id INTEGER, date TEXT, json TEXT)')
+        conn.executemany('INSERT INTO collectobot VALUES (?, ?, ?)', [(1, '2016-07-01', json.dumps({'games': self.children[:300]})), (2, '2016-07-02', json.dumps({'games': self.children[300:]}))])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        collectobot.DATABASE, yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.AGGREGATE_DATABASE = self.settings
+        self.directory.cleanup()
+
+    def test_normalized_days_match_json(self):
+        """
+        Tests that generate_collectobot_data normalizes a database with only json days, building the same games and plays as the json did, and that iter_frames won't read days left as json
+        """
+        with self.assertRaisesRegex(RuntimeError, 'normalize'):
+            list(collectobot.iter_frames())
+        collectobot._connect().close()
+        with self.assertRaisesRegex(RuntimeError, 'normalize'):
+            list(collectobot.iter_frames())
+        client = yaha_analyzer.yaha_analyzer()
+        client.generate_collectobot_data()
+        expected = yaha_analyzer.yaha_analyzer()
+        expected.history = {'children': self.children}
+        expected.generate_decks(dates = False)
+        pd.testing.assert_frame_equal(client.plays, expected.plays)
+        pd.testing.assert_frame_equal(client.games[expected.games.columns], expected.games)
+        conn = sqlite3.connect(collectobot.DATABASE)
+        self.assertEqual(conn.execute('SELECT count(json) FROM collectobot').fetchone()[0], 0)
+        conn.close()
+        self.assertEqual(collectobot.aggregate('2016-07-02', '2016-07-02')[0]['card_history'], self.children[300]['card_history'])
+
+    def test_generate_without_keeping_days(self):
+        """
+        Tests that generate_collectobot_data without keep writes every day to the data file and holds on to none of them
+        """
+        client = yaha_analyzer.yaha_analyzer()
+        self.assertIsNone(client.generate_collectobot_data(keep = False))
+        self.assertIsNone(client.games)
+        self.assertIsNone(client.plays)
+        self.assertEqual(client.history['meta']['total_items'], 600)
+        reader = yaha_analyzer.yaha_analyzer()
+        reader.open_collectobot_data()
+        self.assertEqual(len(reader.plays), sum(len(game['card_history']) for game in self.children))
+
+    def test_aggregate_normalizes_json_days(self):
+        """
+        Tests that aggregate reads a database with only json days
+        """
+        games = collectobot.aggregate('2016-07-01', '2016-07-02')
+        self.assertEqual([game['card_history'] for game in games], [game['card_history'] for game in self.children])
+
+    def test_iter_frames_reads_only_what_is_asked(self):
+        """
+        Tests that iter_frames filters days and modes in the query and only reads the asked for columns
+        """
+        collectobot.normalize()
+        days = list(collectobot.iter_frames(start_date = '2016-07-02', modes = ['ranked'], columns = ['result']))
+        self.assertEqual([day_id for day_id, frames in days], [2])
+        games, plays = days[0][1]
+        self.assertEqual(list(games.columns), ['hero', 'hero_deck', 'opponent', 'opponent_deck', 'result'])
+        ranked = [game for game in self.children[300:] if game['mode'] == 'ranked']
+        self.assertEqual(len(games), len(ranked))
+        self.assertEqual(len(plays), sum(len(game['card_history']) for game in ranked))
+
+    def test_card_dictionary(self):
+        """
+        Tests that cards are interned into the cards tables, that old tables keyed on names are moved over, and that the aggregates keyed on card ids match the in memory ones by name
+        """
+        conn = sqlite3.connect(collectobot.DATABASE)
+        conn.execute('CREATE TABLE plays (game INTEGER, player TEXT, turn INTEGER, card TEXT, card_id TEXT, mana INTEGER)')
+        conn.execute("INSERT INTO plays VALUES (5000, 'me', 1, 'Old Card', 'OLD_1', 3)")
+        conn.commit()
+        conn.close()
+        collectobot.normalize()
+        expected = yaha_analyzer.yaha_analyzer()
+        expected.history = {'children': self.children}
+        expected.generate_decks(dates = False)
+        self.assertEqual(expected.plays['card'].dtype, np.int16)
+        self.assertEqual(sorted(expected.cards['name']), sorted(set(play['card']['name'] for game in self.children for play in game['card_history'])))
+        self.assertEqual(expected.cards.set_index('name').loc['The Coin', 'card_id'], 'GAME_005')
+        self.assertEqual(expected.card_names(expected.plays['card'][:20]).tolist(), [play['card']['name'] for game in self.children for play in game['card_history']][:20])
+        named = lambda client, frame: frame.rename(index = dict(enumerate(client.cards['name'])), level = 'card').sort_index()
+        client = yaha_analyzer.yaha_analyzer()
+        client.update_aggregates()
+        self.assertTrue(pd.api.types.is_integer_dtype(client.aggregates['plays']['card']))
+        pd.testing.assert_frame_equal(named(client, client.generate_card_stats()), named(expected, expected.generate_card_stats()), check_dtype = False)
+        conn = sqlite3.connect(collectobot.DATABASE)
+        self.assertEqual(conn.execute('SELECT card, name, card_id, mana FROM cards WHERE card = 1').fetchone(), (1, 'Old Card', 'OLD_1', 3))
+        self.assertEqual(conn.execute('SELECT card FROM plays WHERE game = 5000').fetchone(), (1,))
+        conn.close()
+        conn = sqlite3.connect(yaha_analyzer.AGGREGATE_DATABASE)
+        self.assertEqual([name for (name,) in conn.execute('SELECT name FROM cards ORDER BY card')], client.cards['name'].tolist())
+        conn.execute('CREATE TABLE play_counts_names AS SELECT mode, player, name AS card, p_deck_type, o_deck_type, turn, win, loss FROM play_counts JOIN cards USING (card)')
+        conn.execute('DROP TABLE play_counts')
+        conn.execute('DROP TABLE cards')
+        conn.execute('CREATE TABLE play_counts (mode TEXT, player TEXT, card TEXT, p_deck_type TEXT, o_deck_type TEXT, turn INTEGER, win INTEGER, loss INTEGER, PRIMARY KEY (mode, player, card, p_deck_type, o_deck_type, turn))')
+        conn.execute('INSERT INTO play_counts SELECT * FROM play_counts_names')
+        conn.execute('DROP TABLE play_counts_names')
+        conn.commit()
+        conn.close()
+        migrated = yaha_analyzer.yaha_analyzer()
+        self.assertEqual(migrated.update_aggregates(), 0)
+        pd.testing.assert_frame_equal(named(migrated, migrated.generate_card_stats()), named(expected, expected.generate_card_stats()), check_dtype = False)
+
+    def test_interrupted_update_resumes(self):
+        """
+        Tests that an update stopped after a day's games were stored but before its counts were committed stores that day once when it's picked up again
+        """
+        self.addCleanup(setattr, yaha_analyzer, 'STORAGE_BACKEND', yaha_analyzer.STORAGE_BACKEND)
+        self.addCleanup(setattr, yaha_analyzer, 'PARQUET_NAME', yaha_analyzer.PARQUET_NAME)
+        yaha_analyzer.PARQUET_NAME = '/cbot.parquet'
+        collectobot.normalize()
+        backends = ['hdf5'] if yaha_analyzer.pa is None else ['hdf5', 'parquet']
+        for backend in backends:
+            yaha_analyzer.STORAGE_BACKEND = backend
+            client = yaha_analyzer.yaha_analyzer()
+            merge_counts = client._merge_counts
+            def interrupted(c, play_counts, matchup_counts):
+                if c.execute("SELECT count(*) FROM meta WHERE key = 'high_water_mark'").fetchone()[0]:
+                    raise KeyboardInterrupt
+                merge_counts(c, play_counts, matchup_counts)
+            client._merge_counts = interrupted
+            with self.assertRaises(KeyboardInterrupt):
+                client.update_aggregates(rebuild = True)
+            self.assertEqual(yaha_analyzer.yaha_analyzer().update_aggregates(), 1)
+            reader = yaha_analyzer.yaha_analyzer()
+            reader.open_collectobot_data()
+            self.assertTrue(reader.games['id'].is_unique)
+            self.assertEqual(len(reader.plays), sum(len(game['card_history']) for game in self.children))
+
+class StorageBackendTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.PARQUET_NAME, yaha_analyzer.STORAGE_BACKEND)
+        yaha_analyzer.DATA_PATH = self.directory.name
+        yaha_analyzer.HDF_NAME = '/cbot.hdf5'
+        yaha_analyzer.PARQUET_NAME = '/cbot.parquet'
+        self.client = yaha_analyzer.yaha_analyzer()
+        self.client.history = {'children': synthetic_games(600)}
+        self.client.generate_decks(dates = False)
+
+    def tearDown(self):
+        yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.PARQUET_NAME, yaha_analyzer.STORAGE_BACKEND = self.settings
+        self.directory.cleanup()
+
+    def read(self, backend, **filters):
+        yaha_analyzer.STORAGE_BACKEND = backend
+        with self.client._open_store('w') as store:
+            for chunk in (self.client.games.index < 300, self.client.games.index >= 300):
+                games = self.client.games[chunk]
+                self.client._append_data(store, games, self.client.plays[self.client.plays['game'].isin(games.index)])
+        reader = yaha_analyzer.yaha_analyzer()
+        reader.open_collectobot_data(**filters)
+        return reader
+
+    def test_filtered_reads_match(self):
+        """
+        Tests that both backends load the same games and plays for a projected, filtered read
+        """
+        filters = dict(columns = ['mode', 'result', 'p_deck_type', 'o_deck_type'], modes = ['ranked'], start_date = '2016-07-10', end_date = '2016-07-20')
+        hdf5 = self.read('hdf5', **filters)
+        games = self.client.games
+        games = games[(games['mode'] == 'ranked') & (games['added'] >= '2016-07-10') & (games['added'] < '2016-07-21')]
+        self.assertEqual(list(hdf5.games.index), list(games.index))
+        self.assertEqual(list(hdf5.games.columns), ['mode', 'result', 'p_deck_type', 'o_deck_type', 'win'])
+        if yaha_analyzer.pa is None:
+            self.skipTest('pyarrow is not installed')
+        parquet = self.read('parquet', **filters)
+        pd.testing.assert_frame_equal(parquet.games, hdf5.games)
+        pd.testing.assert_frame_equal(parquet.plays, hdf5.plays)
+        pd.testing.assert_frame_equal(parquet.generate_card_stats(game_threshold = 0), hdf5.generate_card_stats(game_threshold = 0))
+
+    def test_chunks_with_different_values_append(self):
+        """
+        Tests that chunks compacted one at a time share a schema, so a chunk of short games with a missing coin can be appended after one of long games
+        """
+        children = synthetic_games(200)
+        for n, game in enumerate(children[100:]):
+            game.update(duration = n % 100, coin = None if n == 0 else game['coin'])
+        backends = ['hdf5'] if yaha_analyzer.pa is None else ['hdf5', 'parquet']
+        for backend in backends:
+            yaha_analyzer.STORAGE_BACKEND = backend
+            with self.client._open_store('w') as store:
+                for games, plays in self.client._iter_decks([children[:100], children[100:]], dates = False):
+                    self.client._append_data(store, games, plays)
+            reader = yaha_analyzer.yaha_analyzer()
+            reader.open_collectobot_data()
+            self.assertEqual(reader.games['duration'].tolist(), [children[game_id]['duration'] for game_id in reader.games['id']])
+            self.assertEqual(reader.games['coin'].isnull().sum(), 1)
+            self.assertEqual(len(reader.plays), sum(len(game['card_history']) for game in children))
+
+class CompactDtypeTests(TestCase):
+    def test_compact_games(self):
+        """
+        Tests that generate_decks builds the compact schema and reports a smaller footprint
+        """
+        children = synthetic_games(600)
+        for n, game in enumerate(children):
+            game.update(rank = n % 26 or None, legend = None, region = 'eu', user_hash = 'user {}'.format(n % 7))
+        client = yaha_analyzer.yaha_analyzer()
+        client.history = {'children': children}
+        client.generate_decks(dates = True, chunks = [children[:300], children[300:]])
+        games = client.games
+        for column in ('hero', 'p_deck_type', 'o_deck_type', 'mode', 'result', 'region', 'user_hash'):
+            self.assertEqual(games[column].dtype, 'category')
+        self.assertEqual(str(games['rank'].dtype), 'Int8')
+        self.assertEqual(games['win'].dtype, bool)
+        self.assertEqual(str(games['coin'].dtype), 'boolean')
+        self.assertEqual(str(games['duration'].dtype), 'Int32')
+        self.assertEqual(list(games['win']), list(games['result'] == 'win'))
+        self.assertEqual(games['date'].dtype, 'datetime64[ns]')
+        self.assertNotIn('year', games.columns)
+        self.assertLess(client.footprint['after'].sum(), client.footprint['before'].sum())
+        self.assertEqual(client.memory_footprint()['games'].sum(), games.memory_usage(deep = True).sum())
+
+class DateTests(TestCase):
+    def setUp(self):
+        self.client = yaha_analyzer.yaha_analyzer()
+
+    def test_parse_dates_tolerates_formats(self):
+        """
+        Tests that timestamps with and without fractional seconds parse, and that garbage becomes NaT
+        """
+        dates = self.client._parse_dates(pd.Series(['2016-06-28T17:57:45.250Z', '2016-06-28T17:57:45Z', '2016-06-28 17:57', None, 'never']))
+        self.assertEqual(list(dates[:3]), [pd.Timestamp('2016-06-28 17:57:45.250'), pd.Timestamp('2016-06-28 17:57:45'), pd.Timestamp('2016-06-28 17:57')])
+        self.assertTrue(dates[3:].isnull().all())
+
+    def test_win_rates_by_day(self):
+        """
+        Tests that daily win rates match counting the games of each day, without adding date columns to self.games
+        """
+        self.client.history = {'children': synthetic_games(600)}
+        self.client.generate_decks(dates = False)
+        rates = self.client.generate_win_rates(freq = 'D', game_mode = 'both')
+        games = self.client.games
+        day = games['added'].str[:10]
+        expected = games.assign(day = day).groupby([games['p_deck_type'].astype(object), 'day'])['win'].agg(['sum', 'count'])
+        self.assertEqual(rates['win'].tolist(), expected['sum'].tolist())
+        self.assertEqual(rates['total_games'].tolist(), expected['count'].tolist())
+        self.assertEqual(str(rates.index.get_level_values('period')[0]), expected.index[0][1])
+        self.assertNotIn('date', self.client.games.columns)
+
+class MatchupTests(TestCase):
+    def setUp(self):
+        yaha_analyzer.clear_analysis_cache()
+        self.client = yaha_analyzer.yaha_analyzer()
+        self.client.history = {'children': synthetic_games(600)}
+        self.client.generate_decks(dates = False)
+
+    def test_matchups_leave_games_alone(self):
+        """
+        Tests that generate_matchups doesn't add columns to self.games and only adds card_history when asked
+        """
+        columns = list(self.client.games.columns)
+        matchups = self.client.generate_matchups(game_mode = 'both')
+        self.assertEqual(list(self.client.games.columns), columns)
+        self.assertNotIn('card_history', matchups.columns.get_level_values(0))
+        with_history = self.client.generate_matchups(game_mode = 'both', card_history = True)
+        self.assertEqual(with_history['count']['sum'].tolist(), [len(history) for history in with_history['card_history']['<lambda>']])
+        self.assertEqual(matchups['count']['sum'].sum(), len(self.client.games))
+        self.assertEqual(matchups['win']['sum'].sum(), (self.client.games['result'] == 'win').sum())
+
+    def test_matchups_cache_follows_data(self):
+        """
+        Tests that cached matchups are reused until self.games is replaced
+        """
+        calls = []
+        make_matchups = self.client._make_matchups
+        self.client._make_matchups = lambda *args: calls.append(args) or make_matchups(*args)
+        first = self.client.generate_matchups()
+        first['win%'] = 0
+        self.assertNotEqual(self.client.generate_matchups()['win%'].sum(), 0)
+        self.assertEqual(len(calls), 1)
+        self.client.games = self.client.games[self.client.games['p_deck_type'] != 'Deck0_Hero0']
+        self.assertNotIn('Deck0_Hero0', self.client.generate_matchups().index.get_level_values(0))
+        self.assertEqual(len(calls), 2)
+
+class AnalysisCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (yaha_analyzer.ANALYSIS_CACHE_DIR, yaha_analyzer.ANALYSIS_CACHE_SIZE)
+        yaha_analyzer.ANALYSIS_CACHE_DIR = self.directory.name
+        yaha_analyzer.clear_analysis_cache()
+        self.client = yaha_analyzer.yaha_analyzer()
+        self.client.history = {'children': synthetic_games(600)}
+        self.client.generate_decks(dates = False)
+
+    def tearDown(self):
+        yaha_analyzer.ANALYSIS_CACHE_DIR, yaha_analyzer.ANALYSIS_CACHE_SIZE = self.settings
+        yaha_analyzer.clear_analysis_cache()
+        self.directory.cleanup()
+
+    def test_results_follow_fingerprint(self):
+        """
+        Tests that analyzers reading the same stored data share cached results, that appending to it gives a new fingerprint, and that data built in memory isn't shared
+        """
+        data = tempfile.TemporaryDirectory()
+        self.addCleanup(data.cleanup)
+        self.addCleanup(setattr, yaha_analyzer, 'DATA_PATH', yaha_analyzer.DATA_PATH)
+        self.addCleanup(setattr, yaha_analyzer, 'HDF_NAME', yaha_analyzer.HDF_NAME)
+        yaha_analyzer.DATA_PATH = data.name
+        yaha_analyzer.HDF_NAME = '/cbot.hdf5'
+        games, plays = self.client.games, self.client.plays
+        with self.client._open_store('w') as store:
+            self.client._append_data(store, games[games.index < 300], plays[plays['game'] < 300])
+        first, second = yaha_analyzer.yaha_analyzer(), yaha_analyzer.yaha_analyzer()
+        first.open_collectobot_data()
+        second.open_collectobot_data()
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+        stats = first.generate_card_stats(game_threshold = 1)
+        second._count_plays = None #a cache miss would fail
+        pd.testing.assert_frame_equal(second.generate_card_stats(game_threshold = 1), stats)
+        with self.client._open_store('a') as store:
+            self.client._append_data(store, games[games.index >= 300], plays[plays['game'] >= 300])
+        appended = yaha_analyzer.yaha_analyzer()
+        appended.open_collectobot_data()
+        self.assertNotEqual(appended.fingerprint(), first.fingerprint())
+        other = yaha_analyzer.yaha_analyzer()
+        other.history = {'children': synthetic_games(600)}
+        other.generate_decks(dates = False)
+        self.assertNotEqual(other.fingerprint(), self.client.fingerprint())
+        self.assertEqual(self.client._unique_decks(game_threshold = 5), self.client._unique_decks('ranked', 5))
+
+    def test_disk_tier(self):
+        """
+        Tests that results evicted from memory are read back from ANALYSIS_CACHE_DIR
+        """
+        yaha_analyzer.ANALYSIS_CACHE_SIZE = 0
+        stats = self.client.generate_card_stats()
+        decklists = self.client.generate_decklist_matchups()
+        self.assertEqual(len(yaha_analyzer._analysis_cache['results']), 1)
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+        self.client._count_plays = None #a cache miss would fail
+        pd.testing.assert_frame_equal(self.client.generate_card_stats(), stats)
+        pd.testing.assert_frame_equal(self.client.generate_decklist_matchups(), decklists)
+
+class BenchmarkTests(TestCase):
+    def test_synthetic_games(self):
+        """
+        Tests that the benchmark's synthetic games are reproducible and follow the distribution arguments
+        """
+        games = benchmark.synthetic_games(200, heroes = 2, archetypes = 1, cards = 5, max_turns = 3, seed = 3)
+        self.assertEqual(games, benchmark.synthetic_games(200, heroes = 2, archetypes = 1, cards = 5, max_turns = 3, seed = 3))
+        self.assertEqual(set(game['hero'] for game in games), {'Hero0', 'Hero1'})
+        self.assertTrue(all(play['turn'] <= 3 for game in games for play in game['card_history']))
+        self.assertLessEqual(len(set(play['card']['name'] for game in games for play in game['card_history'])), 5)
+
+    def test_run_scale_and_compare(self):
+        """
+        Tests that every stage is timed and that compare only flags stages slower than the tolerance
+        """
+        settings = (yaha_analyzer.GRAPH_DATABASE, yaha_analyzer.ANALYSIS_CACHE_DIR)
+        try:
+            results = benchmark.run_scale(200)
+        finally:
+            yaha_analyzer.GRAPH_DATABASE, yaha_analyzer.ANALYSIS_CACHE_DIR = settings
+        self.assertEqual(sorted(results), sorted(benchmark.STAGES))
+        baseline = {'200': dict((name, {'seconds': 1.0}) for name in benchmark.STAGES)}
+        slow = {'200': {'generate_decks': {'seconds': 2.0}, 'generate_matchups': {'seconds': 1.1}}}
+        self.assertEqual(benchmark.compare(slow, baseline), [('200', 'generate_decks', 1.0, 2.0)])
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        yaha_analyzer.clear_analysis_cache()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (collectobot.DATABASE, yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.AGGREGATE_DATABASE, yaha_analyzer.GRAPH_DATABASE)
+        collectobot.DATABASE = os.path.join(self.directory.name, 'collectobot.db')
+        yaha_analyzer.DATA_PATH = self.directory.name
+        yaha_analyzer.HDF_NAME = '/cbot.hdf5'
+        yaha_analyzer.AGGREGATE_DATABASE = os.path.join(self.directory.name, 'aggregates.db')
+        yaha_analyzer.GRAPH_DATABASE = os.path.join(self.directory.name, 'graph.db')
+        self.profile_dir = os.path.join(self.directory.name, 'profiles')
+
+    def tearDown(self):
+        collectobot.DATABASE, yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.AGGREGATE_DATABASE, yaha_analyzer.GRAPH_DATABASE = self.settings
+        self.directory.cleanup()
+
+    def test_stages_nest_and_add_up(self):
+        """
+        Tests that stages are nested into paths, repeated stages add up, and the report and cProfile dumps are written
+        """
+        with profiling.stage('outside') as stage:
+            stage.add(rows = 1)
+        with profiling.profile('run', self.profile_dir, cprofile = True, trace_memory = True) as profiler:
+            for day in range(3):
+                with profiling.stage('day') as stage:
+                    stage.add(rows = 10, nbytes = 100)
+                    with profiling.stage('parse'):
+                        sorted(range(1000))
+        stages = dict((record['stage'], record) for record in profiler.report()['stages'])
+        self.assertEqual(list(stages), ['run', 'run/day', 'run/day/parse'])
+        self.assertEqual((stages['run/day']['calls'], stages['run/day']['rows'], stages['run/day']['bytes']), (3, 30, 300))
+        self.assertGreaterEqual(stages['run']['seconds'], stages['run/day']['seconds'])
+        self.assertIsNotNone(stages['run/day/parse']['peak_traced_mb'])
+        files = sorted(os.listdir(self.profile_dir))
+        self.assertEqual(len(files), 4)
+        with open(os.path.join(self.profile_dir, files[0])) as infile:
+            self.assertEqual(json.load(infile)['stages'][1]['stage'], 'run/day')
+        stats = pstats.Stats(os.path.join(self.profile_dir, [name for name in files if name.endswith('.day.parse.prof')][0]))
+        self.assertTrue(any(function[2] == "<built-in method builtins.sorted>" for function in stats.stats))
+
+    def test_rebuild_and_update_report(self):
+        """
+        Tests that rebuild_and_update reports the stages of collectobot and the analyzer, and isn't profiled without a directory
+        """
+        children = synthetic_games(600)
+        conn = sqlite3.connect(collectobot.DATABASE)
+        conn.execute('CREATE TABLE collectobot (id INTEGER, date TEXT, json TEXT)')
+        conn.executemany('INSERT INTO collectobot VALUES (?, ?, ?)', [(1, '2016-07-01', json.dumps({'games': children[:300]})), (2, '2016-07-02', json.dumps({'games': children[300:]}))])
+        conn.commit()
+        conn.close()
+        report = yaha_analyzer.yaha_analyzer().rebuild_and_update(profile_dir = self.profile_dir)
+        stages = dict((record['stage'], record) for record in report['stages'])
+        for stage in ('normalize/json_parse', 'update_aggregates/sqlite_read', 'update_aggregates/dataframe', 'update_aggregates/card_extraction', 'update_aggregates/groupby',
+                      'update_aggregates/sqlite_write', 'make_graph_data/groupby', 'make_graph_data/plotly', 'make_graph_data/sqlite_write'):
+            self.assertIn('rebuild_and_update/' + stage, stages)
+        self.assertEqual(stages['rebuild_and_update/normalize/json_parse']['rows'], 600)
+        self.assertEqual(stages['rebuild_and_update/update_aggregates/sqlite_read']['rows'], 600 + sum(len(game['card_history']) for game in children))
+        self.assertEqual(stages['rebuild_and_update/update_aggregates/dataframe']['calls'], 2)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 1)
+        self.assertIsNone(yaha_analyzer.yaha_analyzer().remake_graphs())
+
+class JobTests(TestCase):
+    def setUp(self):
+        yaha_analyzer.clear_analysis_cache()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (collectobot.DATABASE, yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.AGGREGATE_DATABASE, yaha_analyzer.GRAPH_DATABASE, jobs.JOB_DATABASE)
+        collectobot.DATABASE = os.path.join(self.directory.name, 'collectobot.db')
+        yaha_analyzer.DATA_PATH = self.directory.name
+        yaha_analyzer.HDF_NAME = '/cbot.hdf5'
+        yaha_analyzer.AGGREGATE_DATABASE = os.path.join(self.directory.name, 'aggregates.db')
+        yaha_analyzer.GRAPH_DATABASE = os.path.join(self.directory.name, 'graph.db')
+        jobs.JOB_DATABASE = os.path.join(self.directory.name, 'jobs.db')
+
+    def tearDown(self):
+        collectobot.DATABASE, yaha_analyzer.DATA_PATH, yaha_analyzer.HDF_NAME, yaha_analyzer.AGGREGATE_DATABASE, yaha_analyzer.GRAPH_DATABASE, jobs.JOB_DATABASE = self.settings
+        self.directory.cleanup()
+
+    def test_rebuild_job(self):
+        """
+        Tests that concurrent rebuild requests share one job, which reports progress and leaves only the new graphs table behind
+        """
+        conn = sqlite3.connect(collectobot.DATABASE)
+        conn.execute('CREATE TABLE collectobot (id INTEGER, date TEXT, json TEXT)')
+        conn.execute('INSERT INTO collectobot VALUES (?, ?, ?)', (1, '2016-07-01', json.dumps({'games': synthetic_games(600)})))
+        conn.commit()
+        conn.close()
+        job_id = jobs.submit('rebuild', start = False)
+        self.assertEqual(jobs.submit('rebuild', start = False), job_id)
+        remake_id = jobs.submit('remake', start = False)
+        self.assertNotEqual(remake_id, job_id)
+        self.assertEqual(jobs.get(job_id)['status'], 'queued')
+        self.assertEqual(jobs.work(), 2)
+        job = jobs.get(job_id)
+        self.assertEqual((job['status'], job['progress'], job['error']), ('done', 1.0, None))
+        self.assertEqual(jobs.get(remake_id)['status'], 'done')
+        self.assertIsNone(jobs.get(remake_id + 1))
+        conn = sqlite3.connect(yaha_analyzer.GRAPH_DATABASE)
+        self.assertEqual(conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'graphs_staging'").fetchone()[0], 0)
+        self.assertGreater(conn.execute('SELECT count(*) FROM graphs').fetchone()[0], 0)
+        conn.close()
+
+    def test_orphaned_job_fails(self):
+        """
+        Tests that a job whose worker stopped beating is failed instead of blocking new ones, while a live running job gets a new job queued behind it
+        """
+        job_id = jobs.submit('rebuild', start = False)
+        jobs._update(job_id, status = 'running', heartbeat = time.time() - jobs.HEARTBEAT_TIMEOUT - 1)
+        queued_id = jobs.submit('rebuild', start = False)
+        self.assertNotEqual(queued_id, job_id)
+        self.assertEqual((jobs.get(job_id)['status'], jobs.get(job_id)['error']), ('failed', 'worker stopped responding'))
+        jobs._update(queued_id, status = 'running', heartbeat = time.time())
+        self.assertNotEqual(jobs.submit('rebuild', start = False), queued_id)
+        self.assertEqual(jobs.get(queued_id)['status'], 'running')
+
+    def test_orphaned_job_stays_failed(self):
+        """
+        Tests that a worker that was only slow doesn't mark its job done after it was failed as an orphan
+        """
+        orphaned = []
+        def remake_graphs(analyzer, progress = None):
+            if not orphaned:
+                orphaned.append(True)
+                conn = sqlite3.connect(jobs.JOB_DATABASE)
+                with conn:
+                    conn.execute("UPDATE jobs SET heartbeat = ? WHERE status = 'running'", (time.time() - jobs.HEARTBEAT_TIMEOUT - 1,))
+                conn.close()
+                jobs.submit('remake', start = False)
+        self.addCleanup(setattr, yaha_analyzer.yaha_analyzer, 'remake_graphs', yaha_analyzer.yaha_analyzer.remake_graphs)
+        yaha_analyzer.yaha_analyzer.remake_graphs = remake_graphs
+        job_id = jobs.submit('remake', start = False)
+        self.assertEqual(jobs.work(), 2)
+        self.assertEqual((jobs.get(job_id)['status'], jobs.get(job_id)['error']), ('failed', 'worker stopped responding'))
+        self.assertEqual(jobs.get(job_id + 1)['status'], 'done')
@@ -1,50 +1,531 @@
 import sys
 import json
+import base64
 import requests
 import pandas as pd
 import numpy as np
 import os.path
-import datetime
 import sqlite3
 import hashlib
+import gzip
+import glob
+import shutil
+import operator
+import threading
+import time
+import pickle
+import copy
+import functools
+import inspect
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pandas import HDFStore
 import plotly
 import collectobot
+import profiling
 import plotly.graph_objs as go
-
+from pandas.api.types import union_categoricals
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+TRACKOBOT_URL = 'https://trackobot.com/profile/history.json' #track-o-bot history api, pages are newest game first
+SYNC_WORKERS = 4 #track-o-bot history pages pulled at once by pull_data
 DATA_PATH = '../test_data/' #TODO in current directory while testing, needs to be fixed before shipping!
 HDF_NAME = '../test_data/cbot.hdf5'
+PARQUET_NAME = '../test_data/cbot.parquet'
+STORAGE_BACKEND = 'hdf5' #'hdf5' or 'parquet' (needs pyarrow), format of the collect-o-bot games and plays
+CATEGORY_COLUMNS = ['hero', 'opponent', 'hero_deck', 'opponent_deck', 'p_deck_type', 'o_deck_type', 'mode', 'region', 'result', 'user_hash'] #low cardinality string columns of the games kept as categoricals
+INT_COLUMNS = {'rank': 'Int8', 'legend': 'Int32', 'duration': 'Int32'} #nullable integer columns of the games, the widths are fixed so every chunk appended to the data file has the same schema
 GRAPH_DATABASE = '../test_data/graph.db'
+AGGREGATE_DATABASE = '../test_data/aggregates.db'
+GRAPH_WORKERS = 1 #processes used by make_graph_data, 1 builds the graphs in the calling process
+GRAPH_BATCH_SIZE = 50 #graphs per worker task and per database write in make_graph_data
+GRAPH_CACHE_SIZE = 512 #graph json kept in memory by get_graph_data in each process
+GRAPH_COMPACT = False #compact heatmap payloads in make_graph_data, z is sent as base64 float32 which matchups.html decodes for the bundled plotly.js
+GRAPH_TEXTTEMPLATE = False #label heatmap cells in make_graph_data with a texttemplate instead of an annotation per cell, needs plotly.js >= 2.11 and yaha_web bundles 1.4.1
+HDF_MIN_ITEMSIZE = 128 #width reserved for string columns when appending to a hdf5 table, longer notes are truncated
+ANALYSIS_CACHE_SIZE = 256*2**20 #bytes of analysis results kept in memory by the methods wrapped in _cached
+ANALYSIS_CACHE_DIR = None #directory for a second, on disk tier of analysis results, off if None
+ANALYSIS_DISK_CACHE_SIZE = 2*2**30 #bytes of analysis results kept in ANALYSIS_CACHE_DIR
+USER_CACHE_SIZE = 1*2**30 #bytes of track-o-bot user datasets, and of the analysis results made from them, kept in memory by pull_data
+USER_COLUMNS = [('user_hash', 'TEXT PRIMARY KEY'), ('total_items', 'INTEGER'), ('json_name', 'TEXT'), ('hdf5_name', 'TEXT'), ('last_game_id', 'INTEGER'), ('row_count', 'INTEGER'), ('content_hash', 'TEXT'), ('synced', 'REAL')] #fields of a track-o-bot user in users.db
+CARD_COLUMNS = [('card', 'INTEGER PRIMARY KEY'), ('name', 'TEXT UNIQUE'), ('card_id', 'TEXT'), ('mana', 'INTEGER')] #fields of a card in the card dictionary, self.cards and the cards table of AGGREGATE_DATABASE
+
+_GRAPH_TABLE = 'CREATE TABLE IF NOT EXISTS {} (id INTEGER, name TEXT, json TEXT, type TEXT, gzip BLOB, br BLOB, etag TEXT)'
+_PLAY_COUNTS_TABLE = 'CREATE TABLE IF NOT EXISTS play_counts (mode TEXT, player TEXT, card INTEGER, p_deck_type TEXT, o_deck_type TEXT, turn INTEGER, win INTEGER, loss INTEGER, PRIMARY KEY (mode, player, card, p_deck_type, o_deck_type, turn))'
+_DATA_ATTRIBUTES = ('games', 'plays', 'cards', 'aggregates') #replacing one of these bumps yaha_analyzer._data_version
+_graph_connections = threading.local()
+_user_connections = threading.local()
+_filter_ops = {'in': lambda column, values: column.isin(values), '>=': operator.ge, '<': operator.lt}
+_graph_cache = {'lock': threading.Lock(), 'version': None, 'graphs': OrderedDict(), 'names': None}
+_analysis_cache = {'lock': threading.Lock(), 'results': OrderedDict(), 'size': 0}
+_user_cache = {'lock': threading.Lock(), 'users': OrderedDict(), 'size': 0}
+
+def _cached(method):
+    """
+    Caches the results of an analysis method by (method, arguments, dataset fingerprint), see yaha_analyzer.fingerprint
+    Results live in an in-memory LRU of ANALYSIS_CACHE_SIZE bytes, and in ANALYSIS_CACHE_DIR if it's set, callers always get a copy, see _copy_result
+    Results made from a track-o-bot user's dataset served out of the user cache are kept with that dataset instead, see _user_cache_put
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        fingerprint = self.fingerprint()
+        key = repr((method.__name__, list(arguments.arguments.items())[1:], fingerprint))
+        user = self._user if self._user is not None and self._user['fingerprint'] == fingerprint else None
+        result = _user_result_get(user, key) if user else _cache_get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            if user:
+                _user_result_put(user, key, result)
+            else:
+                _cache_put(key, result)
+        return _copy_result(result)
+    return wrapper
+
+def _copy_result(result):
+    """A copy of a cached result to hand out, frames, series, arrays and lists are copied with their own copy method, which doesn't copy the python objects held in object columns, so those mustn't be changed in place"""
+    if isinstance(result, tuple):
+        return tuple(_copy_result(item) for item in result)
+    if isinstance(result, (pd.DataFrame, pd.Series, np.ndarray, list)):
+        return result.copy()
+    return copy.deepcopy(result)
+
+def _cache_size(result):
+    """Bytes used by a cached result"""
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(np.sum(result.memory_usage(deep = True)))
+    if isinstance(result, (list, tuple)):
+        return sys.getsizeof(result) + sum(_cache_size(item) for item in result)
+    return sys.getsizeof(result)
+
+def _cache_file(key):
+    """Path of a result in ANALYSIS_CACHE_DIR"""
+    return os.path.join(ANALYSIS_CACHE_DIR, '{}.pkl'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+def _cache_get(key):
+    """Looks a result up in memory and then on disk, None if it isn't cached"""
+    with _analysis_cache['lock']:
+        results = _analysis_cache['results']
+        if key in results:
+            results.move_to_end(key)
+            return results[key][0]
+    if ANALYSIS_CACHE_DIR and os.path.isfile(_cache_file(key)):
+        with open(_cache_file(key), 'rb') as infile:
+            result = pickle.load(infile)
+        os.utime(_cache_file(key))
+        _cache_put(key, result, disk = False)
+        return result
+    return None
+
+def _cache_put(key, result, disk = True):
+    """Adds a result to the in-memory LRU and the disk tier, evicting the least recently used results past their sizes"""
+    size = _cache_size(result)
+    with _analysis_cache['lock']:
+        results = _analysis_cache['results']
+        if key in results:
+            _analysis_cache['size'] -= results.pop(key)[1]
+        results[key] = (result, size)
+        _analysis_cache['size'] += size
+        while _analysis_cache['size'] > ANALYSIS_CACHE_SIZE and len(results) > 1:
+            _analysis_cache['size'] -= results.popitem(last = False)[1][1]
+    if disk and ANALYSIS_CACHE_DIR:
+        os.makedirs(ANALYSIS_CACHE_DIR, exist_ok = True)
+        with open(_cache_file(key) + '.tmp', 'wb') as outfile:
+            pickle.dump(result, outfile, pickle.HIGHEST_PROTOCOL)
+        os.replace(_cache_file(key) + '.tmp', _cache_file(key))
+        files = sorted(glob.glob(os.path.join(ANALYSIS_CACHE_DIR, '*.pkl')), key = os.path.getmtime)
+        total = sum(os.path.getsize(name) for name in files)
+        for name in files[:-1]:
+            if total <= ANALYSIS_DISK_CACHE_SIZE:
+                break
+            total -= os.path.getsize(name)
+            os.remove(name)
+
+def clear_analysis_cache():
+    """Empties the in-memory tier of the analysis cache, the disk tier is left alone"""
+    with _analysis_cache['lock']:
+        _analysis_cache['results'].clear()
+        _analysis_cache['size'] = 0
+
+def _deep_size(value):
+    """Bytes used by a parsed json value, lists of more than 100 items are sampled"""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_deep_size(key) + _deep_size(item) for key, item in value.items())
+    if isinstance(value, list):
+        sample = value[:100]
+        return sys.getsizeof(value) + (sum(_deep_size(item) for item in sample)*len(value))//max(len(sample), 1)
+    return sys.getsizeof(value)
+
+def _user_cache_get(user_hash, stamp):
+    """The cached dataset of a user, None if it isn't cached or the stamp doesn't match what it was loaded from"""
+    with _user_cache['lock']:
+        users = _user_cache['users']
+        if user_hash in users and users[user_hash]['stamp'] == stamp:
+            users.move_to_end(user_hash)
+            return users[user_hash]
+    return None
+
+def _user_cache_put(user_hash, entry):
+    """Adds a user's dataset to the user cache, replacing an older one of that user and evicting the least recently used users past USER_CACHE_SIZE"""
+    with _user_cache['lock']:
+        users = _user_cache['users']
+        if user_hash in users:
+            _user_cache['size'] -= users.pop(user_hash)['size']
+        users[user_hash] = entry
+        _user_cache['size'] += entry['size']
+        _evict_users()
+
+def _user_result_get(user, key):
+    """An analysis result kept with a cached user's dataset, None if it isn't there"""
+    with _user_cache['lock']:
+        return user['results'].get(key)
+
+def _user_result_put(user, key, result):
+    """Keeps an analysis result with a cached user's dataset, it counts towards USER_CACHE_SIZE and is evicted along with the dataset"""
+    size = _cache_size(result)
+    with _user_cache['lock']:
+        user['results'][key] = result
+        user['size'] += size
+        if _user_cache['users'].get(user['user_hash']) is user:
+            _user_cache['size'] += size
+            _evict_users()
+
+def _evict_users():
+    """Drops the least recently used users until the user cache fits in USER_CACHE_SIZE, the most recent one is always kept. Called with the lock held"""
+    users = _user_cache['users']
+    while _user_cache['size'] > USER_CACHE_SIZE and len(users) > 1:
+        _user_cache['size'] -= users.popitem(last = False)[1]['size']
+
+def clear_user_cache():
+    """Empties the user cache"""
+    with _user_cache['lock']:
+        _user_cache['users'].clear()
+        _user_cache['size'] = 0
+
+def _empty_cards():
+    """An empty card dictionary, the cards are added by yaha_analyzer._intern_cards"""
+    return pd.DataFrame({'name': pd.Series(dtype = object), 'card_id': pd.Series(dtype = object), 'mana': pd.Series(dtype = np.float32)}, index = pd.RangeIndex(0, name = 'card'))
+
+class CardsPlayed(object):
+    """
+    The cards each player played in a set of games, as flat arrays instead of a list per game
+    The plays of game row n are at values[offsets[n]:offsets[n + 1]] for 'me' and at values[offsets[rows + n]:offsets[rows + n + 1]] for 'opponent', in the order they were played
+    values are codes into categories, turns and card_ids (codes into card_id_categories) line up with values when they were asked for
+    """
+
+    def __init__(self, rows, game, me, card, categories, turn = None, card_id = None, card_id_categories = None):
+        """
+        :param rows: number of games
+        :param game: row of each play's game
+        :param me: whether each play was made by 'me'
+        :param card: card code of each play
+        :param categories: card names of the codes
+        :param turn: turn of each play, left out if None
+        :param card_id: card id code of each play, left out if None
+        :param card_id_categories: card ids of the codes
+        :type rows: int
+        :type game: numpy array
+        :type me: numpy array
+        :type card: numpy array
+        :type categories: pandas index
+        :type turn: numpy array
+        :type card_id: numpy array
+        :type card_id_categories: pandas index
+        """
+        key = np.where(me, 0, rows) + game
+        order = np.argsort(key, kind = 'stable')
+        self.rows = rows
+        self.offsets = np.zeros(2*rows + 1, dtype = np.int64)
+        np.cumsum(np.bincount(key, minlength = 2*rows), out = self.offsets[1:])
+        self.values = card[order]
+        self.categories = categories
+        self.turns = None if turn is None else turn[order]
+        self.card_ids = None if card_id is None else card_id[order]
+        self.card_id_categories = card_id_categories
+
+    def __len__(self):
+        return self.rows
+
+    def bounds(self, row, player = 'me'):
+        """
+        :param row: position of the game
+        :param player: 'me' or 'opponent'
+        :type row: int
+        :type player: string
+
+        :return: start and end of the game's plays by player in the flat arrays
+        :rtype: (int, int)
+        """
+        row = row if player == 'me' else self.rows + row
+        return self.offsets[row], self.offsets[row + 1]
+
+    def codes(self, row, player = 'me'):
+        """
+        :return: view of the card codes a player played in a game
+        :rtype: numpy array
+        """
+        start, end = self.bounds(row, player)
+        return self.values[start:end]
+
+    def cards(self, row, player = 'me'):
+        """
+        :return: names of the cards a player played in a game
+        :rtype: list of strings
+        """
+        return self.categories.take(self.codes(row, player)).tolist()
+
+    def counts(self, player = 'me'):
+        """
+        :return: number of cards a player played in each game
+        :rtype: numpy array
+        """
+        offsets = self.offsets[:self.rows + 1] if player == 'me' else self.offsets[self.rows:]
+        return np.diff(offsets)
+
+    def to_lists(self, player = 'me'):
+        """
+        :return: names of the cards a player played in each game, like the old ['p_cards_played'] and ['o_cards_played'] columns
+        :rtype: list of lists of strings
+        """
+        names = self.categories.take(self.values).tolist()
+        offsets = (self.offsets[:self.rows + 1] if player == 'me' else self.offsets[self.rows:]).tolist()
+        return [names[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+class ParquetStore(object):
+    """
+    Directory of parquet files holding games and plays, used in place of a HDFStore when STORAGE_BACKEND is 'parquet'
+    Every append writes one file under games/ and one under plays/, games keep their index in the ['game'] column
+    """
+
+    def __init__(self, path, mode = 'a'):
+        """
+        :param path: directory of the store
+        :param mode: 'w' to start over, 'a' to append to the files already there, 'r' to read
+        :type path: string
+        :type mode: string
+        """
+        if pa is None:
+            raise ImportError('pyarrow is needed for the parquet storage backend')
+        self.path = path
+        if mode == 'w' and os.path.isdir(path):
+            shutil.rmtree(path)
+        if mode != 'r':
+            for table in ('games', 'plays'):
+                os.makedirs(os.path.join(path, table), exist_ok = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def append(self, games, plays):
+        """
+        Writes a chunk of games and plays as the next part of the store
+
+        :param games: games to append
+        :param plays: plays of those games
+        :type games: pandas dataframe
+        :type plays: pandas dataframe
+        """
+        part = 'part-{:05d}.parquet'.format(len(os.listdir(os.path.join(self.path, 'games'))))
+        pq.write_table(pa.Table.from_pandas(plays, preserve_index = False), os.path.join(self.path, 'plays', part))
+        pq.write_table(pa.Table.from_pandas(games.rename_axis('game').reset_index(), preserve_index = False), os.path.join(self.path, 'games', part))
+
+    def dtypes(self, table):
+        """
+        :param table: 'games' or 'plays'
+        :type table: string
+
+        :return: dtypes of the table's columns as they were first written, None if nothing was appended yet
+        :rtype: pandas series
+        """
+        files = self._files(table)
+        if not files:
+            return None
+        return pq.read_schema(files[0]).empty_table().to_pandas().dtypes
+
+    def rows(self, table):
+        """
+        :param table: 'games' or 'plays'
+        :type table: string
+
+        :return: number of rows in the table
+        :rtype: int
+        """
+        return sum(pq.read_metadata(name).num_rows for name in self._files(table))
+
+    def truncate(self, table, rows):
+        """
+        Drops the rows of a table after the first rows, the parts past them are deleted and the part they end in is cut short
+
+        :param table: 'games' or 'plays'
+        :param rows: number of rows to keep
+        :type table: string
+        :type rows: int
+        """
+        for name in self._files(table):
+            count = pq.read_metadata(name).num_rows
+            if rows <= 0:
+                os.remove(name)
+            elif count > rows:
+                pq.write_table(pq.read_table(name).slice(0, rows), name)
+            rows -= count
+
+    def _files(self, table):
+        """Internal method -- The parts of a table, in the order they were appended"""
+        return sorted(glob.glob(os.path.join(self.path, table, '*.parquet')))
+
+    def read(self, table, columns = None, filters = None):
+        """
+        Reads a table through memory mapped files, only loading the columns asked for and the row groups that can match the filters
+
+        :param table: 'games' or 'plays'
+        :param columns: columns to read, all of them if None
+        :param filters: (column, op, value) predicates that are all true for the rows read, op is one of 'in', '>=', '<'
+        :type table: string
+        :type columns: list
+        :type filters: list of tuples
+
+        :return: the table
+        :rtype: pandas dataframe
+        """
+        files = self._files(table)
+        schema = pa.unify_schemas([pq.read_schema(name) for name in files], promote_options = 'permissive') #chunks where a column was all null have it typed as null
+        dataset = ds.dataset(files, schema = schema, format = 'parquet', filesystem = pyarrow.fs.LocalFileSystem(use_mmap = True))
+        return dataset.to_table(columns = columns, filter = pq.filters_to_expression(filters) if filters else None).to_pandas()
+
 
 class yaha_analyzer(object):
 
     def __init__(self):
+        self._data_version = 0
+        self._fingerprint = (None, None)
+        self._source = (None, None)
+        self._token = uuid.uuid4().hex
+        self._user = None
+        self._cards_played = (None, None)
+        self.cards = _empty_cards()
         self.total_pages = 0
         self.history = []
         self.username = ''
         self.api_key = ''
         self.new_data = False
+        self.aggregates = None
+        self.footprint = None
+
+    def __setattr__(self, name, value):
+        """Bumps self._data_version whenever self.games, self.plays, self.cards or self.aggregates is replaced, so results cached from the old data aren't reused"""
+        if name in _DATA_ATTRIBUTES:
+            object.__setattr__(self, '_data_version', self.__dict__.get('_data_version', 0) + 1)
+        object.__setattr__(self, name, value)
 
-    def generate_collectobot_data(self):
+    def fingerprint(self):
         """
-        Generates collect-o-bot data from the database, writes it to a hdf5 file
+        Returns a hash identifying self.games, self.plays, self.cards and self.aggregates, used as the dataset part of the analysis cache keys
+        Data loaded by read_data, generate_collectobot_data or update_aggregates is identified by where it was read from (the file's modification time and size, and the high water mark for the aggregates) and its row counts, so analyzers reading the same stored data share results
+        Data built in memory, by generate_decks from a history, is only identified by this analyzer and _data_version
+        It's computed once per _data_version, so it changes whenever the data is replaced. Changing self.games in place isn't noticed.
 
-        :return: list of games
+        :return: sha1 hex digest
+        :rtype: string
+        """
+        version, digest = self._fingerprint
+        if version != self._data_version:
+            source_version, source = self._source
+            if source_version != self._data_version:
+                source = ('memory', self._token, self._data_version)
+            self._fingerprint = (self._data_version, hashlib.sha1(repr(source).encode('utf-8')).hexdigest())
+        return self._fingerprint[1]
+
+    def _set_source(self, *source):
+        """Internal method -- Records where the data that was just loaded came from, for fingerprint. Replacing the data afterwards makes it count as built in memory again"""
+        self._source = (self._data_version, source + (len(self.games) if self.games is not None else None, len(self.plays) if self.plays is not None else None))
+
+    def _file_stamp(self, path):
+        """Internal method -- Modification times and sizes of a data file, or of the parts of a ParquetStore directory"""
+        paths = sorted(glob.glob(os.path.join(path, '*', '*.parquet'))) if os.path.isdir(path) else [path]
+        return tuple((name, os.stat(name).st_mtime_ns, os.stat(name).st_size) for name in paths)
+
+    def generate_collectobot_data(self, keep = True):
+        """
+        Generates collect-o-bot data from the database one day at a time, appending each day to the STORAGE_BACKEND file as it's built
+        Only one day is parsed at a time, but with keep every day's games and plays stay in memory to be joined into self.games and self.plays, so memory still grows with the whole history
+        Without keep each day is dropped once it's written and memory stays at about one day, read the file back with open_collectobot_data
+        Days collectobot still stores as json are normalized first
+
+        :param keep: load the games and plays into self.games and self.plays
+        :type keep: bool
+
+        :return: list of games, None without keep
         :rtype: pandas dataframe
         """
-        results = collectobot.aggregate()
-        self.games = results
-        self.history = {'children': results, 'meta': {'total_items': len(results)}}
-        self.generate_decks(dates = False)
-        self.write_hdf5(HDF_NAME)
-        return results
+        games = []
+        plays = []
+        self.history = {'meta': {'total_items': 0}}
+        self.footprint = None
+        self.cards = _empty_cards()
+        with profiling.stage('normalize'):
+            collectobot.normalize()
+        with self._open_store('w') as store:
+            for day_games, day_plays in self._iter_decks(self._count_items(frames for day_id, frames in collectobot.iter_frames()), dates = False):
+                self._append_data(store, day_games, day_plays)
+                if keep:
+                    games.append(day_games)
+                    plays.append(day_plays)
+        if not keep:
+            self.aggregates = None
+            self.games = None
+            self.plays = None
+            return None
+        self._concat_decks(games, plays)
+        self._set_source('collectobot', collectobot.DATABASE, self._file_stamp(collectobot.DATABASE))
+        return self.games
+
+    def _count_items(self, chunks):
+        """Internal method -- Passes chunks of games through while counting them into self.history['meta']['total_items']"""
+        for children in chunks:
+            self.history['meta']['total_items'] += len(children[0]) if isinstance(children, tuple) else len(children)
+            yield children
+
+    def open_collectobot_data(self, columns = None, modes = None, start_date = None, end_date = None):
+        """
+        Loads the collectobot data from the STORAGE_BACKEND file, see read_data for the parameters
+        """
+        self.read_data(hdf5_name=self._data_name(), columns = columns, modes = modes, start_date = start_date, end_date = end_date)
 
+    def _data_name(self):
+        """Internal method -- Name of the collect-o-bot data file under DATA_PATH for STORAGE_BACKEND"""
+        return PARQUET_NAME if STORAGE_BACKEND == 'parquet' else HDF_NAME
 
-    def open_collectobot_data(self):
+    def _open_store(self, mode):
         """
-        Loads the collectobot data from a hdf5 file
+        Internal method -- Opens the collect-o-bot data file for appending games and plays with _append_data
+
+        :param mode: 'w' to start over, 'a' to append
+        :type mode: string
+
+        :return: store for STORAGE_BACKEND
+        :rtype: ParquetStore or pandas HDFStore
         """
-        self.read_data(hdf5_name=HDF_NAME)
+        path = '{}{}'.format(DATA_PATH, self._data_name())
+        if STORAGE_BACKEND == 'parquet':
+            return ParquetStore(path, mode)
+        return HDFStore(path, mode = mode)
 
     def _load_json_data(self, json_file):
         """
@@ -56,8 +537,9 @@ class yaha_analyzer(object):
         :return: list of games
         :rtype: pandas dataframe
         """
-        with open(json_file, "r") as infile:
+        with open(json_file, "r") as infile, profiling.stage('json_parse') as stage:
             results = json.load(infile)
+            stage.add(rows = len(results.get('children', [])), nbytes = infile.tell())
         self.history = results
         self.generate_decks()
         return results
@@ -66,6 +548,8 @@ class yaha_analyzer(object):
         """
 
         Grabs the data from the trackobot servers, writes it out to a new files and the database if it doesn't exist/outdated
+        A user with stored data is synced incrementally, only the pages newer than the last stored game are pulled and only the new games are appended to the hdf5 file
+        If the stored games can't be found in the history anymore (e.g. the count went down) everything is pulled again
 
         :param username: trackobot username
         :param api_key: trackobot api key
@@ -77,51 +561,242 @@ class yaha_analyzer(object):
         """
         self.username = username
         self.api_key = api_key
-        url = 'https://trackobot.com/profile/history.json?'
-        auth = {'username': username, 'token': api_key}
-        req = requests.get(url, params=auth).json()
-        metadata = req['meta']
-        user_hash, count, json_name, hdf5_name = self.store_data()
-        #if it's not equal, repull
-        if metadata['total_items'] != count or not self.check_data(json_name, hdf5_name):
-            results = {'children': req['history']}
-            if metadata['total_pages'] != None:
-                for page_number in range(2, metadata['total_pages']+1):
-                    auth['page'] = page_number
-                    results['children'].extend(requests.get(url, params=auth).json()['history'])
-            results['meta'] = {'total_items': metadata['total_items']}
+        sessions = threading.local()
+        first_page = self._fetch_history_page(sessions, 1)
+        metadata = first_page['meta']
+        user = self.store_data()
+        json_name, hdf5_name = user['json_name'], user['hdf5_name']
+        newest_id = first_page['history'][0]['id'] if first_page['history'] else None
+        stored_files = self.check_data(json_name, hdf5_name)
+        if stored_files and metadata['total_items'] == user['total_items'] and user['last_game_id'] in (None, newest_id): #None for users synced before last_game_id was kept
+            return self._load_user(user)
+        incremental = stored_files and user['last_game_id'] is not None and user['total_items'] and metadata['total_items'] > user['total_items']
+        new_games = None
+        if incremental:
+            new_games = self._sync_history(sessions, first_page, user['last_game_id'], user['total_items'])
+        stored = []
+        if new_games is None: #a new user, or the stored games aren't in the history anymore
+            new_games = self._sync_history(sessions, first_page)
+        else:
+            with open('{}{}'.format(DATA_PATH, json_name)) as infile:
+                stored = json.load(infile)['children']
+        results = {'children': new_games + stored, 'meta': {'total_items': metadata['total_items']}}
+        if stored:
+            self.history = {'children': new_games}
+            with HDFStore('{}{}'.format(DATA_PATH, hdf5_name), mode='a') as store:
+                for games, plays in self._iter_decks([new_games], offset = len(stored)):
+                    self._append_data(store, games, plays)
+            self.history = results
+            self.read_data(hdf5_name = hdf5_name)
+        else:
             self.history = results
             self.generate_decks()
             self.write_hdf5(hdf5_name)
-            with open('{}{}'.format(DATA_PATH, json_name), "w") as outfile:
-                json.dump(results, outfile)
-            self.update_count(user_hash, metadata['total_items']) #once everything's been loaded and written, update the total_items count in the database
-        else:
-            results = self.read_data(json_name, hdf5_name)
+        json_data = json.dumps(results)
+        with open('{}{}'.format(DATA_PATH, json_name), "w") as outfile:
+            outfile.write(json_data)
+        #once everything's been loaded and written, update the user's sync state in the database
+        user.update(total_items = metadata['total_items'], last_game_id = newest_id, row_count = len(self.games), content_hash = hashlib.sha1(json_data.encode('utf-8')).hexdigest())
+        self.update_count(user['user_hash'], user['total_items'], last_game_id = user['last_game_id'], row_count = user['row_count'], content_hash = user['content_hash'])
+        self._cache_user(user)
         return results
 
-    def generate_decks(self, dates = True):
+    def _user_stamp(self, user):
+        """
+        Internal method -- What a user's cached dataset is checked against, the modification times and sizes of the user's files and the content hash from the users table
+
+        :param user: the user's row from store_data
+        :type user: dictionary
+
+        :return: stamp of the user's stored data
+        :rtype: tuple
+        """
+        stats = [os.stat('{}{}'.format(DATA_PATH, user[name])) for name in ('json_name', 'hdf5_name')]
+        return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats) + (user['content_hash'],)
+
+    def _load_user(self, user):
+        """
+        Internal method -- Loads an up to date user's stored data, out of the user cache if the files haven't changed since it was cached, otherwise with read_data
+        The cached frames are shared by every analyzer serving that user and mustn't be changed in place
+
+        :param user: the user's row from store_data
+        :type user: dictionary
+
+        :return: complete history of games and metadata
+        :rtype: dictionary
+        """
+        entry = _user_cache_get(user['user_hash'], self._user_stamp(user))
+        if entry is None:
+            self.read_data(user['json_name'], user['hdf5_name'])
+            self._cache_user(user)
+            return self.history
+        self.history = entry['history']
+        self.games = entry['games']
+        self.plays = entry['plays']
+        self.cards = entry['cards']
+        self.aggregates = None
+        self._fingerprint = (self._data_version, entry['fingerprint'])
+        self._user = entry
+        return self.history
+
+    def _cache_user(self, user):
+        """
+        Internal method -- Puts the loaded history, games, plays and cards into the user cache as the user's dataset, analysis results made from them afterwards are kept with them
+
+        :param user: the user's row from store_data, after the files were written
+        :type user: dictionary
+        """
+        size = _deep_size(self.history) + int(np.sum(self.memory_footprint()))
+        self._user = {'user_hash': user['user_hash'], 'stamp': self._user_stamp(user), 'history': self.history, 'games': self.games, 'plays': self.plays, 'cards': self.cards,
+                      'fingerprint': self.fingerprint(), 'results': {}, 'size': size}
+        _user_cache_put(user['user_hash'], self._user)
+
+    def _fetch_history_page(self, sessions, page):
+        """
+        Internal method -- Pulls one page of the user's track-o-bot history, each thread keeps its own pooled requests session
+
+        :param sessions: holds each thread's requests session
+        :param page: page number, 1 is the newest
+        :type sessions: threading.local
+        :type page: int
+
+        :return: the page's json, with ['meta'] and ['history']
+        :rtype: dictionary
+        """
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        response = sessions.session.get(TRACKOBOT_URL, params = {'username': self.username, 'token': self.api_key, 'page': page})
+        response.raise_for_status()
+        return response.json()
+
+    def _sync_history(self, sessions, first_page, last_id = None, stored_count = 0):
+        """
+        Internal method -- Pulls the games newer than the newest stored one, stopping at the first page holding a stored game
+        The pages up to where the newest stored game should be, going by the difference between the total and the stored count, are pulled at once by SYNC_WORKERS threads. If it isn't there the following pages are pulled SYNC_WORKERS at a time
+
+        :param sessions: holds each thread's requests session
+        :param first_page: the newest page of history, already pulled
+        :param last_id: id of the newest stored game, every page is pulled if None
+        :param stored_count: number of stored games
+        :type sessions: threading.local
+        :type first_page: dictionary
+        :type last_id: int
+        :type stored_count: int
+
+        :return: the new games, newest first. None if last_id isn't in the history
+        :rtype: list of dictionaries
+        """
+        metadata = first_page['meta']
+        total_pages = metadata['total_pages'] or 1
+        per_page = max(len(first_page['history']), 1)
+        wanted = total_pages if last_id is None else (metadata['total_items'] - stored_count)//per_page + 1 #the page the newest stored game should be on
+        new_games = []
+        pages = [first_page]
+        next_page = 2
+        with ThreadPoolExecutor(max_workers = SYNC_WORKERS) as pool:
+            while pages:
+                for page in pages:
+                    for game in page['history']:
+                        if last_id is not None and game['id'] <= last_id:
+                            return new_games
+                        new_games.append(game)
+                numbers = list(range(next_page, min(wanted if wanted >= next_page else next_page + SYNC_WORKERS - 1, total_pages) + 1))
+                pages = list(pool.map(lambda number: self._fetch_history_page(sessions, number), numbers))
+                next_page += len(numbers)
+        return new_games if last_id is None else None
+
+    def generate_decks(self, dates = True, chunks = None):
         """
         Differentiates between the different deck types, and sorts them into their individual lists (history is a massive array, transform into a pandas dataframe for processing)
 
         :param dates: generate specific dates into their own columns
+        :param chunks: lists of games to build from one at a time (e.g. collectobot.iter_aggregate()), self.history['children'] is used if None. Only one chunk's dicts are turned into frames at a time, the frames of every chunk are kept and joined at the end
         :type dates: bool
+        :type chunks: iterable of lists of dictionaries
 
         :return: list of games
         :rtype: pandas dataframe
         """
-        self.games = pd.DataFrame(self.history['children'])
-        self.games.loc[self.games['hero_deck'].isnull(), 'hero_deck'] = 'Other'
-        self.games.loc[self.games['opponent_deck'].isnull(), 'opponent_deck'] = 'Other'
-        self.games['p_deck_type'] = self.games['hero_deck'].map(str) + '_' +  self.games['hero']
-        self.games['o_deck_type'] = self.games['opponent_deck'].map(str) + '_' + self.games['opponent']
-
-        self._generate_cards_played()
-        if dates:
-            self._make_dates()
-        self.games = self.games[self.games['card_history'].str.len() != 0]
+        if chunks is None:
+            chunks = [self.history['children']]
+        self.footprint = None
+        self.cards = _empty_cards()
+        games = []
+        plays = []
+        for chunk_games, chunk_plays in self._iter_decks(chunks, dates):
+            games.append(chunk_games)
+            plays.append(chunk_plays)
+        self._concat_decks(games, plays)
         return self.games
 
+    def _iter_decks(self, chunks, dates = True, offset = 0):
+        """
+        Internal method -- Builds the games and plays for each list of games in chunks, called by generate_decks
+        The cards played are interned into self.cards as they're found, so card ids are shared by all the chunks
+
+        :param chunks: lists of games, or already flattened (games, plays) dataframes from collectobot.iter_frames
+        :param dates: generate specific dates into their own columns
+        :param offset: game id of the first game in chunks
+        :type chunks: iterable of lists of dictionaries or of (pandas dataframe, pandas dataframe)
+        :type dates: bool
+        :type offset: int
+
+        :return: games and plays of each chunk, with game ids unique across chunks
+        :rtype: generator of (pandas dataframe, pandas dataframe)
+        """
+        for children in chunks:
+            if len(children) == 0:
+                continue
+            if isinstance(children, tuple) and len(children[0]) == 0:
+                continue
+            with profiling.stage('dataframe') as stage:
+                if isinstance(children, tuple):
+                    self.games, plays = children
+                    self.games = self.games.set_axis(np.arange(offset, offset + len(self.games)))
+                    self.plays = self._plays_frame(plays['game'].values + offset, plays['player'], plays['turn'], plays['card'], plays['card_id'], plays['mana'])
+                else:
+                    self.games = pd.DataFrame(children, index = np.arange(offset, offset + len(children)))
+                offset += len(self.games)
+                self.games.loc[self.games['hero_deck'].isnull(), 'hero_deck'] = 'Other'
+                self.games.loc[self.games['opponent_deck'].isnull(), 'opponent_deck'] = 'Other'
+                self.games['p_deck_type'] = self.games['hero_deck'].map(str) + '_' +  self.games['hero']
+                self.games['o_deck_type'] = self.games['opponent_deck'].map(str) + '_' + self.games['opponent']
+                stage.add(rows = len(self.games))
+
+            with profiling.stage('card_extraction') as stage:
+                if 'card_history' in self.games.columns:
+                    self._generate_plays()
+                stage.add(rows = len(self.plays))
+            with profiling.stage('compact') as stage:
+                if dates:
+                    self._make_dates()
+                self.games = self._compact_games(self.games[self.games.index.isin(self.plays['game'])])
+                stage.add(rows = len(self.games), nbytes = int(self.games.memory_usage().sum() + self.plays.memory_usage().sum()))
+            yield self.games, self.plays
+
+    def _concat_decks(self, games, plays):
+        """
+        Internal method -- Joins the per chunk games and plays from _iter_decks into self.games and self.plays, merging the categories of the games and of the plays' card ids
+
+        :param games: games of each chunk
+        :param plays: plays of each chunk
+        :type games: list of pandas dataframes
+        :type plays: list of pandas dataframes
+        """
+        self.aggregates = None
+        if len(games) == 1:
+            self.games, self.plays = games[0], plays[0]
+            return
+        self.games = pd.concat(games)
+        for column in self.games.columns:
+            if all(isinstance(chunk[column].dtype, pd.CategoricalDtype) for chunk in games):
+                self.games[column] = union_categoricals([chunk[column] for chunk in games], sort_categories = True)
+        card_ids = union_categoricals([chunk['card_id'] for chunk in plays], sort_categories = True)
+        self.plays = pd.concat([chunk.drop('card_id', axis=1) for chunk in plays], ignore_index = True)
+        self.plays['card_id'] = card_ids
+        self.plays = self.plays[['game', 'player', 'turn', 'card', 'card_id', 'mana']]
+
+    @_cached
     def _unique_decks(self, game_mode='ranked', game_threshold = 5, formatted = True):
         """
         Returns a list with the unique decks for that game mode in self.games
@@ -141,33 +816,135 @@ class yaha_analyzer(object):
             return sorted(list(map(lambda x: x.replace("_", " "), deck_types)))
         return deck_types
 
+    @_cached
     def _unique_cards(self, game_mode='ranked', game_threshold = 5, formatted = True):
         """
-        Returns a list with the unique cards for that game mode in self.games
+        Returns a list with the unique cards for that game mode in self.games, sorted by name
         >> Don't actually use this, call the database instead
 
         :param game_mode: the game mode, 'ranked', 'casual', or 'both
         :param game_threshold: the minimum amount of games the deck has to show up
+        :param formatted: return the card names, otherwise their ids in self.cards
         :type game_mode: string
         :type game_threshold: int
+        :type formatted: bool
 
         :return: a list of cards
-        :rtype: list of strings
+        :rtype: list of strings (ints if not formatted)
         """
-        cards = self.generate_card_stats(game_mode, game_threshold).reset_index()
-        cards = cards['card'].unique().tolist()
-        return cards
+        cards = self.generate_card_stats(game_mode, game_threshold).index.unique(level='card')
+        cards = cards[np.argsort(self.card_names(cards), kind='stable')]
+        if formatted:
+            return self.card_names(cards).tolist()
+        return cards.tolist()
 
     def _make_dates(self):
-        """Internal method -- Converts the dates in self.games to separate columns for easier parsing, called by generate_decks"""
-        format_date = lambda x: datetime.datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ')
-        split_date = lambda x: {'year': x.year, 'month': x.month, 'day': x.day, 'hour': x.hour, 'minute': x.minute, 'second': x.second}
-        date_df = pd.DataFrame(list(map(lambda x: split_date(format_date(x)), self.games['added'])))
-        self.games = self.games.join(date_df, how='outer')
+        """Internal method -- Converts the dates in self.games to a datetime ['date'] column for easier parsing, called by generate_decks"""
+        self.games['date'] = self._parse_dates(self.games['added'])
+
+    def _parse_dates(self, added):
+        """
+        Internal method -- Parses ['added'] timestamps with or without fractional seconds in one vectorized pass per format, anything else is left to pandas and unparseable values become NaT
+
+        :param added: timestamps such as '2016-06-28T17:57:45.123Z' or '2016-06-28T17:57:45Z'
+        :type added: pandas series
+
+        :return: the timestamps as naive UTC datetimes
+        :rtype: pandas series
+        """
+        if pd.api.types.is_datetime64_any_dtype(added):
+            return added
+        added = added.astype(object)
+        dates = pd.to_datetime(added, format='%Y-%m-%dT%H:%M:%S.%fZ', errors='coerce')
+        for parse in (lambda x: pd.to_datetime(x, format='%Y-%m-%dT%H:%M:%SZ', errors='coerce'), lambda x: pd.to_datetime(x, errors='coerce', utc=True).dt.tz_localize(None)):
+            missing = dates.isnull() & added.notnull()
+            if not missing.any():
+                break
+            dates[missing] = parse(added[missing])
+        return dates
+
+    def game_dates(self, games = None):
+        """
+        Returns when each game was added, the ['date'] column if generate_decks made one, otherwise parsed from ['added'] without storing it
+        Date parts come from the .dt accessor (e.g. game_dates().dt.hour), so no extra columns are kept
+
+        :param games: subset of self.games, all of self.games if None
+        :type games: pandas dataframe
+
+        :return: dates indexed the same as games
+        :rtype: pandas series
+        """
+        games = self.games if games is None else games
+        if 'date' in games.columns:
+            return games['date']
+        return self._parse_dates(games['added'])
+
+    def generate_win_rates(self, freq = 'W', game_mode = 'ranked', level = 'p_deck_type'):
+        """
+        Returns the win rate of every deck type over time, bucketed by the date the games were added
+
+        :param freq: pandas period frequency of the buckets, 'D' for days, 'W' for weeks, 'M' for months
+        :param game_mode: the game mode, 'ranked', 'casual', or 'both
+        :param level: column of self.games to split the win rates by
+        :type freq: string
+        :type game_mode: string
+        :type level: string
+
+        :return: win rates indexed by [level, 'period'] with ['win', 'loss', 'total_games', 'win%']
+        :rtype: pandas dataframe
+        """
+        games = self.games
+        if game_mode != 'both':
+            games = games[games['mode'] == game_mode]
+        period = self.game_dates(games).dt.to_period(freq).rename('period')
+        win = (games['result'] == 'win').values
+        counts = pd.DataFrame({'win': win.astype(np.int64), 'loss': (~win).astype(np.int64)}, index = games.index)
+        counts = counts.groupby([games[level].astype(object), period]).sum()
+        counts['total_games'] = counts['win'] + counts['loss']
+        counts['win%'] = counts['win']/counts['total_games']
+        return counts
+
+    def _compact_games(self, games):
+        """
+        Internal method -- Converts games to compact dtypes, CATEGORY_COLUMNS become categoricals, INT_COLUMNS small nullable ints, ['coin'] a nullable boolean and ['result'] is also kept as a boolean ['win']
+        The dtypes don't depend on the values in games, so chunks compacted one at a time all get the same schema
+        The memory used by each column before and after is added into self.footprint
+
+        :param games: games from _iter_decks or read_data
+        :type games: pandas dataframe
+
+        :return: the compacted games
+        :rtype: pandas dataframe
+        """
+        before = games.memory_usage(deep = True)
+        columns = {}
+        for column in CATEGORY_COLUMNS:
+            if column in games.columns and not isinstance(games[column].dtype, pd.CategoricalDtype):
+                columns[column] = games[column].astype('category')
+        for column, dtype in INT_COLUMNS.items():
+            if column in games.columns:
+                columns[column] = pd.to_numeric(games[column]).astype(dtype)
+        if 'coin' in games.columns:
+            columns['coin'] = games['coin'].astype('boolean')
+        if 'result' in games.columns:
+            columns['win'] = (games['result'] == 'win').values
+        games = games.assign(**columns)
+        footprint = pd.DataFrame({'before': before, 'after': games.memory_usage(deep = True)}).fillna(0).astype(np.int64)
+        self.footprint = footprint if self.footprint is None else self.footprint.add(footprint, fill_value = 0).astype(np.int64)
+        return games
+
+    def memory_footprint(self):
+        """
+        Returns the memory used by self.games, self.plays and the card dictionary self.cards
+
+        :return: bytes used by each column, indexed by ('games', 'plays' or 'cards', column)
+        :rtype: pandas series
+        """
+        return pd.concat([self.games.memory_usage(deep = True), self.plays.memory_usage(deep = True), self.cards.memory_usage(deep = True)], keys = ['games', 'plays', 'cards'])
 
     def _get_card_list(self, dict_list, player='me'):
         """
-        Internal method -- Returns the list of cards that were played in a game, called by _generate_cards_played
+        Internal method -- Returns the list of cards that were played in a game, use cards_played for every game at once
 
         Keyword parameters:
         dict_list -- list of dictionaries from the ['card_history'] column in self.games for one particular game
@@ -176,38 +953,283 @@ class yaha_analyzer(object):
         Returns:
         p_card_list -- array of card names (str)
         """
-        p_card_list = list(filter(None, map(lambda x: x['card']['name'] if x['player'] == player else None, dict_list)))
+        p_card_list = [play['card']['name'] for play in dict_list if play['player'] == player]
         return p_card_list
 
 
-    def _generate_cards_played(self):
-        """Internal method -- Generates a list of cards for player and opponent into the list ['p_cards_played'] and ['o_cards_played'], called by generate_decks"""
-        self.games['p_cards_played'] = self.games['card_history'].map(lambda x: self._get_card_list(x, player='me'))
-        self.games['o_cards_played'] = self.games['card_history'].map(lambda x: self._get_card_list(x, player='opponent'))
+    def _generate_plays(self):
+        """
+        Internal method -- Flattens the ['card_history'] column of self.games into self.plays and drops it, called by generate_decks
+        self.plays has one row per card played in the format ['game', 'player', 'turn', 'card', 'card_id', 'mana'], where ['game'] is the index of the game in self.games and ['card'] the card's id in self.cards
+        """
+        game, player, turn, card, card_id, mana = [], [], [], [], [], []
+        for game_id, card_history in zip(self.games.index, self.games['card_history']):
+            for play in card_history:
+                game.append(game_id)
+                player.append(play['player'])
+                turn.append(play['turn'])
+                card.append(play['card']['name'])
+                card_id.append(play['card']['id'])
+                mana.append(play['card']['mana'])
+        self.plays = self._plays_frame(game, player, turn, card, card_id, mana)
+        self.games = self.games.drop('card_history', axis=1)
+
+    def _plays_frame(self, game, player, turn, card, card_id, mana):
+        """Internal method -- Builds the plays dataframe with its compact dtypes out of one sequence per column, the card names are interned into self.cards"""
+        card_id = pd.Categorical(card_id)
+        mana = np.array(mana, dtype=np.float32)
+        return pd.DataFrame({
+            'game': np.array(game, dtype=np.int32),
+            'player': pd.Categorical(player, categories=['me', 'opponent']),
+            'turn': np.array(turn, dtype=np.int16),
+            'card': self._intern_cards(card, card_id, mana),
+            'card_id': card_id,
+            'mana': mana
+        }, columns=['game', 'player', 'turn', 'card', 'card_id', 'mana'])
+
+    def _intern_cards(self, card, card_id, mana):
+        """
+        Internal method -- Swaps the card names of some plays for their ids in self.cards, the card dictionary, adding the names it doesn't have yet with the card id and mana of their first play
+        The id of a card is its position in self.cards, every aggregate is keyed on these ids and the names are only looked up again by card_names when graphs are made
+
+        :param card: card name of each play
+        :param card_id: card id of each play
+        :param mana: mana cost of each play
+        :type card: sequence of strings or pandas categorical
+        :type card_id: pandas categorical or series
+        :type mana: numpy array or pandas series
+
+        :return: card id of each play, -1 where the name is missing
+        :rtype: numpy array of int16 (int32 once there are too many cards)
+        """
+        codes, names = pd.factorize(card)
+        ids = pd.Index(self.cards['name']).get_indexer(np.asarray(names, dtype=object))
+        new = np.flatnonzero(ids < 0)
+        if len(new):
+            first = pd.Series(codes).drop_duplicates()
+            first = first.index.values[pd.Index(first.values).get_indexer(new)] #position of the first play of each new name
+            ids[new] = np.arange(len(self.cards), len(self.cards) + len(new))
+            added = pd.DataFrame({
+                'name': np.asarray(names, dtype=object)[new],
+                'card_id': pd.Series(card_id).take(first).astype(object).values,
+                'mana': pd.Series(mana).take(first).astype(np.float32).values
+            }, columns=['name', 'card_id', 'mana'])
+            self.cards = pd.concat([self.cards, added]).set_axis(pd.RangeIndex(len(self.cards) + len(new), name='card'))
+        return np.where(codes >= 0, ids[np.maximum(codes, 0)], -1).astype(np.int16 if len(self.cards) < 2**15 else np.int32)
+
+    def card_names(self, cards):
+        """
+        Looks up the names of card ids from self.cards
 
-    def generate_matchups(self, game_mode = 'ranked', game_threshold = 0):
+        :param cards: card ids, e.g. the ['card'] level of generate_card_stats
+        :type cards: sequence of ints
+
+        :return: name of each card, None for the missing id -1
+        :rtype: numpy array of strings
         """
-        Generates a pandas groupby table with duration, count, coin, win #, win%, and card_history
+        cards = np.asarray(cards, dtype=np.int64)
+        return np.where(cards >= 0, self.cards['name'].values[cards], None)
+
+    def cards_played(self, games = None, turns = False, card_ids = False):
+        """
+        Returns the cards each player played in every game, split by player in one pass over self.plays, in place of the per game lists of the old ['p_cards_played'] and ['o_cards_played'] columns
+        The result for all of self.games is kept until the data changes, games_with_cards_played turns it back into the old columns
+
+        :param games: subset of self.games, all of them if None
+        :param turns: include the turn of every play
+        :param card_ids: include the card id of every play
+        :type games: pandas dataframe
+        :type turns: bool
+        :type card_ids: bool
+
+        :return: ragged arrays of the plays, row n is the game at position n in games
+        :rtype: CardsPlayed
+        """
+        version, cards_played = self._cards_played
+        everything = games is None
+        if everything and version == self._data_version and (cards_played.turns is not None or not turns) and (cards_played.card_ids is not None or not card_ids):
+            return cards_played
+        games = self.games if everything else games
+        game, me, card, turn = self._game_play_codes(games)
+        card_id = self.plays['card_id'].cat.codes.values[games.index.get_indexer(self.plays['game']) >= 0] if card_ids else None
+        cards_played = CardsPlayed(len(games), game, me, card, pd.Index(self.cards['name']), turn if turns else None, card_id, self.plays['card_id'].cat.categories if card_ids else None)
+        if everything:
+            self._cards_played = (self._data_version, cards_played)
+        return cards_played
+
+    def games_with_cards_played(self, games = None):
+        """
+        Returns a copy of the games with the ['p_cards_played'] and ['o_cards_played'] columns generate_decks used to add, lists of the card names each player played, rebuilt from cards_played
+
+        :param games: subset of self.games, all of them if None
+        :type games: pandas dataframe
+
+        :return: the games with the two list columns
+        :rtype: pandas dataframe
+        """
+        cards_played = self.cards_played(games)
+        games = (self.games if games is None else games).copy()
+        games['p_cards_played'] = pd.Series(cards_played.to_lists('me'), index = games.index, dtype = object)
+        games['o_cards_played'] = pd.Series(cards_played.to_lists('opponent'), index = games.index, dtype = object)
+        return games
+
+    def _game_play_codes(self, games):
+        """
+        Internal method -- Looks up the plays made in games as flat arrays, one entry per play
+
+        :param games: subset of self.games
+        :type games: pandas dataframe
+
+        :return: game, me, card, turn -- position of the play's game in games, whether it was played by 'me', id of the card in self.cards, and the turn it was played
+        :rtype: numpy array, numpy array, numpy array, numpy array
+        """
+        game = games.index.get_indexer(self.plays['game'])
+        found = game >= 0
+        me = (self.plays['player'] == 'me').values[found]
+        card = self.plays['card'].values[found]
+        turn = self.plays['turn'].values[found]
+        return game[found], me, card, turn
+
+    def _deck_codes(self, games):
+        """
+        Internal method -- Factorizes ['p_deck_type'] and ['o_deck_type'] of games against one shared, sorted list of deck types
+
+        :param games: subset of self.games
+        :type games: pandas dataframe
+
+        :return: p_deck, o_deck, decks -- codes of the player and opponent deck types of each game, and the deck types the codes point into
+        :rtype: numpy array, numpy array, pandas index
+        """
+        codes, decks = pd.factorize(np.concatenate([np.asarray(games['p_deck_type'], dtype=object), np.asarray(games['o_deck_type'], dtype=object)]), sort=True)
+        return codes[:len(games)], codes[len(games):], pd.Index(decks)
+
+    def _count_outcomes(self, keys, win):
+        """
+        Internal method -- Counts the wins and losses of every observed combination of keys, in one pass over their integer codes
+
+        :param keys: (name, codes, levels) for each level of the result's index, where codes are positions into levels and -1 is missing
+        :param win: whether each entry is counted as a win or a loss
+        :type keys: list of tuples
+        :type win: numpy array of bools
+
+        :return: counts indexed by the key names with columns ['win', 'loss']
+        :rtype: pandas dataframe
+        """
+        names = [key[0] for key in keys]
+        levels = [pd.Index(key[2]) for key in keys]
+        codes = [np.asarray(key[1], dtype=np.int64) for key in keys]
+        observed = np.logical_and.reduce([code >= 0 for code in codes])
+        codes = [code[observed] for code in codes]
+        shape = [max(len(level), 1) for level in levels]
+        combinations, inverse = np.unique(np.ravel_multi_index(codes, shape), return_inverse=True)
+        wins = np.bincount(inverse, weights=np.asarray(win)[observed], minlength=len(combinations)).astype(np.int64)
+        totals = np.bincount(inverse, minlength=len(combinations)).astype(np.int64)
+        index = pd.MultiIndex(levels=levels, codes=list(np.unravel_index(combinations, shape)), names=names)
+        if len(keys) == 1:
+            index = index.get_level_values(0)
+        return pd.DataFrame({'win': wins, 'loss': totals - wins}, index=index, columns=['win', 'loss']).sort_index()
+
+    def _card_history(self, games):
+        """
+        Internal method -- Rebuilds the original ['card_history'] list of dicts for each game out of self.plays
+
+        :param games: subset of self.games
+        :type games: pandas dataframe
+
+        :return: list of plays for each game, indexed the same as games
+        :rtype: pandas series
+        """
+        plays = self.plays[self.plays['game'].isin(games.index)]
+        history = dict((game_id, []) for game_id in games.index)
+        for game_id, player, turn, name, card_id, mana in zip(plays['game'], plays['player'], plays['turn'], self.card_names(plays['card']), plays['card_id'], plays['mana']):
+            history[game_id].append({'player': player, 'turn': int(turn), 'card': {'id': None if pd.isnull(card_id) else card_id, 'name': name, 'mana': None if np.isnan(mana) else int(mana)}})
+        return pd.Series([history[game_id] for game_id in games.index], index=games.index)
+
+    @_cached
+    def generate_matchups(self, game_mode = 'ranked', game_threshold = 0, card_history = False):
+        """
+        Generates a pandas groupby table with duration, count, coin, win #, win%, and optionally card_history
+        Results are cached by _cached, self.games isn't modified
 
         :param game_mode: the game mode, 'ranked', 'casual', or 'both
         :param game_threshold: the minimum amount of games the deck has to show up
+        :param card_history: also add a tuple of the card histories of each matchup's games, this is slow
         :type game_mode: string
         :type game_threshold: int
+        :type card_history: bool
 
         :return: grouped, indicies are player 'p_deck_type' then opponent 'o_deck_type'
         :rtype: pandas groupby
          """
+        return self._make_matchups(game_mode, game_threshold, card_history)
+
+    def _make_matchups(self, game_mode, game_threshold, card_history):
+        """Internal method -- Builds generate_matchups, counting games with the group sizes instead of adding columns to self.games"""
+        if self.aggregates is not None:
+            return self._stored_matchups(game_mode, game_threshold)
         decks = self.games
         if game_mode != 'both':
             decks = decks[decks['mode'] == game_mode]
-        decks.loc[:, 'win'] = decks['result'].map(lambda x: True if x == 'win' else False)
-        decks.loc[:, 'count'] = [1]*len(decks)
-
-        grouped = decks.groupby(['p_deck_type', 'o_deck_type']).agg({'coin': np.sum, 'duration': [np.mean, np.std], 'count': np.sum, 'win': np.sum, 'card_history': lambda x: tuple(x)})
+        keys = [decks['p_deck_type'].astype(object), decks['o_deck_type'].astype(object)]
+        groups = decks.groupby(keys)
+        columns = [groups['coin'].sum(), groups['duration'].mean(), groups['duration'].std(), groups.size(), (decks['result'] == 'win').groupby(keys).sum()]
+        names = [('coin', 'sum'), ('duration', 'mean'), ('duration', 'std'), ('count', 'sum'), ('win', 'sum')]
+        if card_history:
+            columns.append(self._card_history(decks).groupby(keys).agg(tuple))
+            names.append(('card_history', '<lambda>'))
+        grouped = pd.concat(columns, axis=1, keys=names)
         grouped['win%'] = grouped['win']['sum']/grouped['count']['sum']*100
         grouped = grouped[grouped['count']['sum'] > game_threshold]
         return grouped #note this returns a groupby, so a reset_index is necessary before pivoting/plotting
 
+    def _stored_matchups(self, game_mode, game_threshold):
+        """
+        Internal method -- generate_matchups built from the matchup counts in self.aggregates, card_history isn't kept in the aggregates so it's left out
+
+        :param game_mode: the game mode, 'ranked', 'casual', or 'both
+        :param game_threshold: the minimum amount of games the deck has to show up
+        :type game_mode: string
+        :type game_threshold: int
+
+        :return: grouped, indicies are player 'p_deck_type' then opponent 'o_deck_type'
+        :rtype: pandas dataframe
+        """
+        counts = self.aggregates['matchups']
+        if game_mode != 'both':
+            counts = counts[counts['mode'] == game_mode]
+        counts = counts.groupby(['p_deck_type', 'o_deck_type'])[['count', 'win', 'coin', 'duration', 'duration_sq', 'duration_count']].sum()
+        mean = counts['duration']/counts['duration_count']
+        variance = (counts['duration_sq'] - counts['duration']*mean)/(counts['duration_count'] - 1)
+        std = np.sqrt(variance.where(counts['duration_count'] > 1).clip(lower = 0))
+        grouped = pd.concat([counts['coin'], mean, std, counts['count'], counts['win']], axis=1, keys=[('coin', 'sum'), ('duration', 'mean'), ('duration', 'std'), ('count', 'sum'), ('win', 'sum')])
+        grouped['win%'] = grouped['win']['sum']/grouped['count']['sum']*100
+        grouped = grouped[grouped['count']['sum'] > game_threshold]
+        return grouped
+
+    def _count_matchups(self, games):
+        """
+        Internal method -- Sums up the games of every (mode, p_deck_type, o_deck_type), these partial counts can be added together and are what _stored_matchups is built from
+
+        :param games: subset of self.games
+        :type games: pandas dataframe
+
+        :return: counts with ['count', 'win', 'coin', 'duration', 'duration_sq', 'duration_count']
+        :rtype: pandas dataframe
+        """
+        duration = games['duration'].astype(np.float64)
+        decks = pd.DataFrame({
+            'mode': games['mode'].astype(object),
+            'p_deck_type': games['p_deck_type'].astype(object),
+            'o_deck_type': games['o_deck_type'].astype(object),
+            'count': 1,
+            'win': (games['result'] == 'win').astype(np.int64),
+            'coin': games['coin'].fillna(False).astype(np.int64),
+            'duration': duration,
+            'duration_sq': duration**2,
+            'duration_count': duration.notnull().astype(np.int64)
+        }, columns=['mode', 'p_deck_type', 'o_deck_type', 'count', 'win', 'coin', 'duration', 'duration_sq', 'duration_count'])
+        return decks.groupby(['mode', 'p_deck_type', 'o_deck_type']).sum()
+
 
     def generate_cards(self, filtered):
         """
@@ -216,23 +1238,66 @@ class yaha_analyzer(object):
         :param filtered: subset of self.games filtered
         :type filtered: pandas dataframe
 
-        :return: p_df, o_df -- cards marked as 'me' for player, index is the card name ['card'], columns are win count and loss count ['win', 'loss'], cards marked as 'opponent' for player, index is the card name ['card'], columns are win count and loss count ['win', 'loss']
+        :return: p_df, o_df -- cards marked as 'me' for player, index is the card id in self.cards ['card'], columns are win count and loss count ['win', 'loss'], cards marked as 'opponent' for player, index is the card id in self.cards ['card'], columns are win count and loss count ['win', 'loss']
         :rtype: pandas groupby, pandas groupby
         """
-        p_df = []
-        o_df = []
-        for r in zip(filtered['p_cards_played'], filtered['o_cards_played'], filtered['result']):
-            for p_card in r[0]:
-                p_df.append({'card': p_card, 'win': 1, 'loss': 0} if r[2] == 'win' else {'card': p_card, 'win': 0, 'loss': 1})
-            for o_card in r[1]:
-                o_df.append({'card': o_card, 'win': 1, 'loss': 0} if r[2] == 'loss' else {'card': o_card, 'win': 0, 'loss': 1})
-
-        p_df = pd.DataFrame(p_df)
-        o_df = pd.DataFrame(o_df)
-        p_df = p_df.groupby('card').agg(np.sum)
-        o_df = o_df.groupby('card').agg(np.sum)
+        game, me, card, turn = self._game_play_codes(filtered)
+        result = filtered['result'].values[game]
+        win = np.where(me, result == 'win', result == 'loss')
+        cards = self.cards.index
+        p_df = self._count_outcomes([('card', card[me], cards)], win[me])
+        o_df = self._count_outcomes([('card', card[~me], cards)], win[~me])
         return p_df, o_df
 
+    def _count_plays(self, games, by_mode = False):
+        """
+        Internal method -- Counts the wins and losses of the cards played in games, where a win is the game's result for 'me' regardless of who played the card
+        These partial counts can be added together, and are what generate_decklist_matchups and generate_card_stats are built from
+
+        :param games: subset of self.games
+        :param by_mode: split the counts by the game mode
+        :type games: pandas dataframe
+        :type by_mode: bool
+
+        :return: counts indexed by (['mode'],) ['player', 'card', 'p_deck_type', 'o_deck_type', 'turn'] with ['win', 'loss'], cards are ids in self.cards, deck types are the game's and aren't swapped for the opponent
+        :rtype: pandas dataframe
+        """
+        game, me, card, turn = self._game_play_codes(games)
+        p_deck, o_deck, decks = self._deck_codes(games)
+        turn, turns = pd.factorize(turn, sort=True)
+        keys = [
+            ('player', np.where(me, 0, 1), ['me', 'opponent']),
+            ('card', card, self.cards.index),
+            ('p_deck_type', p_deck[game], decks),
+            ('o_deck_type', o_deck[game], decks),
+            ('turn', turn, turns)
+        ]
+        if by_mode:
+            mode, modes = pd.factorize(np.asarray(games['mode'], dtype=object), sort=True)
+            keys.insert(0, ('mode', mode[game], modes))
+        return self._count_outcomes(keys, (games['result'] == 'win').values[game])
+
+    def _play_counts(self, game_mode):
+        """
+        Internal method -- The _count_plays of the games in game_mode, summed up from self.aggregates if the analyzer is working off the stored aggregates
+
+        :param game_mode: the game mode, 'ranked', 'casual', or 'both
+        :type game_mode: string
+
+        :return: counts indexed by ['player', 'card', 'p_deck_type', 'o_deck_type', 'turn'] with ['win', 'loss']
+        :rtype: pandas dataframe
+        """
+        if self.aggregates is not None:
+            counts = self.aggregates['plays']
+            if game_mode != 'both':
+                counts = counts[counts['mode'] == game_mode]
+            return counts.groupby(['player', 'card', 'p_deck_type', 'o_deck_type', 'turn'])[['win', 'loss']].sum()
+        gs = self.games
+        if game_mode != 'both':
+            gs = gs[gs['mode'] == game_mode]
+        return self._count_plays(gs)
+
+    @_cached
     def generate_decklist_matchups(self, game_mode = 'ranked', game_threshold = 2):
         """
         Generates a dataframe with a list of cards, and the matchups where the card won and lost in the format of: ['card', 'p_deck_type', 'winning_matchups', 'losing_matchups']
@@ -245,25 +1310,18 @@ class yaha_analyzer(object):
         :return: cards with ['card', 'p_deck_type', 'o_deck_type', 'loss', 'win', 'win%']
         :rtype: pandas groupby
         """
-        cards = []
-        gs = self.games
-        if game_mode != 'both':
-           gs = gs[gs['mode'] == game_mode]
-        for r in zip(gs['p_cards_played'], gs['result'], gs['p_deck_type'], gs['o_deck_type']):
-            for card in r[0]:
-                data = {'card': card, 'p_deck_type': r[2], 'o_deck_type': r[3], 'win': 1, 'loss': 0} if r[1] == 'win' else {'card': card, 'p_deck_type': r[2], 'o_deck_type': r[3], 'win': 0, 'loss': 1}
-                cards.append(data)
-        cards = pd.DataFrame(cards)
-        cards = cards.groupby(['card', 'p_deck_type', 'o_deck_type']).agg(np.sum)
+        counts = self._play_counts(game_mode).reset_index()
+        cards = counts[counts['player'] == 'me'].groupby(['card', 'p_deck_type', 'o_deck_type'])[['win', 'loss']].sum()
         cards = cards[(cards['win'] + cards['loss']) > game_threshold]
         cards.loc[:, 'win%'] = cards['win']/(cards['win'] + cards['loss'])
         cards['total_games'] = cards['win'] + cards['loss']
         return cards
 
 
+    @_cached
     def generate_card_stats(self, game_mode='ranked', game_threshold = 2):
         """
-        Returns a groupby object with ['card', 'p_deck_type', 'o_deck_type', 'turn', 'loss', 'win'] as [str, str, str, int, int, int]
+        Returns a groupby object with ['card', 'p_deck_type', 'o_deck_type', 'turn', 'loss', 'win'] as [int, str, str, int, int, int], where ['card'] is the card's id in self.cards
         :param game_mode: game type
         :param card_threshold: the minimum amount of time the card has to show up
         :type game_mode: str
@@ -272,34 +1330,18 @@ class yaha_analyzer(object):
         :return: cards
         :rtype: pandas groupby object
         """
-        cards = []
-        gs = self.games
-        if game_mode != 'both':
-            gs = gs[gs['mode'] == game_mode]
-
-        for r in zip(gs['card_history'], gs['result'], gs['p_deck_type'], gs['o_deck_type']):
-            for play in r[0]:
-                card = play['card']['name']
-                player = play['player']
-                turn = play['turn']
-                result = {'win': 1, 'loss': 0} if r[1] == 'win' else {'win': 0, 'loss': 1}
-                card_data = {'card': card,  'player': player, 'turn': turn}
-                player_data = {'p_deck_type': r[2], 'o_deck_type': r[3]} if player == 'me' else {'p_deck_type': r[3], 'o_deck_type': r[2]}
-                data = result.copy()
-                data.update(card_data)
-                data.update(player_data)
-                cards.append(data)
-
-        cards = pd.DataFrame(cards)
-        cards = cards.groupby(['card', 'p_deck_type', 'o_deck_type', 'turn']).agg(np.sum)
+        counts = self._play_counts(game_mode).reset_index()
+        me = counts['player'] == 'me'
+        counts['p_deck_type'], counts['o_deck_type'] = counts['p_deck_type'].where(me, counts['o_deck_type']), counts['o_deck_type'].where(me, counts['p_deck_type'])
+        cards = counts.groupby(['card', 'p_deck_type', 'o_deck_type', 'turn'])[['win', 'loss']].sum()
         cards = cards[cards['win'] + cards['loss'] > game_threshold]
         cards.loc[:, 'win%'] = cards['win']/(cards['win'] + cards['loss'])
         cards['total_games'] = cards['win'] + cards['loss']
         return cards
 
-    def create_heatmap(self, x, y, z, df, title, layout = None, text = None):
+    def create_heatmap(self, x, y, z, df, title, layout = None, text = None, compact = False, texttemplate = False):
         """
-        Creates a heatmap x, y, and z
+        Creates a heatmap x, y, and z, a ['card'] axis holds card ids which are shown by their names from self.cards
 
         :param x: name of the x value column
         :param y: name of the y value column
@@ -308,6 +1350,8 @@ class yaha_analyzer(object):
         :param title: heatmap title
         :param layout: dictionary for plotly layout. Autogenerated if None is passed
         :param text: column to be displayed for hover text
+        :param compact: if True, z is sent as a base64 float32 array
+        :param texttemplate: if True, the cell labels come from a texttemplate with a font color per cell instead of an annotation per cell, older plotly.js than 2.11 shows no labels
         :type x: string
         :type y: string
         :type z: string
@@ -315,45 +1359,35 @@ class yaha_analyzer(object):
         :type title: string
         :type layout: dictionary
         :type text: string
+        :type compact: boolean
+        :type texttemplate: boolean
 
         :return: one dictionary to be used with plotly.utils.PlotlyJSONEncoder
         :rtype: list
         """
         data = df.reset_index()
+        if 'card' in (x, y):
+            data['card'] = self.card_names(data['card'])
+        columns = [z, text] if text else [z]
+        x_vals, y_vals, grids = self._heatmap_grid(data, x, y, columns)
+        z_grid = grids[0]*100
         hover_text = []
         if text:
-            text = data[[x, y, text]]
-            text = text.pivot(x, y)
-            hover_text = [text[x].values.tolist() for x in text.columns]
-            for n, row in enumerate(hover_text):
-                for m, val in enumerate(row):
-                    hover_text[n][m] = 'Total Games: {}'.format(hover_text[n][m])
-        data = data[[x, y, z]]
-        data.loc[:, z] = data[z]*100
-        x_vals = sorted(data[x].unique())
-        y_vals = sorted(data[y].unique())
-        x_vals = list(map(lambda x: x.replace('_', ' '), x_vals))
-        y_vals = list(map(lambda x: x.replace('_', ' '), y_vals))
-        data = data.pivot(x, y)
-        z_vals = [data[x].values.tolist() for x in data.columns]
+            hover_text = np.char.add('Total Games: ', grids[1].astype(str)).tolist()
+        x_vals = np.char.replace(np.array(x_vals, dtype = str), '_', ' ').tolist()
+        y_vals = np.char.replace(np.array(y_vals, dtype = str), '_', ' ').tolist()
+        if compact:
+            z_vals = dict(dtype = 'f4', bdata = base64.b64encode(z_grid.astype('<f4').tobytes()).decode('ascii'), shape = '{}, {}'.format(*z_grid.shape))
+        else:
+            z_vals = z_grid.tolist()
         titles = self.title_format(x, y, z)
+        colors = np.where(z_grid > 70, 'white', 'black')
         if layout == None:
             annotations = []
-            for n, row in enumerate(z_vals):
-                for m, val in enumerate(row):
-                    var = z_vals[n][m]
-                    annotations.append(
-                        dict(
-                            text = '{:.2f}%'.format(val) if not pd.isnull(val) else '',
-                            x = x_vals[m],
-                            y = y_vals[n],
-                            showarrow = False,
-                            font = dict(
-                                color='white' if val > 70 else 'black',
-                                size = 8
-                            )
-                        )
-                    )
+            if not texttemplate:
+                labels = np.where(np.isnan(z_grid), '', np.char.mod('%.2f%%', z_grid)).ravel().tolist()
+                cells = zip(np.repeat(y_vals, len(x_vals)).tolist(), np.tile(x_vals, len(y_vals)).tolist(), labels, colors.ravel().tolist())
+                annotations = [dict(text = label, x = x_val, y = y_val, showarrow = False, font = dict(color = color, size = 8)) for y_val, x_val, label, color in cells]
 
             layout = dict(
                 margin = dict(
@@ -385,10 +1419,39 @@ class yaha_analyzer(object):
                 ],
                 layout = layout
             )
-
+        if texttemplate:
+            graphs['data'][0].update(texttemplate = '%{z:.2f}%', textfont = dict(size = 8, color = colors.tolist()))
 
         return graphs
 
+    def _heatmap_grid(self, data, x, y, columns):
+        """
+        Internal method -- Lays columns out on a grid with a row for every sorted y value and a column for every sorted x value, missing cells are nan
+
+        :param data: dataframe with one row per (x, y) pair
+        :param x: name of the x value column
+        :param y: name of the y value column
+        :param columns: names of the columns to lay out
+        :type data: pandas dataframe
+        :type x: string
+        :type y: string
+        :type columns: list
+
+        :return: x values, y values, and a numpy array per column
+        :rtype: (list, list, list)
+        """
+        x_codes, x_vals = pd.factorize(data[x], sort = True)
+        y_codes, y_vals = pd.factorize(data[y], sort = True)
+        shape = (len(y_vals), len(x_vals))
+        full = len(data) == shape[0]*shape[1]
+        grids = []
+        for column in columns:
+            values = data[column].values
+            grid = np.empty(shape, values.dtype) if full else np.full(shape, np.nan)
+            grid[y_codes, x_codes] = values
+            grids.append(grid)
+        return list(x_vals), list(y_vals), grids
+
     def create_stacked_chart(self, iter_column, x_col, y_col, df, layout = None):
         """
         Creates a stacked chart from a cards groupby object
@@ -430,7 +1493,7 @@ class yaha_analyzer(object):
         :type df: pandas dataframe
         :param card_name: the card name for the title
         :type card_name: string
-        :param level: the level of filtering, e.g. the stacks the histogram has
+        :param level: the level of filtering, e.g. the stacks the histogram has, 'card' stacks are named from self.cards
         :type level: string
 
         :return: one dictionary to be used with plotly.utils.PlotlyJSONEncoder
@@ -441,6 +1504,8 @@ class yaha_analyzer(object):
         traces = []
         for deck_type, new_df in stats.groupby(level=0):
             df = new_df.reset_index()
+            if level == 'card':
+                deck_type = self.card_names([deck_type])[0]
             trace = go.Bar(
                 x = df['turn'],
                 y = df[agg_level],
@@ -459,63 +1524,215 @@ class yaha_analyzer(object):
 
     def write_hdf5(self, hdf5_name):
         """
-        Writes out self.games into a hdf5_file
+        Writes out self.games and self.plays into a hdf5_file
 
         :param hdf5_name: name of the hdf5 file
         :type hdf5_name: string
         """
-        self.games.to_hdf('{}{}'.format(DATA_PATH, hdf5_name), 'table', append = False)
+        with HDFStore('{}{}'.format(DATA_PATH, hdf5_name), mode='w') as store:
+            self._append_data(store, self.games, self.plays)
 
+    def _append_data(self, store, games, plays):
+        """
+        Internal method -- Appends a chunk of games and plays to an open store from _open_store
+        ['win'] is left out and rebuilt by read_data, categorical columns are stored as strings and nullable ones as floats, read_data compacts them again
+        Cards are stored by name, so the file doesn't depend on the ids of self.cards. The chunk is cast to the dtypes the store already has, see _match_stored
+
+        :param store: store opened for writing
+        :param games: games to append
+        :param plays: plays of those games
+        :type store: ParquetStore or pandas HDFStore
+        :type games: pandas dataframe
+        :type plays: pandas dataframe
+        """
+        games = games.drop([column for column in ('win',) if column in games.columns], axis=1)
+        games = games.assign(**dict((column, games[column].astype(object if isinstance(games[column].dtype, pd.CategoricalDtype) else np.float64)) for column in games.columns if pd.api.types.is_extension_array_dtype(games[column].dtype)))
+        plays = plays.assign(card = self.card_names(plays['card']), **dict((column, plays[column].astype(object)) for column in ('player', 'card_id')))
+        games, plays = self._match_stored(store, 'games', games), self._match_stored(store, 'plays', plays)
+        if isinstance(store, ParquetStore):
+            store.append(games, plays)
+        else:
+            self._append_hdf5(store, games, plays)
 
-    def update_count(self, user_hash, total_items):
-        """Updates the given total items count for the user with user_hash"""
-        conn = sqlite3.connect('{}/users.db'.format(DATA_PATH))
-        c = conn.cursor()
-        c.execute('UPDATE users SET total_items = ?', (total_items,))
-        conn.commit()
-        conn.close()
+    def _match_stored(self, store, table, frame):
+        """
+        Internal method -- Casts the columns of a chunk to the dtypes the store already has for them, so every chunk is appended with the schema of the first one
+        String columns are left alone, they're stored as they are
+
+        :param store: store opened for writing
+        :param table: 'games' or 'plays'
+        :param frame: the chunk's rows of table, as _append_data stores them
+        :type store: ParquetStore or pandas HDFStore
+        :type table: string
+        :type frame: pandas dataframe
+
+        :return: the cast chunk
+        :rtype: pandas dataframe
+        """
+        if isinstance(store, ParquetStore):
+            stored = store.dtypes(table)
+        else:
+            key = {'games': 'table', 'plays': 'plays'}[table]
+            stored = store.select(key, start = 0, stop = 0).dtypes if '/{}'.format(key) in store.keys() else None
+        if stored is None:
+            return frame
+        return frame.astype(dict((column, dtype) for column, dtype in stored.items() if column in frame.columns and dtype != object and frame[column].dtype != dtype))
+
+    def _append_hdf5(self, store, games, plays):
+        """
+        Internal method -- Appends a chunk of games and plays to the 'table' and 'plays' tables of an open hdf5 store, called by _append_data
+
+        :param store: hdf5 store opened for writing
+        :param games: games to append, without ['win']
+        :param plays: plays of those games, without categorical columns
+        :type store: pandas HDFStore
+        :type games: pandas dataframe
+        :type plays: pandas dataframe
+        """
+        if 'note' in games.columns:
+            games = games.assign(note = games['note'].map(lambda x: x[:HDF_MIN_ITEMSIZE] if isinstance(x, str) else x))
+        games, plays = games.copy(), plays.copy() #consolidates the columns into one block per dtype, the layout hdf5 matches an append against
+        store.append('table', games, min_itemsize = {'values': HDF_MIN_ITEMSIZE}, index = False)
+        store.append('plays', plays, min_itemsize = {'values': HDF_MIN_ITEMSIZE}, index = False)
+
+    def update_count(self, user_hash, total_items, last_game_id = None, row_count = None, content_hash = None):
+        """
+        Updates the given total items count for the user with user_hash, along with the sync state pull_data uses to find what's new
+
+        :param user_hash: the user's hash from store_data
+        :param total_items: track-o-bot's count of the user's games
+        :param last_game_id: id of the newest stored game, unchanged if None
+        :param row_count: games in the user's hdf5 file, unchanged if None
+        :param content_hash: sha1 of the user's json file, unchanged if None
+        :type user_hash: string
+        :type total_items: int
+        :type last_game_id: int
+        :type row_count: int
+        :type content_hash: string
+        """
+        conn = self._user_connection()
+        with conn:
+            conn.execute('UPDATE users SET total_items = ?, last_game_id = coalesce(?, last_game_id), row_count = coalesce(?, row_count), content_hash = coalesce(?, content_hash), synced = ? WHERE user_hash = ?',
+                         (total_items, last_game_id, row_count, content_hash, time.time(), user_hash))
 
     def store_data(self):
         """
         Stores the python data by using the filename as the sha5 hash of the username and api_key -> hash is stored in a database for lookups later, data is stored using the hdf5 format
-        Table is in the format of ['user_hash', 'total_items', 'json_name', 'hdf5_name']
-
+        Table is in the format of USER_COLUMNS, a new user is added with a count of 0
 
-        :return: total items, json_name, and hdf5_name
-        :rtype: [int, string, string]
+        :return: the user's row
+        :rtype: dictionary of USER_COLUMNS
         """
         user_hash = hashlib.sha1(('{}{}'.format(self.username, self.api_key)).encode()).hexdigest()
-        conn = sqlite3.connect('{}/users.db'.format(DATA_PATH)) #TODO FIX THIS
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE user_hash = ?', (user_hash,))
-        data = c.fetchall()
-        if len(data) != 0:
-            user = data[0]
-        else:
-            user = (user_hash, 0, '{}_j.json'.format(user_hash), '{}_h.hdf5'.format(user_hash))
-            c.execute('INSERT INTO users VALUES (?, ?, ?, ?)', user)
-        conn.commit()
-        conn.close()
-        return user[0], user[1], user[2], user[3]
+        conn = self._user_connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO users (user_hash, total_items, json_name, hdf5_name) VALUES (?, 0, ?, ?)', (user_hash, '{}_j.json'.format(user_hash), '{}_h.hdf5'.format(user_hash)))
+        user = conn.execute('SELECT {} FROM users WHERE user_hash = ?'.format(', '.join(column for column, _ in USER_COLUMNS)), (user_hash,)).fetchone()
+        return dict(zip([column for column, _ in USER_COLUMNS], user))
 
-    def read_data(self, json_name = None, hdf5_name = None):
+    def _user_connection(self):
+        """
+        Internal method -- Returns this thread's connection to the users database under DATA_PATH, it's opened on first use and kept open
+        Creates the users table if it's missing. Tables from before the sync state was kept get the new columns and a unique index on user_hash, keeping the newest row of any duplicate users
+
+        :return: connection to users.db
+        :rtype: sqlite3 connection
+        """
+        path = '{}/users.db'.format(DATA_PATH)
+        connections = _user_connections.__dict__.setdefault('connections', {})
+        if path not in connections:
+            conn = sqlite3.connect(path)
+            conn.execute('CREATE TABLE IF NOT EXISTS users ({})'.format(', '.join('{} {}'.format(*column) for column in USER_COLUMNS)))
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+            for column, column_type in USER_COLUMNS:
+                if column not in columns:
+                    conn.execute('ALTER TABLE users ADD COLUMN {} {}'.format(column, column_type))
+            if not any(row[2] for row in conn.execute('PRAGMA index_list(users)')): #no unique index, a table from before user_hash was the primary key
+                conn.execute('DELETE FROM users WHERE rowid NOT IN (SELECT max(rowid) FROM users GROUP BY user_hash)')
+                conn.execute('CREATE UNIQUE INDEX users_user_hash ON users (user_hash)')
+            conn.commit()
+            connections[path] = conn
+        return connections[path]
+
+    def read_data(self, json_name = None, hdf5_name = None, columns = None, modes = None, start_date = None, end_date = None):
         """
         Takes the names of the files and loads them into memory for processing
+        hdf5_name can also be a ParquetStore directory, which only reads the columns and games asked for from disk, a hdf5 file is read whole and filtered afterwards
 
-        :param hdf5_name: name of the hdf5 file
+        :param hdf5_name: name of the hdf5 file or parquet directory
         :type hdf5_name: string
         :param json_name: name of the json file
         :type json_name: string
+        :param columns: columns of the games to load, all of them if None
+        :type columns: list
+        :param modes: game modes to load, all of them if None
+        :type modes: list
+        :param start_date: first day of games to load, formatted in the manner YY-mm-dd
+        :type start_date: string
+        :param end_date: last day of games to load, formatted in the manner YY-mm-dd
+        :type end_date: string
 
         :return: complete history of games and metadata
         :rtype: dictionary
         """
         if json_name:
-            with open("{}{}".format(DATA_PATH, json_name)) as json_data:
+            with open("{}{}".format(DATA_PATH, json_name)) as json_data, profiling.stage('json_parse') as stage:
                 results = json.load(json_data)
                 self.history = results
+                stage.add(rows = len(results.get('children', [])), nbytes = json_data.tell())
         if hdf5_name:
-            self.games = pd.read_hdf('{}{}'.format(DATA_PATH, hdf5_name), 'table')
+            self.aggregates = None
+            self.footprint = None
+            self.cards = _empty_cards()
+            path = '{}{}'.format(DATA_PATH, hdf5_name)
+            filters = self._data_filters(modes, start_date, end_date)
+            with profiling.stage('read') as stage:
+                if os.path.isdir(path):
+                    store = ParquetStore(path, mode = 'r')
+                    self.games = store.read('games', None if columns is None else ['game'] + list(columns), filters).set_index('game')
+                    self.games.index.name = None
+                    plays_filter = [('game', '>=', self.games.index.min()), ('game', '<', self.games.index.max() + 1)] if filters and len(self.games) else None
+                    self.plays = store.read('plays', filters = plays_filter)
+                else:
+                    with HDFStore(path, mode='r') as store:
+                        self.games = store['table']
+                        if '/plays' in store.keys():
+                            self.plays = store['plays'].reset_index(drop = True)
+                    if filters:
+                        self.games = self.games[np.logical_and.reduce([_filter_ops[op](self.games[column], value) for column, op, value in filters])]
+                    if columns is not None:
+                        self.games = self.games[[column for column in self.games.columns if column in columns or column == 'card_history']]
+                stage.add(rows = len(self.games), nbytes = int(self.games.memory_usage().sum()))
+            with profiling.stage('card_extraction') as stage:
+                if 'card_history' in self.games.columns: #written before self.plays existed
+                    self._generate_plays()
+                if filters:
+                    self.plays = self.plays[self.plays['game'].isin(self.games.index)].reset_index(drop = True)
+                if not pd.api.types.is_integer_dtype(self.plays['card'].dtype): #not interned by _generate_plays
+                    self.plays['card'] = self._intern_cards(self.plays['card'], self.plays['card_id'], self.plays['mana'])
+                for column in ('player', 'card_id'):
+                    self.plays[column] = self.plays[column].astype('category')
+                self.games = self.games.drop([column for column in ('p_cards_played', 'o_cards_played') if column in self.games.columns], axis=1) #list columns of older files, see cards_played
+                stage.add(rows = len(self.plays))
+            with profiling.stage('compact'):
+                self.games = self._compact_games(self.games)
+            self._set_source('file', path, self._file_stamp(path), columns, filters)
+
+    def _data_filters(self, modes = None, start_date = None, end_date = None):
+        """
+        Internal method -- Turns the game filters of read_data into (column, op, value) predicates on ['mode'] and ['added']
+
+        :return: predicates that are all true for the games to load, empty if every game is loaded
+        :rtype: list of tuples
+        """
+        filters = []
+        if modes is not None:
+            filters.append(('mode', 'in', list(modes)))
+        if start_date is not None:
+            filters.append(('added', '>=', pd.Timestamp(start_date).strftime('%Y-%m-%d')))
+        if end_date is not None:
+            filters.append(('added', '<', (pd.Timestamp(end_date) + pd.Timedelta(days = 1)).strftime('%Y-%m-%d')))
+        return filters
 
     def check_data(self, json_name, hdf5_name):
         """
@@ -558,11 +1775,16 @@ class yaha_analyzer(object):
     def get_name_list(self):
         """
         Iterates through the database and creates a list of strings for deck names and card names
+        The lists are cached in memory until make_graph_data bumps the graph database's version
 
         :return: list of deck and card names
         :rtype: (list, list)
         """
-        conn = sqlite3.connect(GRAPH_DATABASE)
+        conn = self._pooled_graph_connection()
+        version = self._graph_version(conn)
+        names = _graph_cache['names']
+        if names is not None:
+            return names
         c = conn.cursor()
         c.execute('SELECT name, type FROM graphs')
         data = c.fetchall()
@@ -573,83 +1795,477 @@ class yaha_analyzer(object):
                 deck_data.append(row[0].replace('_', ' '))
             elif row[1] == 'card':
                 card_data.append(row[0])
-        conn.close()
+        with _graph_cache['lock']:
+            if _graph_cache['version'] == version:
+                _graph_cache['names'] = (deck_data, card_data)
         return deck_data, card_data
 
-    def make_graph_data(self): #TODO: multithread this at some point
+    def make_graph_data(self, workers = GRAPH_WORKERS, batch_size = GRAPH_BATCH_SIZE, progress = None):
         """
         Iterates through all the cards & decks above the game threshold, makes plotly json for each one
+        The deck and card lists are split into shards of batch_size which are built by a pool of worker processes, each worker gets the aggregates once when it starts
+        The graphs are written into a staging table that replaces the graphs table in one transaction at the end, so readers see either the old or the new set of graphs, never a mix
+
+        :param workers: number of processes building graphs, 1 builds them in this process
+        :param batch_size: number of graphs in each shard, each shard is written to the database in one go
+        :param progress: called with the fraction of shards written after each shard
+        :type workers: int
+        :type batch_size: int
+        :type progress: function
         """
         game_threshold = 5
+        with profiling.stage('groupby') as stage:
+            decks = list(map(lambda x: x.replace(' ', '_'), self._unique_decks()))
+            decklists = self.generate_decklist_matchups(game_threshold = game_threshold).reset_index()
+            cards = self._unique_cards(formatted = False)
+            card_stats = self.generate_card_stats(game_threshold = game_threshold)
+            stage.add(rows = len(decklists) + len(card_stats))
+        with profiling.stage('views'):
+            views = self._graph_views(decklists, card_stats)
+        shards = [('deck', decks[n:n + batch_size]) for n in range(0, len(decks), batch_size)]
+        shards.extend(('card', cards[n:n + batch_size]) for n in range(0, len(cards), batch_size))
+        self._create_graph_staging()
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers = workers, initializer = _init_graph_worker, initargs = (views, self.cards)) as pool:
+                self._write_graph_shards(pool.map(_make_graph_shard, shards), len(shards), progress)
+        else:
+            self._write_graph_shards((self._make_graph_shard(shard, views) for shard in shards), len(shards), progress)
+        with profiling.stage('swap'):
+            self._swap_graph_table()
+
+    def _graph_views(self, decklists, card_stats):
+        """
+        Internal method -- Splits the aggregates make_graph_data works from into per deck and per card frames, so every graph starts from its own slice instead of filtering the whole frame
+        The turn-collapsed heatmap data and the per deck type histogram sums of the cards are computed once for all the cards here
+
+        :param decklists: generate_decklist_matchups with the index reset
+        :param card_stats: generate_card_stats
+        :type decklists: pandas dataframe
+        :type card_stats: pandas dataframe
+
+        :return: {'deck': {deck: decklist rows}, 'card': {card id: {'heatmap': ..., 'p_deck_type': ..., 'o_deck_type': ...}}, 'empty': empty decklist}
+        :rtype: dictionary
+        """
+        views = {'deck': dict((deck, d_data) for deck, d_data in decklists.groupby('p_deck_type')), 'card': {}, 'empty': decklists.iloc[:0]}
+        heatmaps = card_stats.groupby(level=['card', 'p_deck_type', 'o_deck_type']).sum()
+        heatmaps.loc[:, 'win%'] = heatmaps['win']/(heatmaps['loss'] + heatmaps['win'])
+        histograms = dict((level, card_stats.groupby(level=['card', level, 'turn']).sum()) for level in ('p_deck_type', 'o_deck_type'))
+        for frame_name, frame in [('heatmap', heatmaps)] + list(histograms.items()):
+            for card, card_data in frame.groupby(level='card'):
+                views['card'].setdefault(card, {})[frame_name] = card_data.reset_index(level='card', drop=True)
+        return views
+
+    def _make_graph_shard(self, shard, views):
+        """
+        Internal method -- Makes the plotly json for one shard of make_graph_data
+
+        :param shard: graph type ('deck' or 'card') and the deck names or card ids to make graphs for
+        :param views: _graph_views
+        :type shard: (string, list)
+        :type views: dictionary
+
+        :return: graph type, and (name, graph json) for each deck or card
+        :rtype: (string, list of tuples)
+        """
+        graph_type, names = shard
+        with profiling.stage('plotly') as stage:
+            if graph_type == 'deck':
+                graphs = [(deck, self._make_deck_graph(deck, views['deck'].get(deck, views['empty']))) for deck in names]
+            else:
+                graphs = [(name, self._make_card_graph(name, views['card'][card])) for card, name in zip(names, self.card_names(names))]
+            stage.add(rows = len(graphs), nbytes = sum(len(graph_json) for name, graph_json in graphs))
+        return graph_type, graphs
+
+    def _write_graph_shards(self, shards, total = None, progress = None):
+        """
+        Internal method -- Numbers the graphs of each shard in order and writes every shard to the staging table as one batch
+
+        :param shards: results of _make_graph_shard
+        :param total: number of shards, for progress
+        :param progress: called with the fraction of shards written after each shard
+        :type shards: iterable of (string, list of tuples)
+        :type total: int
+        :type progress: function
+        """
         graph_id = 0
-        sql_data = []
-        decks = map(lambda x: x.replace(' ', '_'), self._unique_decks())
-        data = self.generate_decklist_matchups(game_threshold = game_threshold).reset_index()
-        for deck in decks:
-            d_data = data[data['p_deck_type'] == deck]
-            graphs = self.create_heatmap(x = 'o_deck_type', y = 'card', z = 'win%', df = d_data, title = 'Win % of Cards in {}'.format(deck), text='total_games')
-            graph_json = json.dumps([graphs], cls=plotly.utils.PlotlyJSONEncoder)
-            sql_data.append((graph_id, deck, graph_json, 'deck'))
-            graph_id += 1
-        self._update_graph_data(sql_data)
-
-        sql_data = []
-        cards = self._unique_cards()
-        data = self.generate_card_stats(game_threshold = game_threshold)
-        for card in cards:
-            h_data = data.sum(level=['card', 'p_deck_type', 'o_deck_type']).loc[card]
-            h_data.loc[:, 'win%'] = h_data['win']/(h_data['loss'] + h_data['win'])
-            heatmap = self.create_heatmap(x = 'o_deck_type', y = 'p_deck_type',z = 'win%', df = h_data, title = 'Win % of {}'.format(card), text='total_games')
-            distplot_with_win = self.create_stacked_histogram(df = data.loc[card], title='Win Counts With {} in Decks'.format(card))
-            distplot_against_win = self.create_stacked_histogram(df = data.loc[card], title = 'Win Counts With {} Against Decks'.format(card), level='o_deck_type')
-            distplot_with_lose = self.create_stacked_histogram(df = data.loc[card], title='Lose Counts With {} in Decks'.format(card), agg_level='loss')
-            distplot_against_lose = self.create_stacked_histogram(df = data.loc[card], title='Lose Counts With {} Against Decks'.format(card), level='o_deck_type', agg_level='loss')
-            graph_json = json.dumps([heatmap, distplot_with_win, distplot_against_win, distplot_with_lose, distplot_against_lose], cls=plotly.utils.PlotlyJSONEncoder)
-            graph_name = card
-            sql_data.append((graph_id, card, graph_json, 'card'))
-            graph_id += 1
-        self._update_graph_data(sql_data)
-
-    def _update_graph_data(self, graph_sql):
-        """
-        Updates the graph database, if the row doesn't already exist, then insert
-        :param: graph_sql -- list of tuples in the fasion (graph_id, graph_name, graph_json, graph_type)
+        for written, (graph_type, graphs) in enumerate(shards, 1):
+            sql_data = []
+            for name, graph_json in graphs:
+                sql_data.append((graph_id, name, graph_json, graph_type))
+                graph_id += 1
+            self._update_graph_data(sql_data, table = 'graphs_staging')
+            if progress:
+                progress(written/total)
+
+    def _make_deck_graph(self, deck, d_data):
+        """
+        Internal method -- Makes the card heatmap of a deck
+
+        :param deck: deck type
+        :param d_data: the deck's rows of generate_decklist_matchups, with the index reset
+        :type deck: string
+        :type d_data: pandas dataframe
+
+        :return: plotly json
+        :rtype: string
+        """
+        graphs = self.create_heatmap(x = 'o_deck_type', y = 'card', z = 'win%', df = d_data, title = 'Win % of Cards in {}'.format(deck), text='total_games', compact = GRAPH_COMPACT, texttemplate = GRAPH_TEXTTEMPLATE)
+        return json.dumps([graphs], cls=plotly.utils.PlotlyJSONEncoder)
+
+    def _make_card_graph(self, card, view):
+        """
+        Internal method -- Makes the deck heatmap and the four win/loss histograms of a card
+
+        :param card: card name
+        :param view: the card's frames from _graph_views
+        :type card: string
+        :type view: dictionary
+
+        :return: plotly json
+        :rtype: string
+        """
+        heatmap = self.create_heatmap(x = 'o_deck_type', y = 'p_deck_type',z = 'win%', df = view['heatmap'], title = 'Win % of {}'.format(card), text='total_games', compact = GRAPH_COMPACT, texttemplate = GRAPH_TEXTTEMPLATE)
+        distplot_with_win = self.create_stacked_histogram(df = view['p_deck_type'], title='Win Counts With {} in Decks'.format(card))
+        distplot_against_win = self.create_stacked_histogram(df = view['o_deck_type'], title = 'Win Counts With {} Against Decks'.format(card), level='o_deck_type')
+        distplot_with_lose = self.create_stacked_histogram(df = view['p_deck_type'], title='Lose Counts With {} in Decks'.format(card), agg_level='loss')
+        distplot_against_lose = self.create_stacked_histogram(df = view['o_deck_type'], title='Lose Counts With {} Against Decks'.format(card), level='o_deck_type', agg_level='loss')
+        return json.dumps([heatmap, distplot_with_win, distplot_against_win, distplot_with_lose, distplot_against_lose], cls=plotly.utils.PlotlyJSONEncoder)
+
+    def _connect_graph_database(self):
+        """
+        Internal method -- Connects to GRAPH_DATABASE in WAL mode, so the web app can keep reading while a rebuild writes
+        Creates the graphs table and its unique (name, type) index if they're missing, dropping older duplicate rows before the index is made, and adds the compressed columns to older tables
+
+        :return: connection to the graph database
+        :rtype: sqlite3 connection
         """
         conn = sqlite3.connect(GRAPH_DATABASE)
-        c = conn.cursor()
-        for graph_id, graph_name, graph_json, graph_type in graph_sql:
-            exists = c.execute('SELECT id FROM graphs WHERE name = ? AND type = ?', (graph_name, graph_type))
-            if exists:
-                c.execute('UPDATE graphs SET name = ?, json = ?, type = ? WHERE name = ? AND type = ?', (graph_name, graph_json, graph_type, graph_name, graph_type))
-            else:
-                c.execute('INSERT INTO graphs VALUES(?, ?, ?, ?)', (graph_id, graph_name, graph_json, graph_type))
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(_GRAPH_TABLE.format('graphs'))
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(graphs)')]
+        for column, column_type in (('gzip', 'BLOB'), ('br', 'BLOB'), ('etag', 'TEXT')):
+            if column not in columns:
+                conn.execute('ALTER TABLE graphs ADD COLUMN {} {}'.format(column, column_type))
+        if conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'graphs_name_type'").fetchone() is None:
+            conn.execute('DELETE FROM graphs WHERE rowid NOT IN (SELECT max(rowid) FROM graphs GROUP BY name, type)')
+            conn.execute('CREATE UNIQUE INDEX graphs_name_type ON graphs (name, type)')
+        conn.commit()
+        return conn
+
+    def _update_graph_data(self, graph_sql, table = 'graphs'):
+        """
+        Upserts a batch of graphs into the graph database in one transaction, rows that already exist for (graph_name, graph_type) get the new json and keep their id
+        The json is stored along with its gzip (and brotli, if installed) compressed bytes and an etag, see _compress_graph
+        Writes to the graphs table bump the version stamp in the same transaction, so every process drops the graphs and names it has cached
+        :param: graph_sql -- list of tuples in the fasion (graph_id, graph_name, graph_json, graph_type)
+        :param: table -- 'graphs', or 'graphs_staging' while make_graph_data is writing a new set of graphs
+        """
+        with profiling.stage('compress') as stage:
+            rows = [(graph_id, graph_name, graph_json, graph_type) + self._compress_graph(graph_json) for graph_id, graph_name, graph_json, graph_type in graph_sql]
+            stage.add(rows = len(rows), nbytes = sum(len(row[4]) for row in rows))
+        with profiling.stage('sqlite_write') as stage:
+            conn = self._connect_graph_database()
+            with conn:
+                conn.executemany('INSERT INTO {} (id, name, json, type, gzip, br, etag) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name, type) DO UPDATE SET json = excluded.json, gzip = excluded.gzip, br = excluded.br, etag = excluded.etag'.format(table), rows)
+                if table == 'graphs':
+                    conn.execute('PRAGMA user_version = {}'.format(conn.execute('PRAGMA user_version').fetchone()[0] + 1))
+            conn.close()
+            stage.add(rows = len(rows), nbytes = sum(len(row[2]) + len(row[4]) + len(row[5] or b'') for row in rows))
+
+    def _create_graph_staging(self):
+        """Internal method -- Makes an empty graphs_staging table for make_graph_data to write into, dropping whatever an interrupted run left behind"""
+        conn = self._connect_graph_database()
+        conn.execute('DROP TABLE IF EXISTS graphs_staging')
+        conn.execute(_GRAPH_TABLE.format('graphs_staging'))
+        conn.execute('CREATE UNIQUE INDEX graphs_staging_name_type ON graphs_staging (name, type)')
         conn.commit()
         conn.close()
 
-    def get_graph_data(self, name):
+    def _swap_graph_table(self):
+        """Internal method -- Replaces the graphs table with graphs_staging and bumps the version stamp in a single transaction, so readers go straight from the old graphs to the new ones"""
+        conn = self._connect_graph_database()
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            conn.execute('DROP TABLE graphs')
+            conn.execute('DROP INDEX graphs_staging_name_type')
+            conn.execute('ALTER TABLE graphs_staging RENAME TO graphs')
+            conn.execute('CREATE UNIQUE INDEX graphs_name_type ON graphs (name, type)')
+            conn.execute('PRAGMA user_version = {}'.format(version + 1))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _compress_graph(self, graph_json):
+        """
+        Internal method -- Precompresses graph json so it can be sent as is with a Content-Encoding
+
+        :param graph_json: plotly json
+        :type graph_json: string
+
+        :return: gzip bytes, brotli bytes (None if brotli isn't installed), and a content hash to use as the etag
+        :rtype: (bytes, bytes, string)
+        """
+        data = graph_json.encode('utf-8')
+        br_data = brotli.compress(data) if brotli else None
+        return gzip.compress(data, 9, mtime = 0), br_data, hashlib.sha1(data).hexdigest()
+
+    def get_graph_data(self, name, graph_type = None):
         """
         Returns plotly json for the specified name
+        Graphs are kept in an in-memory LRU cache of GRAPH_CACHE_SIZE entries until make_graph_data bumps the graph database's version
 
         :param name: name to match in the database
+        :param graph_type: 'deck' or 'card', any type matches if None
         :type name: string
+        :type graph_type: string
 
         :return: plotly json data
         :rtype: string
         """
-        conn = sqlite3.connect(GRAPH_DATABASE)
+        return self.get_graph_file(name, graph_type)[0]
+
+    def get_graph_file(self, name, graph_type = None):
+        """
+        Returns plotly json for the specified name along with its precompressed forms and etag, shares the cache of get_graph_data
+
+        :param name: name to match in the database
+        :param graph_type: 'deck' or 'card', any type matches if None
+        :type name: string
+        :type graph_type: string
+
+        :return: json, gzip bytes, brotli bytes (None if they weren't stored), etag
+        :rtype: (string, bytes, bytes, string)
+        """
+        conn = self._pooled_graph_connection()
+        version = self._graph_version(conn)
+        graphs = _graph_cache['graphs']
+        with _graph_cache['lock']:
+            if (name, graph_type) in graphs:
+                graphs.move_to_end((name, graph_type))
+                return graphs[(name, graph_type)]
         c = conn.cursor()
-        c.execute('SELECT json FROM graphs WHERE name = ?', (name,))
+        if graph_type:
+            c.execute('SELECT json, gzip, br, etag FROM graphs WHERE name = ? AND type = ?', (name, graph_type))
+        else:
+            c.execute('SELECT json, gzip, br, etag FROM graphs WHERE name = ?', (name,))
         data = c.fetchall()
-        data = data[0][0]
-        conn.close()
+        data = data[0]
+        if data[1] is None: #written before the compressed columns existed
+            data = (data[0],) + self._compress_graph(data[0])
+        with _graph_cache['lock']:
+            if _graph_cache['version'] == version:
+                graphs[(name, graph_type)] = data
+                if len(graphs) > GRAPH_CACHE_SIZE:
+                    graphs.popitem(last = False)
         return data
 
-    def rebuild_and_update(self):
-        """Pull collectobot data and remake the graphs"""
-        self.generate_collectobot_data()
-        self.make_graph_data()
+    def _pooled_graph_connection(self):
+        """
+        Internal method -- Returns this thread's connection to GRAPH_DATABASE, it's opened on first use and kept open for the life of the worker
+
+        :return: connection to the graph database
+        :rtype: sqlite3 connection
+        """
+        connections = _graph_connections.__dict__.setdefault('connections', {})
+        if GRAPH_DATABASE not in connections:
+            connections[GRAPH_DATABASE] = self._connect_graph_database()
+        return connections[GRAPH_DATABASE]
+
+    def _graph_version(self, conn):
+        """
+        Internal method -- Reads the version stamp of the graph database, emptying the in-memory graph caches if it changed since they were filled
 
-    def remake_graphs(self):
-        """Remake the graphs"""
-        self.open_collectobot_data()
-        self.make_graph_data()
+        :param conn: connection to the graph database
+        :type conn: sqlite3 connection
+
+        :return: the database and its version
+        :rtype: (string, int)
+        """
+        version = (GRAPH_DATABASE, conn.execute('PRAGMA user_version').fetchone()[0])
+        with _graph_cache['lock']:
+            if _graph_cache['version'] != version:
+                _graph_cache['version'] = version
+                _graph_cache['graphs'].clear()
+                _graph_cache['names'] = None
+        return version
+
+    def update_aggregates(self, rebuild = False):
+        """
+        Parses only the collect-o-bot days added since the last update and merges their win/loss counts into the partial aggregates in AGGREGATE_DATABASE, appending their games to the STORAGE_BACKEND file
+        The high water mark is the id of the last collectobot row merged, it's committed together with that day's counts and the number of rows in the store so an interrupted update picks up where it stopped, dropping the games of a day it wrote but didn't commit
+        The counts are keyed on card ids, the card dictionary is kept in the cards table and new cards are added to it along with the counts, so the ids stay the same from one update to the next
+        Afterwards the analyzer works off the stored aggregates (self.aggregates) and card dictionary (self.cards) instead of self.games
+
+        :param rebuild: throw away the stored aggregates and start over from the first day
+        :type rebuild: bool
+
+        :return: number of days merged
+        :rtype: int
+        """
+        conn = sqlite3.connect(AGGREGATE_DATABASE)
+        c = conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS cards ({})'.format(', '.join('{} {}'.format(*column) for column in CARD_COLUMNS)))
+        if 'TEXT' in [row[2] for row in c.execute('PRAGMA table_info(play_counts)') if row[1] == 'card']: #counts from before cards were interned
+            self._intern_play_counts(c)
+        c.execute(_PLAY_COUNTS_TABLE)
+        c.execute('CREATE TABLE IF NOT EXISTS matchup_counts (mode TEXT, p_deck_type TEXT, o_deck_type TEXT, count INTEGER, win INTEGER, coin INTEGER, duration REAL, duration_sq REAL, duration_count INTEGER, PRIMARY KEY (mode, p_deck_type, o_deck_type))')
+        c.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        if rebuild:
+            c.execute('DELETE FROM play_counts')
+            c.execute('DELETE FROM matchup_counts')
+            c.execute('DELETE FROM cards')
+            c.execute('DELETE FROM meta')
+        conn.commit()
+        meta = dict(c.execute('SELECT key, value FROM meta').fetchall())
+        next_game = meta.get('next_game', 0)
+        days = 0
+        self.cards = pd.read_sql_query('SELECT card, name, card_id, mana FROM cards ORDER BY card', conn, index_col = 'card').astype({'name': object, 'card_id': object, 'mana': np.float32})
+        with self._open_store('a' if 'high_water_mark' in meta else 'w') as store:
+            if 'stored_games' in meta:
+                self._truncate_store(store, meta['stored_games'], meta['stored_plays'])
+            for day_id, day in collectobot.iter_frames(after_id = meta.get('high_water_mark', -1)):
+                known = len(self.cards)
+                for games, plays in self._iter_decks([day], dates = False, offset = next_game):
+                    with profiling.stage('store_write') as stage:
+                        self._append_data(store, games, plays)
+                        stage.add(rows = len(games) + len(plays))
+                    with profiling.stage('groupby') as stage:
+                        play_counts, matchup_counts = self._count_plays(games, by_mode = True), self._count_matchups(games)
+                        stage.add(rows = len(play_counts) + len(matchup_counts))
+                    with profiling.stage('sqlite_write') as stage:
+                        self._merge_counts(c, play_counts, matchup_counts)
+                        stage.add(rows = len(play_counts) + len(matchup_counts))
+                next_game += len(day[0])
+                with profiling.stage('sqlite_write'):
+                    cards = self.cards.iloc[known:].reset_index()
+                    c.executemany('INSERT INTO cards VALUES (?, ?, ?, ?)', cards.astype(object).where(cards.notnull(), None).values.tolist())
+                    stored_games, stored_plays = self._stored_rows(store)
+                    c.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('high_water_mark', day_id), ('next_game', next_game), ('stored_games', stored_games), ('stored_plays', stored_plays)])
+                    conn.commit()
+                days += 1
+        self.games = None
+        self.plays = None
+        with profiling.stage('read_aggregates') as stage:
+            self.aggregates = {
+                'plays': pd.read_sql_query('SELECT * FROM play_counts', conn),
+                'matchups': pd.read_sql_query('SELECT * FROM matchup_counts', conn)
+            }
+            stage.add(rows = sum(len(frame) for frame in self.aggregates.values()))
+        meta = dict(c.execute('SELECT key, value FROM meta').fetchall())
+        conn.close()
+        self._set_source('aggregates', AGGREGATE_DATABASE, self._file_stamp(AGGREGATE_DATABASE), meta.get('high_water_mark'), meta.get('next_game'), len(self.aggregates['plays']), len(self.aggregates['matchups']))
+        return days
+
+    def _stored_rows(self, store):
+        """Internal method -- Numbers of rows in the games and plays tables of an open store, flushed to disk first so they can be committed to the meta table"""
+        if isinstance(store, ParquetStore):
+            return store.rows('games'), store.rows('plays')
+        store.flush(fsync = True)
+        return tuple(int(store.get_storer(key).nrows) if '/' + key in store.keys() else 0 for key in ('table', 'plays'))
+
+    def _truncate_store(self, store, games, plays):
+        """Internal method -- Drops the games and plays rows an open store has past the numbers committed to the meta table, called by update_aggregates"""
+        if isinstance(store, ParquetStore):
+            store.truncate('games', games)
+            store.truncate('plays', plays)
+            return
+        for key, rows in (('table', games), ('plays', plays)):
+            if '/' + key in store.keys() and store.get_storer(key).nrows > rows:
+                store.remove(key, start = rows)
+
+    def _intern_play_counts(self, c):
+        """Internal method -- Moves a play_counts table keyed on card names over to card ids, the names go into the cards table without their card id and mana, called by update_aggregates"""
+        c.execute('BEGIN')
+        c.execute('ALTER TABLE play_counts RENAME TO play_counts_names')
+        c.execute('INSERT INTO cards (card, name) SELECT row_number() OVER (ORDER BY card) - 1, card FROM (SELECT DISTINCT card FROM play_counts_names WHERE card IS NOT NULL)')
+        c.execute(_PLAY_COUNTS_TABLE)
+        c.execute('INSERT INTO play_counts SELECT mode, player, cards.card, p_deck_type, o_deck_type, turn, win, loss FROM play_counts_names JOIN cards ON cards.name = play_counts_names.card')
+        c.execute('DROP TABLE play_counts_names')
+
+    def _merge_counts(self, c, play_counts, matchup_counts):
+        """
+        Internal method -- Adds one day of partial counts onto the stored aggregates, called by update_aggregates
+
+        :param c: cursor on AGGREGATE_DATABASE
+        :param play_counts: _count_plays split by mode
+        :param matchup_counts: _count_matchups
+        :type c: sqlite3 cursor
+        :type play_counts: pandas dataframe
+        :type matchup_counts: pandas dataframe
+        """
+        c.executemany('INSERT INTO play_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (mode, player, card, p_deck_type, o_deck_type, turn) DO UPDATE SET win = win + excluded.win, loss = loss + excluded.loss',
+                      play_counts.reset_index().to_records(index = False).tolist())
+        c.executemany('INSERT INTO matchup_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (mode, p_deck_type, o_deck_type) DO UPDATE SET count = count + excluded.count, win = win + excluded.win, coin = coin + excluded.coin, duration = duration + excluded.duration, duration_sq = duration_sq + excluded.duration_sq, duration_count = duration_count + excluded.duration_count',
+                      matchup_counts.reset_index().to_records(index = False).tolist())
+
+    def rebuild_and_update(self, incremental = True, profile_dir = None, cprofile = None, progress = None):
+        """
+        Pull collectobot data and remake the graphs, days collectobot still stores as json are normalized first
+        Each stage (database reads, dataframe building, card extraction, groupbys, plotly serialization, sqlite writes) is timed into a json report in profile_dir, see profiling.profile
+
+        :param incremental: only parse the days added since the last rebuild, otherwise every statistic is recomputed from the first day
+        :param profile_dir: directory for the profile report, the YAHA_PROFILE environment variable if None, nothing is profiled if neither is set
+        :param cprofile: also dump cProfile stats for every stage, the YAHA_CPROFILE environment variable if None
+        :param progress: called with the name of the current step and the fraction of the rebuild done
+        :type incremental: bool
+        :type profile_dir: string
+        :type cprofile: bool
+        :type progress: function
+
+        :return: the profile report, None if nothing was profiled
+        :rtype: dictionary
+        """
+        progress = progress or (lambda step, fraction: None)
+        with profiling.profile('rebuild_and_update', profile_dir, cprofile) as profiler:
+            progress('normalize', 0.0)
+            with profiling.stage('normalize'):
+                collectobot.normalize()
+            progress('update_aggregates', 0.0)
+            with profiling.stage('update_aggregates'):
+                self.update_aggregates(rebuild = not incremental)
+            progress('make_graph_data', 0.5)
+            with profiling.stage('make_graph_data'):
+                self.make_graph_data(progress = lambda fraction: progress('make_graph_data', 0.5 + fraction/2))
+        return profiler.report() if profiler else None
+
+    def remake_graphs(self, profile_dir = None, cprofile = None, progress = None):
+        """
+        Remake the graphs, profiled like rebuild_and_update
+
+        :param profile_dir: directory for the profile report, the YAHA_PROFILE environment variable if None, nothing is profiled if neither is set
+        :param cprofile: also dump cProfile stats for every stage, the YAHA_CPROFILE environment variable if None
+        :param progress: called with the name of the current step and the fraction of the remake done
+        :type profile_dir: string
+        :type cprofile: bool
+        :type progress: function
+
+        :return: the profile report, None if nothing was profiled
+        :rtype: dictionary
+        """
+        progress = progress or (lambda step, fraction: None)
+        with profiling.profile('remake_graphs', profile_dir, cprofile) as profiler:
+            progress('read_data', 0.0)
+            with profiling.stage('read_data'):
+                self.open_collectobot_data()
+            progress('make_graph_data', 0.5)
+            with profiling.stage('make_graph_data'):
+                self.make_graph_data(progress = lambda fraction: progress('make_graph_data', 0.5 + fraction/2))
+        return profiler.report() if profiler else None
+
+
+_graph_worker = {}
+
+def _init_graph_worker(views, cards):
+    """Sets up a make_graph_data worker process with the graph views shared by all of its shards, and the card dictionary to name the cards with"""
+    _graph_worker['analyzer'] = yaha_analyzer()
+    _graph_worker['analyzer'].cards = cards
+    _graph_worker['views'] = views
+
+def _make_graph_shard(shard):
+    """Makes the plotly json for one shard of make_graph_data in a worker process"""
+    return _graph_worker['analyzer']._make_graph_shard(shard, _graph_worker['views'])
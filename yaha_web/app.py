@@ -1,4 +1,4 @@
-from flask import Flask, make_response, render_template
+from flask import Flask, jsonify, make_response, render_template, request, abort, url_for
 import yaha_analyzer
 import plotly.plotly as py
 import plotly
@@ -6,53 +6,81 @@ import plotly.graph_objs as go
 import json
 import sys
 import collectobot
+import jobs
 CSV_HEADER = 'Content-Disposition'
 
 app = Flask(__name__)
+graph_reader = yaha_analyzer.yaha_analyzer() #serves graphs out of its in-memory cache, rebuilds get their own analyzer
 
 @app.route('/')
 def index():
-    scrape = yaha_analyzer.yaha_analyzer()
-    deck_data, card_data = scrape.get_name_list()
+    deck_data, card_data = graph_reader.get_name_list()
     return render_template('front.html', title = 'Yaha', active=generate_active_status('index'), deck_data=deck_data, card_data=card_data, game_count = 20)
 
 @app.route('/card/<card_name>')
 def card(card_name):
-    scrape = yaha_analyzer.yaha_analyzer()
-    graphJSON = scrape.get_graph_data(card_name)
     game_count = 20
-    return render_template('matchups.html', title = card_name, page_name = card_name, active=generate_active_status('card'), graphJSON=graphJSON, game_count = game_count, ids = ['Heatmap', 'Win Counts With {} in Decks'.format(card_name), 'Win Counts With {} Against Decks'.format(card_name), 'Lose Counts With', 'Lose Counts Against'])
+    return render_template('matchups.html', title = card_name, page_name = card_name, graph_type = 'card', active=generate_active_status('card'), game_count = game_count, ids = ['Heatmap', 'Win Counts With {} in Decks'.format(card_name), 'Win Counts With {} Against Decks'.format(card_name), 'Lose Counts With', 'Lose Counts Against'])
 
 @app.route('/deck/<deck>')
 def return_deck(deck):
     deck = deck.replace(' ', '_')
-    scrape = yaha_analyzer.yaha_analyzer()
-    graphJSON = scrape.get_graph_data(deck)
-
     game_count = 20
-    return render_template('matchups.html', title = deck, page_name = deck, active = generate_active_status('deck'), graphJSON = graphJSON, game_count = game_count, ids = ['Heatmap'])
+    return render_template('matchups.html', title = deck, page_name = deck, graph_type = 'deck', active = generate_active_status('deck'), game_count = game_count, ids = ['Heatmap'])
+
+@app.route('/graph/<graph_type>/<name>.json')
+def graph_json(graph_type, name):
+    """Sends the stored graph json, precompressed when the client accepts brotli or gzip, with an etag for conditional requests"""
+    if graph_type == 'deck':
+        name = name.replace(' ', '_')
+    try:
+        graph, gzip_graph, br_graph, etag = graph_reader.get_graph_file(name, graph_type)
+    except IndexError:
+        abort(404)
+    if br_graph is not None and 'br' in request.accept_encodings:
+        response, encoding = make_response(br_graph), 'br'
+    elif 'gzip' in request.accept_encodings:
+        response, encoding = make_response(gzip_graph), 'gzip'
+    else:
+        response, encoding = make_response(graph), None
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+        etag = '{}-{}'.format(etag, encoding)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/decks')
 def return_decks():
-    scrape = yaha_analyzer.yaha_analyzer()
-    deck_data, card_data = scrape.get_name_list()
+    deck_data, card_data = graph_reader.get_name_list()
     return render_template('front.html', title = 'Decks', active = generate_active_status('deck'), deck_data=deck_data, card_data=[], game_count = 20)
 
 @app.route('/cards')
 def return_cards():
-    scrape = yaha_analyzer.yaha_analyzer()
-    deck_data, card_data = scrape.get_name_list()
+    deck_data, card_data = graph_reader.get_name_list()
     return render_template('front.html', title = 'Cards', active=generate_active_status('card'), deck_data=[], card_data=card_data, game_count = 20)
 
 @app.route('/rebuild')
 def rebuild():
-    scrape = yaha_analyzer.yaha_analyzer()
-    scrape.rebuild_and_update()
+    return submit_job('rebuild')
 
 @app.route('/remake')
 def remake():
-    scrape = yaha_analyzer.yaha_analyzer()
-    scrape.remake_graphs()
+    return submit_job('remake')
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    """Reports a rebuild job's status and progress"""
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+def submit_job(kind):
+    """Queues a background job, or joins the one of that kind already queued, and points the client at its status"""
+    job_id = jobs.submit(kind)
+    return jsonify(jobs.get(job_id)), 202, {'Location': url_for('job_status', job_id = job_id)}
 
 
 def generate_active_status(active_element):
@@ -0,0 +1 @@
+../yaha_analysis/jobs.py
\ No newline at end of file
@@ -0,0 +1 @@
+../yaha_analysis/profiling.py
\ No newline at end of file